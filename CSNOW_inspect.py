@@ -25,7 +25,6 @@
 #   and grid shape that are not what's specified in https://nsidc.org/ease/ease-grid-projection-gt
 """
 
-import gc
 import datetime
 from pathlib import Path
 import re
@@ -36,16 +35,16 @@ import geopandas as gpd
 
 import pandas as pd
 import xarray as xr
-from rasterio.warp import Resampling
 import rioxarray
-from ease_lonlat import EASE2GRID, SUPPORTED_GRIDS
+
+from validation.CSNOW import EASE2G_epsg_str, ingest
+from validation.composite import composite
+from validation.regrid import cached_plan, regrid
 
 # from memory_profiler import profile
 
 xr.set_options(keep_attrs=True)
 
-EASE2G_epsg_str = "epsg:6933"
-
 
 def area_of_interest(domain='WY'):
     """ Define area of interest to clip the data
@@ -86,83 +85,6 @@ def area_of_interest(domain='WY'):
     return bbox_latlon_gs, bbox_ease2_gs
 
 
-def ease2grid_coords():
-    # Define the EASE2_G1km grid
-    egrid = EASE2GRID(name='EASE2_G1km', **SUPPORTED_GRIDS['EASE2_G1km'])
-    eg_easting = [egrid.x_min + (i+0.5)*egrid.res for i in range(34704)]
-    # eg_northing = [egrid.y_max - (j+0.5)*egrid.res for j in range(4500)[::-1]]
-    eg_northing = [egrid.y_max - (j+0.5)*egrid.res for j in range(4500)]
-    return eg_easting, eg_northing
-
-# ## Experimental data product
-# 
-# - This dataset has no global attributes whatsoever
-# - The dimensions are not actually defined as variables. Therefore the coordinate values are unknown;
-#   they're just indices
-# - It has none of the additional CF information (attributes and variables) that would enable
-#   automatic identification of the x & y coordinates and the projection
-
-#@profile
-def open_process(nc_fpath, eg_easting, eg_northing):
-    ds = xr.open_dataset(nc_fpath, cache=False)
-    ds = ds.rename_dims(dims_dict={"ease2_x": "easting", "ease2_y": "northing"})
-
-    # TODO: easting and northing arrays could be calculated just once,
-    #   with the first dataset only
-
-    # calculate the y coordinate (cell center) for row j (base 0 from the top)
-    ds.coords["northing"] = eg_northing
-    ds["northing"].attrs = dict(
-        axis='Y', 
-        long_name='EASE2_G1km Northing', 
-        standard_name='projection_y_coordinate', 
-        units='m'
-    )
-
-    # lon_arr = pub_ds["easting"].values
-    # exp_ds.coords["easting"] = np.append(lon_arr, lon_arr[-1] + (lon_arr[-1] - lon_arr[-2]))
-    # calculate the x coordinate (cell center) for col i (base 0 from the left)
-    ds.coords["easting"] = eg_easting
-    ds["easting"].attrs = dict(
-        axis='X', 
-        long_name='EASE2_G1km Easting', 
-        standard_name='projection_x_coordinate', 
-        units='m'
-    )
-
-    clean_ds = (
-        ds
-        .rio.set_spatial_dims('easting', 'northing')
-        .rio.write_crs(EASE2G_epsg_str)
-    )
-
-    # Add `grid_mapping` global and variable attributes
-    grid_mapping_name = "spatial_ref"
-    clean_ds.attrs['grid_mapping'] = grid_mapping_name
-    clean_ds['snd'].attrs['grid_mapping'] = grid_mapping_name
-
-    #ds.close()
-    #del ds
-    #gc.collect()
-
-    return clean_ds
-
-
-#@profile
-def add_timecoord(ds, date_tindex):
-    """Add time (date) dimension and coordinate
-    """
-    date_da = xr.DataArray([date_tindex], coords=[('time', [date_tindex])])
-    ds["snd"] = ds.snd.expand_dims(time=date_da)
-    ds["time"].attrs = dict(
-        axis='T', 
-        long_name='Date', 
-        standard_name='time'
-    )
-
-    return ds
-
-
 if __name__ == '__main__':
     base_dpath = Path("/usr/mayorgadat/workmain/aarendt/CSO/projectwork/CSNOW")
     pub_dpath = base_dpath / "sentinel1_snow_depth_data"
@@ -179,42 +101,13 @@ if __name__ == '__main__':
     domain = 'NAmer'
     bbox_latlon_gs, bbox_ease2_gs = area_of_interest(domain=domain)
 
-    # Kernel dies on the 13th file, so I can only run 12 files for now,
-    # and in some instances as few as 10
     dates = pd.date_range('2019-05-01', freq='D', periods=30)
 
-    ds_lst = []
-    first_flg = True
-    for date in dates:
-        fname = f"SD_{date.strftime('%Y%m%d')}.nc"
-        print(f"File: {fname}")
-
-        if first_flg:
-            eg_easting, eg_northing = ease2grid_coords()
-            first_flg = False
-        exp_ds = open_process(exp_dpath / fname, eg_easting, eg_northing)
-
-        # Add time coordinate from date
-        exp_ds = add_timecoord(exp_ds, date)
-
-        # Transposing is necessary for xarray to plot correctly and rioxarray
-        # to handle reprojection to lat lon correctly.
-        # Mainly, geographic coordinates should be Y, X rather than X, Y
-        exp_ds = exp_ds.transpose('time', 'northing', 'easting')
-
-        # Clip to area of interest
-        exp_clip_ds = exp_ds.rio.clip(bbox_ease2_gs.geometry, all_touched=True).copy(deep=True)
-        ds_lst.append(exp_clip_ds)
-
-        exp_ds.close()
-        del exp_ds
-        gc.collect()
-
-    exp_clipconcat_ds = xr.concat(ds_lst, dim="time")
-
-    #del exp_clipconcat_ds
-    #gc.collect()
-
+    # Clip each day to the area of interest window and append it to a zarr
+    # store, so memory use stays constant however many days are processed
+    store = exp_dpath / f"Experimental_{domain}_2019May.zarr"
+    ingest(dates, exp_dpath, bbox_ease2_gs.total_bounds, store, geometry=bbox_ease2_gs.geometry)
+    exp_clipconcat_ds = xr.open_zarr(store)
 
     # **NOTES:**
     # - Variable attributes for `time` dropped out. 
@@ -231,36 +124,41 @@ if __name__ == '__main__':
     # This is probably an encoding field used by xarray to describe how a variable is serialized.
     # To proceed, remove this key from the variable's attributes manually.
     # ```
-    del exp_clipconcat_ds.snd.attrs['grid_mapping']
+    # (grid_mapping is removed before writing to the zarr store)
     exp_clipconcat_ds.to_netcdf(
         path=exp_dpath / f"Experimental_{domain}_2019May.nc",
         encoding={"snd": {"dtype": "float32", "zlib": True}}
     )
 
     # ## Bin in time
-    exp_cc_median_ds = exp_clipconcat_ds.resample(time=median_bin_days).median('time')
-    del ds_lst, exp_clipconcat_ds
-    gc.collect()
+    # Days are streamed through the compositor one at a time, so only one
+    # bin of days is held in memory; bins start on the first date, like resample
+    daily_grids = ((t, exp_clipconcat_ds.snd.sel(time=t)) for t in exp_clipconcat_ds.time.values)
+    exp_cc_median_ds = xr.concat(list(composite(daily_grids, freq=median_bin_days)), dim='time')
+    exp_cc_median_ds = exp_cc_median_ds[['median']].rename({'median' : 'snd'})
 
     # ## Reproject to lat lon
     
     x_name = 'longitude'
     y_name = 'latitude'
     
-    # resampling=Resampling.bilinear
-    exp_cc_median_ll_ds = (
-        exp_cc_median_ds
-        #.transpose('time', 'northing', 'easting')
-        .rio.reproject(
-            bbox_latlon_gs.crs,
-            resolution=latlon_deg_res,
-            resampling=Resampling.nearest  # resampling=Resampling.nearest
-        )
+    # The source and target grids never change for a domain, so the
+    # EASE2 -> lat/lon mapping is computed once and saved for later runs
+    regrid_method = 'nearest'  # regrid_method = 'bilinear'
+    plan = cached_plan(
+        exp_dpath / "regrid_plans",
+        f"{domain}_{latlon_deg_res}_{regrid_method}",
+        exp_cc_median_ds["easting"].values,
+        exp_cc_median_ds["northing"].values,
+        EASE2G_epsg_str,
+        latlon_deg_res,
+        dst_crs=bbox_latlon_gs.crs.to_string(),
+        method=regrid_method
     )
     exp_cc_median_ll_ds = (
-        exp_cc_median_ll_ds
-        .rio.set_spatial_dims('x', 'y')
-        .rename({"x": x_name, "y": y_name})
+        regrid(exp_cc_median_ds, plan, x_dim='easting', y_dim='northing', x_name=x_name, y_name=y_name)
+        .rio.set_spatial_dims(x_name, y_name)
+        .rio.write_crs(bbox_latlon_gs.crs)
     )
 
     # del exp_cc_median_ll_ds.snd.attrs['grid_mapping']
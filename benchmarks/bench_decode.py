@@ -0,0 +1,56 @@
+"""Compare SNODAS decoding engines on a local SNODAS tar archive.
+
+Usage:
+    python benchmarks/bench_decode.py SNODAS_unmasked_20200201.tar [--code 1036] [--repeat 5]
+"""
+
+import argparse
+import tarfile
+import time
+import tracemalloc
+
+from validation import utils as ut
+import validation.SNODAS as SNODAS
+
+
+def bench(path, code, engine, repeat):
+    times = []
+    peak = 0
+    for _ in range(repeat):
+        tracemalloc.start()
+        start = time.perf_counter()
+        tar = tarfile.open(path, mode='r|')
+        ds = SNODAS.tar_to_snodas(tar, SNODAS.snodas_file_format(ut.date_from_file(path), code=code),
+                                  code=code, engine=engine)
+        ds.load()
+        times.append(time.perf_counter() - start)
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    return min(times), peak, ds
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('path', help='SNODAS tar archive')
+    parser.add_argument('--code', type=int, default=1036, help='SNODAS product code')
+    parser.add_argument('--repeat', type=int, default=5, help='Number of runs per engine')
+    args = parser.parse_args()
+
+    results = {}
+    for engine in ['gdal', 'numpy']:
+        try:
+            seconds, peak, ds = bench(args.path, args.code, engine, args.repeat)
+        except Exception as e:
+            # e.g. GDAL's Python bindings are not installed
+            tracemalloc.stop()
+            print('%-6s failed: %s: %s' % (engine, type(e).__name__, e))
+            continue
+        results[engine] = ds
+        print('%-6s %8.3f s  %8.1f MB peak (Python allocations)' % (engine, seconds, peak / 1e6))
+
+    if len(results) < 2:
+        raise SystemExit(1)
+    same = (results['gdal'].values == results['numpy'].values).all()
+    print('identical values: %s' % same)
+    print('gdal transform:  %s' % (results['gdal'].attrs['transform'],))
+    print('numpy transform: %s' % (results['numpy'].attrs['transform'],))
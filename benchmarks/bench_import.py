@@ -0,0 +1,76 @@
+"""Measure import time of validation modules in fresh interpreters.
+
+Each module is imported in a new process, so nothing is cached between
+runs. Wall time is the best of the repeated runs; python -X importtime
+gives the heaviest packages loaded along the way.
+
+Usage:
+    python benchmarks/bench_import.py [--modules validation validation.stats] [--repeat 5] [--top 5]
+"""
+
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+MODULES = ['validation', 'validation.cli', 'validation.creds', 'validation.metrics', 'validation.raster',
+           'validation.utils', 'validation.Elevation', 'validation.stats', 'validation.matchups',
+           'validation.SNODAS', 'validation.jobs']
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def import_env():
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([ROOT] + [p for p in [env.get('PYTHONPATH')] if p])
+    return env
+
+
+def wall_time(module, repeat):
+    """Get best wall time of importing module in a fresh interpreter, minus interpreter startup."""
+    times = []
+    for statement in ['pass', 'import %s' % module]:
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, '-c', statement], check=True, env=import_env())
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        times.append(best)
+    return times[1] - times[0]
+
+
+def import_times(statement):
+    """Get dictionary of module name to cumulative import seconds while running statement."""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', statement],
+                            check=True, env=import_env(), stderr=subprocess.PIPE, universal_newlines=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or '[us]' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(cumulative) / 1e6
+    return times
+
+
+def heaviest(module, top):
+    """Get (package, cumulative seconds) of the heaviest packages imported by module."""
+    startup = import_times('pass')
+    # Packages, not their submodules; a package's time includes what it imports first
+    packages = [(name, seconds) for name, seconds in import_times('import %s' % module).items()
+                if '.' not in name and name not in startup and not name.startswith(('_', 'validation'))]
+    return sorted(packages, key=lambda p: -p[1])[:top]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--modules', nargs='+', default=MODULES, help='Modules to import')
+    parser.add_argument('--repeat', type=int, default=5, help='Number of runs per module')
+    parser.add_argument('--top', type=int, default=5, help='Number of heaviest packages listed')
+    args = parser.parse_args()
+
+    for module in args.modules:
+        seconds = wall_time(module, args.repeat)
+        packages = ', '.join('%s %.0f ms' % (name, s * 1e3) for name, s in heaviest(module, args.top))
+        print('%-22s %8.1f ms  %s' % (module, seconds * 1e3, packages))
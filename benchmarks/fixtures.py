@@ -0,0 +1,275 @@
+"""Generate synthetic SNODAS archives, C-SNOW NetCDFs and observation tables.
+
+Inputs match the real products in layout and size: SNODAS tars hold
+gzipped .dat/.txt pairs for all eight products at the masked (6935 x 3351)
+or unmasked (8192 x 4096) grid, C-SNOW files hold the full EASE2_G1km
+grid, and observation tables have the columns of CSO database exports.
+Values are smooth random fields with nodata and snow-free areas, so files
+compress like the real ones. Generated files are reused across runs.
+
+Usage:
+    python benchmarks/fixtures.py [--data benchmarks/data] [--rows 1000 100000 10000000]
+"""
+
+import os
+import io
+import gzip
+import tarfile
+import argparse
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# Default directory for generated inputs
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+# Grid geometry of the SNODAS archives
+SNODAS_GRIDS = {
+    'masked' : {
+        'cols' : 6935,
+        'rows' : 3351,
+        'xmin' : -124.733749999998,
+        'xmax' : -66.9420833333342,
+        'ymin' : 24.9495833333335,
+        'ymax' : 52.8745833333323
+    },
+    'unmasked' : {
+        'cols' : 8192,
+        'rows' : 4096,
+        'xmin' : -130.516666666661,
+        'xmax' : -62.2499999999975,
+        'ymin' : 24.0999999999990,
+        'ymax' : 58.2333333333310
+    }
+}
+
+# Product codes, file name parts and descriptions of the files in a SNODAS archive
+SNODAS_PRODUCTS = [
+    (1025, '0%dSlL00T0024TTNATS%s05DP001', 'Liquid precipitation', 'kg / square meter / 10.0'),
+    (1025, '0%dSlL01T0024TTNATS%s05DP001', 'Solid precipitation', 'kg / square meter / 10.0'),
+    (1034, '1%dtS__T0001TTNATS%s05HP001', 'Snow water equivalent', 'Meters / 1000.000'),
+    (1036, '1%dtS__T0001TTNATS%s05HP001', 'Snow depth', 'Meters / 1000.000'),
+    (1038, '1%dwS__A0024TTNATS%s05DP001', 'Snow pack average temperature', 'Kelvins / 1.000'),
+    (1039, '1%dlL00T0024TTNATS%s05DP000', 'Blowing snow sublimation', 'Meters / 100000.000'),
+    (1044, '1%dbS__T0024TTNATS%s05DP000', 'Snow melt runoff', 'Meters / 100000.000'),
+    (1050, '1%dlL00T0024TTNATS%s05DP000', 'Sublimation from the snow pack', 'Meters / 100000.000')
+]
+
+# Number of cells of the EASE2_G1km grid covered by C-SNOW files
+EASE2_SHAPE = (4500, 34704)
+
+# Range of real observation sizes to benchmark against
+OBSERVATION_ROWS = [1000, 100000, 10000000]
+
+def smooth_field(shape, rng, block=64):
+    """Random field in [0, 1) varying smoothly over blocks of cells.
+
+    Keyword arguments:
+    shape -- Shape of field
+    rng -- numpy random Generator
+    block -- Size of blocks in cells (default 64)
+    """
+    coarse = rng.random((shape[0] // block + 2, shape[1] // block + 2)).astype(np.float32)
+    rows = np.linspace(0, coarse.shape[0] - 1.001, shape[0])
+    cols = np.linspace(0, coarse.shape[1] - 1.001, shape[1])
+    r0, c0 = rows.astype(np.intp), cols.astype(np.intp)
+    wr, wc = (rows - r0)[:, np.newaxis].astype(np.float32), (cols - c0).astype(np.float32)
+    top = coarse[r0][:, c0] * (1 - wc) + coarse[r0][:, c0 + 1] * wc
+    bottom = coarse[r0 + 1][:, c0] * (1 - wc) + coarse[r0 + 1][:, c0 + 1] * wc
+    return top * (1 - wr) + bottom * wr
+
+def snodas_header(grid, code, description, units):
+    """Build SNODAS header text for a product.
+
+    Keyword arguments:
+    grid -- Entry of SNODAS_GRIDS
+    code -- Product code
+    description -- Product description
+    units -- Data units description
+    """
+    lines = [
+        'Format version: NOHRSC GIS/RS raster file v1.1',
+        'Description: %s' % description,
+        'Data units: %s' % units,
+        'Data type: integer',
+        'Product code: %d' % code,
+        'Number of columns: %d' % grid['cols'],
+        'Number of rows: %d' % grid['rows'],
+        'Data bytes per pixel: 2',
+        'Minimum x-axis coordinate: %.12f' % grid['xmin'],
+        'Maximum x-axis coordinate: %.12f' % grid['xmax'],
+        'Minimum y-axis coordinate: %.12f' % grid['ymin'],
+        'Maximum y-axis coordinate: %.12f' % grid['ymax'],
+        'Horizontal datum: WGS84',
+        'No data value: -9999'
+    ]
+    return ('\n'.join(lines) + '\n').encode('latin-1')
+
+def snodas_values(grid, code, rng, land):
+    """Generate big-endian int16 values of a SNODAS product.
+
+    Keyword arguments:
+    grid -- Entry of SNODAS_GRIDS
+    code -- Product code
+    rng -- numpy random Generator
+    land -- Boolean land mask of grid
+    """
+    field = smooth_field((grid['rows'], grid['cols']), rng)
+    if code == 1038:
+        values = 250 + 23 * field
+    else:
+        # Snow covers part of the land, with depths up to a few meters
+        values = np.where(field > 0.55, (field - 0.55) * 6000, 0)
+    values = np.where(land, values, -9999)
+    return values.astype('>i2')
+
+def add_member(tar, name, data):
+    """Add bytes to tar archive as a file."""
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = 0
+    tar.addfile(info, io.BytesIO(data))
+
+def snodas_tar(date, masked=False, data_dir=DATA_DIR, header_first=False, seed=0):
+    """Generate a SNODAS archive for a date, unless it already exists.
+
+    Keyword arguments:
+    date -- datetime of archive
+    masked -- Whether to generate a masked archive (default False)
+    data_dir -- Directory to write archive to (default DATA_DIR)
+    header_first -- Put each .txt before its .dat (default False, .dat first)
+    seed -- Random seed (default 0)
+
+    Returns:
+    Path of archive
+    """
+    kind = 'masked' if masked else 'unmasked'
+    prefix = 'us_ssmv' if masked else 'zz_ssmv'
+    name = date.strftime('SNODAS_%Y%m%d.tar' if masked else 'SNODAS_unmasked_%Y%m%d.tar')
+    path = os.path.join(data_dir, name)
+    if os.path.exists(path):
+        return path
+
+    grid = SNODAS_GRIDS[kind]
+    rng = np.random.default_rng(seed)
+    land = smooth_field((grid['rows'], grid['cols']), rng, block=256) > (0.2 if masked else 0.35)
+    os.makedirs(data_dir, exist_ok=True)
+    with tarfile.open(path + '.tmp', 'w') as tar:
+        for code, pattern, description, units in SNODAS_PRODUCTS:
+            base = prefix + pattern % (code, date.strftime('%Y%m%d'))
+            dat = gzip.compress(snodas_values(grid, code, rng, land).tobytes(), compresslevel=6)
+            txt = gzip.compress(snodas_header(grid, code, description, units), compresslevel=6)
+            members = [(base + '.dat.gz', dat), (base + '.txt.gz', txt)]
+            for member in (members[::-1] if header_first else members):
+                add_member(tar, *member)
+    os.replace(path + '.tmp', path)
+    return path
+
+def csnow_file(date, data_dir=DATA_DIR, seed=0):
+    """Generate a C-SNOW NetCDF on the full EASE2_G1km grid, unless it already exists.
+
+    Keyword arguments:
+    date -- datetime of file
+    data_dir -- Directory to write file to (default DATA_DIR)
+    seed -- Random seed (default 0)
+
+    Returns:
+    Path of file
+    """
+    import xarray as xr
+
+    path = os.path.join(data_dir, date.strftime('SD_%Y%m%d.nc'))
+    if os.path.exists(path):
+        return path
+    rng = np.random.default_rng(seed + date.toordinal())
+    field = smooth_field(EASE2_SHAPE, rng, block=128)
+    # C-SNOW only covers snowy mountain areas of the northern hemisphere
+    snd = np.where(field > 0.6, (field - 0.6) * 10, np.nan).astype(np.float32)
+    snd[:EASE2_SHAPE[0] // 4] = np.nan
+    ds = xr.Dataset({'snd' : (('ease2_y', 'ease2_x'), snd)})
+    os.makedirs(data_dir, exist_ok=True)
+    ds.to_netcdf(path + '.tmp', format='NETCDF4', encoding={'snd' : {'zlib' : True, 'complevel' : 4,
+                                                                   'chunksizes' : (512, 512)}})
+    os.replace(path + '.tmp', path)
+    return path
+
+def observations(rows, data_dir=DATA_DIR, start=datetime(2020, 2, 1), days=1, seed=0,
+                 batch_size=1000000):
+    """Generate an observation table like CSO database exports, unless it already exists.
+
+    Points fall inside the unmasked SNODAS grid, with times spread over the
+    given days.
+
+    Keyword arguments:
+    rows -- Number of observations
+    data_dir -- Directory to write file to (default DATA_DIR)
+    start -- First date of observations (default 2020-02-01)
+    days -- Number of days observations are spread over (default 1)
+    seed -- Random seed (default 0)
+    batch_size -- Rows generated and written at a time (default 1000000)
+
+    Returns:
+    Path of Parquet file
+    """
+    path = os.path.join(data_dir, 'observations_%d_%s_%dd.parquet' % (rows, start.strftime('%Y%m%d'), days))
+    if os.path.exists(path):
+        return path
+    grid = SNODAS_GRIDS['unmasked']
+    rng = np.random.default_rng(seed)
+    sources = np.array(['MountainHub', 'SnowPilot', 'RegObs'])
+    authors = np.array(['observer_%03d' % i for i in range(500)])
+    os.makedirs(data_dir, exist_ok=True)
+
+    writer = None
+    for offset in range(0, rows, batch_size):
+        n = min(batch_size, rows - offset)
+        seconds = rng.integers(0, days * 86400, n)
+        df = pd.DataFrame({
+            'id' : np.char.add('obs', np.arange(offset, offset + n).astype(str)),
+            'author' : authors[rng.integers(0, len(authors), n)],
+            'depth' : np.round(rng.gamma(2.0, 40.0, n), 1),
+            'source' : sources[rng.integers(0, len(sources), n)],
+            'timestamp' : pd.Timestamp(start) + pd.to_timedelta(seconds, unit='s'),
+            'longitude' : rng.uniform(grid['xmin'], grid['xmax'], n),
+            'latitude' : rng.uniform(grid['ymin'], grid['ymax'], n),
+            'elevation' : rng.uniform(0, 4000, n)
+        })
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        if writer is None:
+            writer = pq.ParquetWriter(path + '.tmp', table.schema)
+        writer.write_table(table)
+    writer.close()
+    os.replace(path + '.tmp', path)
+    return path
+
+def generate(data_dir=DATA_DIR, date=datetime(2020, 2, 1), csnow_days=2, rows=OBSERVATION_ROWS):
+    """Generate all benchmark inputs.
+
+    Keyword arguments:
+    data_dir -- Directory to write inputs to (default DATA_DIR)
+    date -- Date of SNODAS archives and first C-SNOW file (default 2020-02-01)
+    csnow_days -- Number of daily C-SNOW files (default 2)
+    rows -- Sizes of observation tables (default OBSERVATION_ROWS)
+
+    Returns:
+    Dictionary of input paths
+    """
+    return {
+        'snodas_masked' : snodas_tar(datetime(2009, date.month, date.day), masked=True, data_dir=data_dir),
+        'snodas_unmasked' : snodas_tar(date, data_dir=data_dir),
+        'csnow' : [csnow_file(date + timedelta(days=i), data_dir=data_dir) for i in range(csnow_days)],
+        'observations' : {n : observations(n, data_dir=data_dir, start=date) for n in rows}
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--data', default=DATA_DIR, help='Directory to write inputs to')
+    parser.add_argument('--csnow-days', type=int, default=2, help='Number of daily C-SNOW files')
+    parser.add_argument('--rows', type=int, nargs='+', default=OBSERVATION_ROWS, help='Sizes of observation tables')
+    args = parser.parse_args()
+
+    for name, value in generate(args.data, csnow_days=args.csnow_days, rows=args.rows).items():
+        print('%-16s %s' % (name, value))
@@ -0,0 +1,289 @@
+"""Run benchmark suite on synthetic inputs and store results.
+
+Each stage runs in a fresh process, so peak memory is measured per stage.
+Latency is measured over repeated runs; a final run under tracemalloc
+gives peak Python/numpy allocations, and the process high-water RSS
+(reset after setup where the kernel allows it) is reported alongside.
+Results are written to benchmarks/results as JSON named after the current
+commit, and can be compared with an earlier run.
+
+Usage:
+    python benchmarks/run.py [--stages tar_to_snodas sample_grid] [--repeat 3] [--compare results/abc1234.json]
+"""
+
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import resource
+import tempfile
+import tarfile
+import tracemalloc
+import subprocess
+import multiprocessing
+from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import fixtures
+
+# Directory results are stored in
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+def proc_status(field):
+    """Get memory field of /proc/self/status in bytes, or None off Linux."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+
+def reset_peak_rss():
+    """Reset the high-water RSS of this process, where the kernel allows it."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+def peak_rss():
+    """Get high-water resident set size of this process in bytes."""
+    peak = proc_status('VmHWM')
+    if peak is not None:
+        return peak
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+def tar_date(path):
+    from validation import utils as ut
+    return ut.date_from_file(os.path.basename(path))
+
+def stage_url_to_tar(inputs, archive='unmasked', stream=False):
+    """Read a SNODAS archive through url_to_tar from a file:// URL."""
+    from validation import utils as ut
+    path = inputs['snodas_' + archive]
+    def run():
+        tar = ut.url_to_tar('file://' + path, stream=stream)
+        for member in tar:
+            if member.isfile():
+                tar.extractfile(member).read()
+        tar.close()
+    return run, os.path.getsize(path), 'bytes'
+
+def stage_tar_to_snodas(inputs, archive='unmasked', engine='numpy', code=1036):
+    """Decode one product from a SNODAS archive in a single streamed pass."""
+    import validation.SNODAS as SNODAS
+    path = inputs['snodas_' + archive]
+    gz_format = SNODAS.snodas_file_format(tar_date(path))
+    def run():
+        with open(path, 'rb') as f:
+            SNODAS.tar_to_snodas(tarfile.open(fileobj=f, mode='r|'), gz_format, code=code, engine=engine).load()
+    return run, os.path.getsize(path), 'bytes'
+
+def stage_tar_to_products(inputs, archive='unmasked', codes=(1034, 1036, 1038, 1044), bbox=None):
+    """Decode several products from a SNODAS archive in one streamed pass."""
+    import validation.SNODAS as SNODAS
+    path = inputs['snodas_' + archive]
+    date = tar_date(path)
+    def run():
+        with open(path, 'rb') as f:
+            SNODAS.tar_to_products(tarfile.open(fileobj=f, mode='r|'), date, list(codes), bbox=bbox)
+    return run, os.path.getsize(path), 'bytes'
+
+def stage_save(inputs, archive='unmasked', code=1036, save='save_tiff', days=1, **options):
+    """Write decoded SNODAS grids with a utils writer, several days into one file."""
+    import validation.SNODAS as SNODAS
+    from validation import utils as ut
+    path = inputs['snodas_' + archive]
+    date = tar_date(path)
+    with open(path, 'rb') as f:
+        da = SNODAS.tar_to_snodas(tarfile.open(fileobj=f, mode='r|'), SNODAS.snodas_file_format(date), code=code)
+    grids = da if days == 1 else [(date + timedelta(days=i), da) for i in range(days)]
+    out_path = os.path.join(tempfile.mkdtemp(), 'snodas.tif' if save == 'save_tiff' else 'snodas.nc')
+    def run():
+        getattr(ut, save)(grids, out_path, **options)
+    return run, da.values.nbytes * days, 'bytes'
+
+def stage_sample_grid(inputs, rows=100000, archive='unmasked', code=1036):
+    """Sample a decoded SNODAS grid at observation points."""
+    import pyarrow.parquet as pq
+    import validation.SNODAS as SNODAS
+    path = inputs['snodas_' + archive]
+    with open(path, 'rb') as f:
+        da = SNODAS.tar_to_snodas(tarfile.open(fileobj=f, mode='r|'),
+                                  SNODAS.snodas_file_format(tar_date(path)), code=code)
+    obs = pq.read_table(inputs['observations'][rows], columns=['longitude', 'latitude']).to_pandas()
+    lons = obs['longitude'].to_numpy()
+    lats = obs['latitude'].to_numpy()
+    def run():
+        SNODAS.sample_grid(da, lons, lats, scale=SNODAS.PRODUCT_SCALES[code])
+    return run, rows, 'rows'
+
+def stage_qaqc_flag(inputs, rows=100000):
+    """Flag observations with the default QA/QC rules."""
+    import pyarrow.parquet as pq
+    import validation.qaqc as qaqc
+    obs = pq.read_table(inputs['observations'][rows]).to_pandas()
+    def run():
+        qaqc.flag(obs)
+    return run, rows, 'rows'
+
+def stage_csnow_window(inputs):
+    """Open a C-SNOW file over an Alaska-sized window and load it."""
+    import validation.CSNOW as CSNOW
+    eg_easting, eg_northing = CSNOW.ease2grid_coords()
+    window = CSNOW.ease2_window((-1.7e7, 5.9e6, -1.2e7, 7.0e6), eg_easting, eg_northing)
+    path = inputs['csnow'][0]
+    def run():
+        CSNOW.open_process(path, eg_easting, eg_northing, window=window).load().close()
+    return run, os.path.getsize(path), 'bytes'
+
+def stage_csnow_ingest(inputs):
+    """Ingest all C-SNOW files over a window into a new zarr store."""
+    import validation.CSNOW as CSNOW
+    paths = inputs['csnow']
+    dates = [tar_date(path) for path in paths]
+    out_dir = tempfile.mkdtemp()
+    runs = []
+    def run():
+        store = os.path.join(out_dir, 'csnow_%d.zarr' % len(runs))
+        runs.append(store)
+        CSNOW.ingest(dates, os.path.dirname(paths[0]), (-1.7e7, 5.9e6, -1.2e7, 7.0e6), store)
+    return run, len(paths), 'days'
+
+# Stages and the parameter sets they run with
+STAGES = {
+    'url_to_tar' : (stage_url_to_tar, [{'archive' : 'unmasked'}, {'archive' : 'unmasked', 'stream' : True}]),
+    'tar_to_snodas' : (stage_tar_to_snodas, [{'archive' : 'masked'}, {'archive' : 'unmasked'},
+                                            {'archive' : 'unmasked', 'engine' : 'gdal'}]),
+    'tar_to_products' : (stage_tar_to_products, [{}, {'bbox' : [-112.1, 40.3, -108.95, 45.02]}]),
+    'save' : (stage_save, [{'save' : 'save_tiff'}, {'save' : 'save_tiff', 'cog' : True},
+                           {'save' : 'save_tiff', 'days' : 7}, {'save' : 'save_netcdf'},
+                           {'save' : 'save_netcdf', 'days' : 7}]),
+    'sample_grid' : (stage_sample_grid, [{'rows' : n} for n in fixtures.OBSERVATION_ROWS]),
+    'qaqc_flag' : (stage_qaqc_flag, [{'rows' : n} for n in fixtures.OBSERVATION_ROWS]),
+    'csnow_window' : (stage_csnow_window, [{}]),
+    'csnow_ingest' : (stage_csnow_ingest, [{}])
+}
+
+def measure(name, params, inputs, repeat):
+    """Run a stage and measure it; called in a fresh process.
+
+    Keyword arguments:
+    name -- Key of STAGES
+    params -- Keyword arguments of stage
+    inputs -- Dictionary returned by fixtures.generate
+    repeat -- Number of timed runs
+    """
+    stage = STAGES[name][0]
+    result = {'stage' : name, 'params' : params}
+    try:
+        run, amount, unit = stage(inputs, **params)
+        setup = proc_status('VmRSS') or peak_rss()
+        reset_peak_rss()
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            run()
+            times.append(time.perf_counter() - start)
+        tracemalloc.start()
+        run()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    except Exception as e:
+        result['error'] = '%s: %s' % (type(e).__name__, e)
+        return result
+
+    result.update({
+        'latency_min' : min(times),
+        'latency_median' : float(np.median(times)),
+        'throughput' : amount / min(times),
+        'unit' : '%s/s' % unit,
+        'peak_traced_mb' : peak / 1e6,
+        'peak_rss_mb' : peak_rss() / 1e6,
+        'setup_rss_mb' : setup / 1e6
+    })
+    return result
+
+def git_commit():
+    """Get short hash of the checked out commit, with a suffix if the tree is dirty."""
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True).strip()
+        dirty = subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+    return commit + ('-dirty' if dirty else '')
+
+def result_key(result):
+    return '%s %s' % (result['stage'], json.dumps(result['params'], sort_keys=True))
+
+def report(results, baseline=None):
+    """Print results table, with speedup over a baseline run if given.
+
+    Keyword arguments:
+    results -- List of stage results
+    baseline -- Results dictionary of an earlier run (default None)
+    """
+    previous = {result_key(result) : result for result in (baseline or {}).get('stages', [])}
+    for result in results:
+        key = result_key(result)
+        if 'error' in result:
+            print('%-60s skipped (%s)' % (key, result['error']))
+            continue
+        line = '%-60s %9.4f s %12.4g %-8s %9.1f MB traced %9.1f MB rss (%.1f MB before)' % (
+            key, result['latency_min'], result['throughput'], result['unit'],
+            result['peak_traced_mb'], result['peak_rss_mb'], result['setup_rss_mb'])
+        old = previous.get(key)
+        if old is not None and 'error' not in old:
+            line += '  %5.2fx' % (old['latency_min'] / result['latency_min'])
+        print(line)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--stages', nargs='+', default=list(STAGES), choices=list(STAGES), help='Stages to run')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of timed runs per stage')
+    parser.add_argument('--data', default=fixtures.DATA_DIR, help='Directory of generated inputs')
+    parser.add_argument('--rows', type=int, nargs='+', default=fixtures.OBSERVATION_ROWS,
+                        help='Sizes of observation tables')
+    parser.add_argument('--compare', default=None, help='Results file of an earlier run to compare with')
+    parser.add_argument('--output', default=None, help='Results file to write (default results/<commit>.json)')
+    args = parser.parse_args()
+
+    inputs = fixtures.generate(args.data, rows=args.rows)
+    results = []
+    context = multiprocessing.get_context('spawn')
+    for name in args.stages:
+        for params in STAGES[name][1]:
+            if 'rows' in params and params['rows'] not in args.rows:
+                continue
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                results.append(executor.submit(measure, name, params, inputs, args.repeat).result())
+            report(results[-1:])
+
+    commit = git_commit()
+    run = {
+        'commit' : commit,
+        'date' : datetime.now().isoformat(timespec='seconds'),
+        'python' : platform.python_version(),
+        'platform' : platform.platform(),
+        'cpus' : os.cpu_count(),
+        'repeat' : args.repeat,
+        'stages' : results
+    }
+    output = args.output or os.path.join(RESULTS_DIR, '%s.json' % commit)
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(run, f, indent=2)
+    print('results written to %s' % output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print('\ncompared with %s (%s):' % (baseline['commit'], args.compare))
+        report(results, baseline)
@@ -17,6 +17,12 @@ with open('requirements.txt') as f:
     requirements = f.readlines()
 install_requires = [t.strip() for t in requirements]
 
+# GDAL's Python bindings need the GDAL library, so they are optional; the
+# rasterio raster backend is used without them (see validation.raster)
+extras_require = {
+    'gdal': ['gdal'],
+}
+
 with open(os.path.join(here, 'README.md'), encoding='utf-8') as f:
     long_description = f.read()
 
@@ -46,4 +52,10 @@ setup(
     keywords=[],
     packages=find_packages(),
     install_requires=install_requires,
+    extras_require=extras_require,
+    entry_points={
+        'console_scripts': [
+            'validation=validation.cli:main',
+        ],
+    },
 )
\ No newline at end of file
@@ -0,0 +1,124 @@
+"""Shared fixtures: synthetic SNODAS archives and a local HTTP stand-in."""
+
+import io
+import gzip
+import tarfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+import numpy as np
+import pytest
+
+import validation.SNODAS as SNODAS
+
+# Small grid with the layout of SNODAS headers, inside the unmasked extent
+GRID = {
+    'rows' : 20,
+    'cols' : 40,
+    'xmin' : -120.0,
+    'xmax' : -119.0,
+    'ymin' : 45.0,
+    'ymax' : 45.5
+}
+
+def snodas_values(date, code):
+    """Get deterministic big-endian values of a product on GRID, with nodata in the first row."""
+    values = (np.arange(GRID['rows'] * GRID['cols']) + date.day * 100 + code).reshape(GRID['rows'], GRID['cols'])
+    values[0] = -9999
+    return values.astype('>i2')
+
+def snodas_header(code):
+    lines = [
+        'Product code: %d' % code,
+        'Number of columns: %d' % GRID['cols'],
+        'Number of rows: %d' % GRID['rows'],
+        'Data bytes per pixel: 2',
+        'Minimum x-axis coordinate: %f' % GRID['xmin'],
+        'Maximum x-axis coordinate: %f' % GRID['xmax'],
+        'Minimum y-axis coordinate: %f' % GRID['ymin'],
+        'Maximum y-axis coordinate: %f' % GRID['ymax'],
+        'No data value: -9999'
+    ]
+    return ('\n'.join(lines) + '\n').encode('latin-1')
+
+def snodas_tar(date, codes=(1034, 1036)):
+    """Build a SNODAS archive for a date as bytes, with an unrelated member first."""
+    out = io.BytesIO()
+    with tarfile.open(fileobj=out, mode='w') as tar:
+        members = [('README.txt', b'synthetic SNODAS archive\n')]
+        for code in codes:
+            gz_format = SNODAS.snodas_file_format(date, code)
+            members.append((gz_format % (code, 'txt'), gzip.compress(snodas_header(code))))
+            members.append((gz_format % (code, 'dat'), gzip.compress(snodas_values(date, code).tobytes())))
+        for name, data in members:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return out.getvalue()
+
+class StandIn(object):
+    """Local HTTP server serving files from memory.
+
+    Paths can be set to fail a number of times with 503 before being
+    served, and requests per path are counted. A callable body is called
+    with the query parameters of each request and returns the response.
+    """
+
+    def __init__(self):
+        self.files = {}
+        self.failures = {}
+        self.requests = {}
+        self.lock = threading.Lock()
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                path, _, query = self.path.partition('?')
+                with stand_in.lock:
+                    stand_in.requests[path] = stand_in.requests.get(path, 0) + 1
+                    failing = stand_in.failures.get(path, 0)
+                    if failing:
+                        stand_in.failures[path] = failing - 1
+                if failing:
+                    self.send_error(503)
+                    return
+                body = stand_in.files.get(path)
+                if body is None:
+                    self.send_error(404)
+                    return
+                if callable(body):
+                    body = body({key : values[0] for key, values in parse_qs(query).items()})
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def url(self, path):
+        return 'http://127.0.0.1:%d%s' % (self.server.server_address[1], path)
+
+    def serve(self, path, body, failures=0):
+        """Serve body, bytes or a function of the query, at path, failing the first failures requests."""
+        self.files[path] = body
+        self.failures[path] = failures
+        return self.url(path)
+
+@pytest.fixture
+def stand_in():
+    server = StandIn()
+    server.thread.start()
+    yield server
+    server.server.shutdown()
+    server.server.server_close()
+
+@pytest.fixture
+def snodas_server(stand_in, monkeypatch):
+    """Stand-in serving SNODAS archives by date in place of the NSIDC FTP server."""
+    monkeypatch.setattr(SNODAS, 'snodas_url', lambda date: stand_in.url(date.strftime('/SNODAS_unmasked_%Y%m%d.tar')))
+    return stand_in
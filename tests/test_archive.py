@@ -0,0 +1,43 @@
+from datetime import datetime
+
+import numpy as np
+import xarray as xr
+
+import validation.archive as archive
+import validation.utils as ut
+
+from conftest import GRID, snodas_values
+
+DATES = [datetime(2020, 2, day) for day in [1, 2, 3]]
+
+def grid(date):
+    rows, cols = GRID['rows'], GRID['cols']
+    a = (GRID['xmax'] - GRID['xmin']) / cols
+    e = (GRID['ymin'] - GRID['ymax']) / rows
+    return xr.DataArray(snodas_values(date, 1036).astype(np.int16), dims=('y', 'x'), name='snd',
+                        attrs={'transform' : (a, 0.0, GRID['xmin'], 0.0, e, GRID['ymax']),
+                               'crs' : 'EPSG:4326', 'nodatavals' : (-9999,)})
+
+def write_archive(path):
+    for date in DATES:
+        ut.save_netcdf(grid(date), str(path / date.strftime('SD_%Y%m%d.nc')), chunks=(1, 8, 16))
+
+def test_open_index(tmp_path):
+    write_archive(tmp_path)
+    index = archive.update_index(str(tmp_path))
+    assert len(index['files']) == len(DATES)
+    ds = archive.open_index(str(tmp_path))
+    assert list(ds['time'].values) == [np.datetime64(date) for date in DATES]
+    np.testing.assert_array_equal(ds['snd'].values[1], np.where(snodas_values(DATES[1], 1036) == -9999, np.nan,
+                                                                snodas_values(DATES[1], 1036)))
+    raw = archive.open_index(str(tmp_path), decode=False)
+    np.testing.assert_array_equal(raw['snd'][2, 3:11, 5:30].values, snodas_values(DATES[2], 1036)[3:11, 5:30])
+
+def test_open_index_grid_mapping(tmp_path):
+    write_archive(tmp_path)
+    archive.update_index(str(tmp_path))
+    for decode in [True, False]:
+        spatial_ref = archive.open_index(str(tmp_path), decode=decode)['spatial_ref']
+        assert spatial_ref.dims == ()
+        assert spatial_ref.values == 0
+        assert 'crs_wkt' in spatial_ref.attrs and '_FillValue' not in spatial_ref.attrs
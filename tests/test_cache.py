@@ -0,0 +1,93 @@
+import io
+import os
+import tarfile
+from datetime import datetime
+
+import numpy as np
+import pytest
+
+import validation.SNODAS as SNODAS
+from validation.cache import SnodasCache
+
+from conftest import snodas_tar, snodas_values
+
+DATES = [datetime(2020, 2, day) for day in [1, 2, 3, 4]]
+
+def grid(date, code=1036):
+    tar = tarfile.open(fileobj=io.BytesIO(snodas_tar(date)), mode='r|')
+    return SNODAS.tar_to_snodas(tar, SNODAS.snodas_file_format(date, code), code=code)
+
+def entry_path(cache, date, code=1036):
+    return os.path.join(cache.path, cache.key(date, False, code))
+
+def age(cache, date, seconds):
+    """Set last access time of an entry to seconds ago."""
+    when = os.stat(entry_path(cache, date)).st_mtime - seconds
+    os.utime(entry_path(cache, date), (when, when))
+
+@pytest.fixture
+def entry_bytes(tmp_path):
+    cache = SnodasCache(str(tmp_path / 'probe'))
+    cache.put(DATES[0], False, 1036, grid(DATES[0]))
+    return cache.stats()['bytes']
+
+def test_round_trip(tmp_path):
+    cache = SnodasCache(str(tmp_path))
+    assert cache.get(DATES[0], False, 1036) is None
+    da = grid(DATES[0])
+    cache.put(DATES[0], False, 1036, da)
+    cached = cache.get(DATES[0], False, 1036)
+    np.testing.assert_array_equal(cached.values[0], snodas_values(DATES[0], 1036))
+    np.testing.assert_array_equal(cached['x'].values, da['x'].values)
+    assert cached.attrs['transform'] == tuple(da.attrs['transform'])
+    assert cached.attrs['nodatavals'] == (-9999.0,)
+    # Masked and unmasked grids are separate entries
+    assert cache.get(DATES[0], True, 1036) is None
+    assert (cache.hits, cache.misses) == (1, 2)
+
+def test_evicts_least_recently_used(tmp_path, entry_bytes):
+    # Room for two entries, whose sizes vary by a few bytes
+    cache = SnodasCache(str(tmp_path / 'cache'), max_bytes=int(2.5 * entry_bytes))
+    for i, date in enumerate(DATES[:2]):
+        cache.put(date, False, 1036, grid(date))
+        age(cache, date, 100 - i)
+    # Using the first entry makes the second one least recently used
+    assert cache.get(DATES[0], False, 1036) is not None
+    cache.put(DATES[2], False, 1036, grid(DATES[2]))
+    assert os.path.exists(entry_path(cache, DATES[0]))
+    assert not os.path.exists(entry_path(cache, DATES[1]))
+    assert os.path.exists(entry_path(cache, DATES[2]))
+
+    stats = cache.stats()
+    assert stats['entries'] == 2 and stats['evictions'] == 1
+    assert stats['bytes'] <= cache.max_bytes
+    assert (stats['hits'], stats['misses']) == (1, 0)
+
+def test_byte_cap(tmp_path, entry_bytes):
+    cache = SnodasCache(str(tmp_path / 'cache'), max_bytes=int(1.5 * entry_bytes))
+    for date in DATES:
+        cache.put(date, False, 1036, grid(date))
+        assert cache.stats()['bytes'] <= cache.max_bytes
+    assert cache.stats()['entries'] == 1
+    assert cache.evictions == len(DATES) - 1
+    assert cache.get(DATES[-1], False, 1036) is not None
+
+def test_reused_after_restart(snodas_server, tmp_path):
+    path = DATES[0].strftime('/SNODAS_unmasked_%Y%m%d.tar')
+    snodas_server.serve(path, snodas_tar(DATES[0]))
+    SNODAS.snodas_ds(DATES[0], cache=SnodasCache(str(tmp_path)))
+    restarted = SnodasCache(str(tmp_path))
+    assert restarted.stats()['entries'] == 1 and restarted.hits == 0
+    ds = SNODAS.snodas_ds(DATES[0], cache=restarted)
+    np.testing.assert_array_equal(ds.values[0], snodas_values(DATES[0], 1036))
+    assert snodas_server.requests[path] == 1
+    assert restarted.hits == 1
+
+def test_partial_entry_is_a_miss(tmp_path):
+    cache = SnodasCache(str(tmp_path))
+    with open(entry_path(cache, DATES[0]), 'wb') as f:
+        f.write(b'PK\x03\x04 truncated')
+    assert cache.get(DATES[0], False, 1036) is None
+    assert cache.misses == 1
+    cache.clear()
+    assert cache.stats()['entries'] == 0
@@ -0,0 +1,76 @@
+from datetime import datetime
+
+import numpy as np
+import pytest
+import xarray as xr
+
+import validation.climatology as climatology
+
+from conftest import GRID, snodas_tar, snodas_values
+
+@pytest.fixture
+def stack():
+    """Small stack of grids with missing pixels, one pixel missing in every grid."""
+    rng = np.random.default_rng(0)
+    values = rng.integers(0, 3000, size=(7, 5, 6)).astype(np.float32)
+    values[rng.random(values.shape) < 0.3] = np.nan
+    values[:, 0, 0] = np.nan
+    values[1:, 4, 5] = np.nan
+    return values
+
+def test_running_moments(stack):
+    moments = climatology.RunningMoments(stack.shape[1:])
+    for values in stack * 0.001:
+        moments.update(values)
+    with np.errstate(invalid='ignore', divide='ignore'), pytest.warns(RuntimeWarning):
+        mean = np.nanmean(stack * 0.001, axis=0)
+        std = np.nanstd(stack * 0.001, axis=0, ddof=1)
+    np.testing.assert_array_equal(moments.count, (~np.isnan(stack)).sum(axis=0))
+    np.testing.assert_allclose(np.where(moments.count > 0, moments.mean, np.nan), mean, rtol=1e-5)
+    np.testing.assert_allclose(moments.std(), std, rtol=1e-4)
+
+@pytest.mark.parametrize('block_rows', [2, 256])
+def test_day_stack_quantiles(stack, block_rows):
+    days = climatology.DayStack(stack.shape[1:], len(stack))
+    for i, values in enumerate(stack):
+        # Stored integers with SNODAS nodata, and NaN floats
+        if i % 2:
+            days.update(np.where(np.isnan(values), -9999, values).astype(np.int16), nodata=-9999)
+        else:
+            days.update(values)
+    quantiles = (0.0, 0.25, 0.5, 0.9, 1.0)
+    result = days.quantiles(quantiles, scale=0.001, block_rows=block_rows)
+    with pytest.warns(RuntimeWarning):
+        expected = np.nanquantile(stack, quantiles, axis=0) * 0.001
+    np.testing.assert_allclose(result, expected, rtol=1e-6)
+    assert np.isnan(result[:, 0, 0]).all()
+
+def test_day_stack_partial(stack):
+    days = climatology.DayStack(stack.shape[1:], 10)
+    for values in stack[:3]:
+        days.update(values)
+    with pytest.warns(RuntimeWarning):
+        expected = np.nanquantile(stack[:3], [0.5], axis=0)
+    np.testing.assert_allclose(days.quantiles([0.5]), expected)
+
+def test_build_climatology(snodas_server, tmp_path):
+    years = [2018, 2019, 2020]
+    for year in years:
+        date = datetime(year, 2, 1)
+        snodas_server.serve(date.strftime('/SNODAS_unmasked_%Y%m%d.tar'), snodas_tar(date, codes=(1036,)))
+    a = (GRID['xmax'] - GRID['xmin']) / GRID['cols']
+    e = (GRID['ymin'] - GRID['ymax']) / GRID['rows']
+    transform = (a, 0.0, GRID['xmin'], 0.0, e, GRID['ymax'])
+    store = str(tmp_path / 'climatology.zarr')
+    written = climatology.build_climatology(store, years[0], years[-1], doys=[32], transform=transform,
+                                            shape=(GRID['rows'], GRID['cols']), decoders=1, backoff=0)
+    assert written == 1
+    values = np.stack([snodas_values(datetime(year, 2, 1), 1036) for year in years]).astype(np.float32)
+    values[values == -9999] = np.nan
+    with xr.open_zarr(store) as ds:
+        assert list(ds['doy'].values) == [32]
+        np.testing.assert_allclose(ds['mean'].values[0, 1:], values[:, 1:].mean(axis=0) * 0.001, rtol=1e-5)
+        np.testing.assert_allclose(ds['q50'].values[0, 1:], np.median(values[:, 1:], axis=0) * 0.001, rtol=1e-6)
+        assert np.isnan(ds['mean'].values[0, 0]).all()
+    # Days of year in the store are skipped
+    assert climatology.build_climatology(store, years[0], years[-1], doys=[32], decoders=1) == 0
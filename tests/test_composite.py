@@ -0,0 +1,66 @@
+import os
+import warnings
+
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+import validation.composite as composite
+
+DATES = pd.date_range('2020-01-03', '2020-02-06', freq='D')
+
+def daily(date, shape=(6, 8), seed=None):
+    """Daily grid with SNODAS nodata in some pixels and one pixel never valid."""
+    rng = np.random.default_rng(date.dayofyear if seed is None else seed)
+    values = rng.integers(0, 500, size=shape).astype(np.int16)
+    values[rng.random(shape) < 0.2] = -9999
+    values[0, 0] = -9999
+    return xr.DataArray(values[np.newaxis], dims=('band', 'y', 'x'),
+                        coords={'band' : [1], 'y' : np.arange(shape[0]) + 0.5, 'x' : np.arange(shape[1]) + 0.5},
+                        attrs={'nodatavals' : (-9999.0,)})
+
+def expected(dates, freq):
+    """Composite statistics computed by xarray from all days at once."""
+    da = xr.concat([daily(date).isel(band=0, drop=True).expand_dims(time=[date]) for date in dates], dim='time')
+    da = da.where(da != -9999).astype(np.float32)
+    resampled = da.resample(time=freq)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return {
+            'mean' : resampled.mean(),
+            'median' : resampled.median(),
+            'p25' : resampled.quantile(0.25).drop_vars('quantile'),
+            'p75' : resampled.quantile(0.75).drop_vars('quantile'),
+            'count' : resampled.count()
+        }
+
+@pytest.mark.parametrize('spill', [False, True])
+def test_composite_matches_resample(tmp_path, spill):
+    freq = '10D'
+    # Missing days leave gaps inside bins
+    dates = DATES.delete([4, 5, 17])
+    result = xr.concat(list(composite.composite(((date, daily(date)) for date in dates), freq=freq,
+                                                spill_dir=str(tmp_path) if spill else None)), dim='time')
+    reference = expected(dates, freq)
+    np.testing.assert_array_equal(result['time'].values, reference['mean']['time'].values)
+    for name, values in reference.items():
+        np.testing.assert_allclose(result[name].values, values.values, rtol=1e-5, err_msg=name)
+    assert os.listdir(str(tmp_path)) == []
+
+def test_composite_grid_change_closes_spill(tmp_path):
+    spill_dir = str(tmp_path)
+    grids = [(date, daily(date, shape=(6, 8) if date < DATES[10] else (4, 5))) for date in DATES[:20]]
+    bins = composite.composite(iter(grids), freq='5D', spill_dir=spill_dir)
+    shapes = []
+    for ds in bins:
+        shapes.append(ds['mean'].shape[1:])
+        # Only the file of the current bin is kept
+        assert len(os.listdir(spill_dir)) == 1
+    assert shapes == [(6, 8)] * 2 + [(4, 5)] * 2
+    assert os.listdir(spill_dir) == []
+
+def test_composite_out_of_order():
+    grids = [(DATES[12], daily(DATES[12])), (DATES[0], daily(DATES[0]))]
+    with pytest.raises(ValueError):
+        list(composite.composite(grids, freq='10D'))
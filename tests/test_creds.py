@@ -0,0 +1,27 @@
+import json
+
+import pytest
+
+import validation.creds as creds
+
+@pytest.fixture
+def home(tmp_path, monkeypatch):
+    monkeypatch.setenv('HOME', str(tmp_path))
+    return tmp_path
+
+def test_set_credential_merges(home):
+    creds.set_credential(google_key='key')
+    creds.set_credential(dem_dir='~/dem', raster_backend='numpy')
+    assert json.loads((home / '.csoconfig.json').read_text()) == \
+        {'google_key' : 'key', 'dem_dir' : '~/dem', 'raster_backend' : 'numpy'}
+    assert creds.get_credential('dem_dir') == '~/dem'
+    creds.set_credential(google_key='other')
+    assert creds.get_credential('google_key') == 'other'
+    assert creds.get_credential('raster_backend') == 'numpy'
+
+def test_set_credential_unknown(home):
+    with pytest.raises(ValueError):
+        creds.set_credential(dem_directory='dem')
+    with pytest.raises(ValueError):
+        creds.set_credential(raster_backend='grass')
+    assert not (home / '.csoconfig.json').exists()
@@ -0,0 +1,86 @@
+import os
+from datetime import datetime
+
+import netCDF4
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+from pyproj import Transformer
+
+import validation.CSNOW as CSNOW
+
+DATES = pd.date_range('2020-02-01', periods=3)
+# Cells written in each fixture file, around 106W 40N; the rest of the grid is never stored
+ROWS = slice(1800, 1840)
+COLS = slice(7500, 7540)
+
+def snd_values(date):
+    rows, cols = np.mgrid[ROWS, COLS]
+    values = (rows - ROWS.start) * 100.0 + (cols - COLS.start) + date.day * 0.25
+    values[::7, ::5] = np.nan
+    return values.astype(np.float32)
+
+@pytest.fixture(scope='module')
+def coords():
+    return CSNOW.ease2grid_coords()
+
+@pytest.fixture
+def dpath(tmp_path, coords):
+    """Daily C-SNOW files on the full EASE2 grid, only storing the chunks around the cells written."""
+    easting, northing = coords
+    for date in DATES:
+        with netCDF4.Dataset(str(tmp_path / date.strftime('SD_%Y%m%d.nc')), 'w') as nc:
+            nc.createDimension('ease2_y', len(northing))
+            nc.createDimension('ease2_x', len(easting))
+            snd = nc.createVariable('snd', 'f4', ('ease2_y', 'ease2_x'), chunksizes=(20, 20), fill_value=np.nan)
+            snd[ROWS, COLS] = snd_values(date)
+    return str(tmp_path)
+
+def cell_bounds(coords, rows, cols):
+    """EASE2 bounds inside the cells of rows and columns, so windows touch exactly those cells."""
+    easting, northing = coords
+    inset = 100.0
+    return (easting[cols.start] - 500 + inset, northing[rows.stop - 1] - 500 + inset,
+            easting[cols.stop - 1] + 500 - inset, northing[rows.start] + 500 - inset)
+
+def test_ease2_window(coords):
+    window = CSNOW.ease2_window(cell_bounds(coords, slice(1805, 1815), slice(7510, 7530)), *coords)
+    assert window == {'northing' : slice(1805, 1815), 'easting' : slice(7510, 7530)}
+    with pytest.raises(ValueError):
+        CSNOW.ease2_window((1e9, 1e9, 1e9 + 1, 1e9 + 1), *coords)
+
+def test_ingest_window_matches_full_read(dpath, coords, tmp_path):
+    rows, cols = slice(1805, 1815), slice(7510, 7530)
+    bounds = cell_bounds(coords, rows, cols)
+    store = str(tmp_path / 'csnow.zarr')
+    assert CSNOW.ingest(DATES[:2], dpath, bounds, store) == 2
+    # Dates already in the store are skipped
+    assert CSNOW.ingest(DATES, dpath, bounds, store) == 1
+
+    ds = xr.open_zarr(store)
+    assert list(ds.indexes['time']) == list(DATES)
+    assert ds['snd'].dims == ('time', 'northing', 'easting')
+    for date in DATES:
+        full = CSNOW.open_process(os.path.join(dpath, date.strftime('SD_%Y%m%d.nc')), *coords)
+        expected = full['snd'].isel(northing=rows, easting=cols)
+        np.testing.assert_array_equal(ds['snd'].sel(time=date).values, expected.values)
+        np.testing.assert_array_equal(ds['northing'].values, expected['northing'].values)
+        np.testing.assert_array_equal(ds['easting'].values, expected['easting'].values)
+        np.testing.assert_array_equal(expected.values, snd_values(date)[5:15, 10:30])
+
+def test_sample_store(dpath, coords, tmp_path):
+    rows, cols = slice(1805, 1815), slice(7510, 7530)
+    store = str(tmp_path / 'csnow.zarr')
+    CSNOW.ingest(DATES, dpath, cell_bounds(coords, rows, cols), store)
+    easting, northing = coords
+    # Cell centers inside the store, one of them missing, and a point outside it
+    cells = [(1806, 7511), (1814, 7529), (1807, 7515), (1830, 7511)]
+    transformer = Transformer.from_crs(CSNOW.EASE2G_epsg_str, 'epsg:4326', always_xy=True)
+    lons, lats = transformer.transform([easting[col] for _, col in cells], [northing[row] for row, _ in cells])
+    values = CSNOW.sample_store(store, DATES[1], lons, lats)
+    grid = snd_values(DATES[1])
+    expected = [grid[row - ROWS.start, col - COLS.start] for row, col in cells[:3]] + [np.nan]
+    np.testing.assert_allclose(values, expected)
+    assert np.isnan(values[2])
+    assert np.isnan(CSNOW.sample_store(store, datetime(2020, 3, 1), lons, lats)).all()
@@ -0,0 +1,79 @@
+import io
+import tarfile
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+import validation.SNODAS as SNODAS
+import validation.cube as cube
+
+from conftest import snodas_tar, snodas_values
+
+DATES = [datetime(2020, 2, day) for day in [1, 2, 3, 4]]
+
+# A cell center of the synthetic grid: row 5, column 10
+LON, LAT = -120.0 + 10.5 / 40, 45.5 - 5.5 / 40
+
+def grid(date, code=1036):
+    tar = tarfile.open(fileobj=io.BytesIO(snodas_tar(date)), mode='r|')
+    return SNODAS.tar_to_snodas(tar, SNODAS.snodas_file_format(date, code), code=code)
+
+def expected(dates, row=5, col=10):
+    return [snodas_values(date, 1036)[row, col] * 0.001 for date in dates]
+
+def test_cube_append(tmp_path):
+    store = str(tmp_path / 'cube.zarr')
+    # Dates out of order
+    for date in [DATES[2], DATES[0], DATES[1]]:
+        assert cube.cube_append(store, grid(date), date, chunks=(2, 8, 16))
+    assert cube.cube_dates(store) == set(pd.DatetimeIndex(DATES[:3]))
+    with xr.open_zarr(store) as ds:
+        assert ds['snodas_1036'].encoding['chunks'] == (2, 8, 16)
+        np.testing.assert_array_equal(ds['snodas_1036'].sel(time=DATES[0]).values[1:],
+                                      snodas_values(DATES[0], 1036)[1:])
+        # Nodata is decoded as NaN
+        assert np.isnan(ds['snodas_1036'].sel(time=DATES[0]).values[0]).all()
+
+def test_cube_append_idempotent(tmp_path):
+    store = str(tmp_path / 'cube.zarr')
+    cube.cube_append(store, grid(DATES[0]), DATES[0])
+    # Writing a date again does nothing, unless overwriting it in place
+    assert not cube.cube_append(store, grid(DATES[1]), DATES[0])
+    with xr.open_zarr(store) as ds:
+        assert ds.sizes['time'] == 1
+        assert ds['snodas_1036'].values[0, 5, 10] == snodas_values(DATES[0], 1036)[5, 10]
+    assert cube.cube_append(store, grid(DATES[1]), DATES[0], overwrite=True)
+    with xr.open_zarr(store) as ds:
+        assert ds.sizes['time'] == 1
+        assert ds['snodas_1036'].values[0, 5, 10] == snodas_values(DATES[1], 1036)[5, 10]
+
+def test_cube_append_other_grid(tmp_path):
+    store = str(tmp_path / 'cube.zarr')
+    cube.cube_append(store, grid(DATES[0]), DATES[0])
+    with pytest.raises(ValueError):
+        cube.cube_append(store, grid(DATES[1]).isel(x=slice(0, 20)), DATES[1])
+
+def test_point_series(tmp_path):
+    store = str(tmp_path / 'cube.zarr')
+    for date in [DATES[3], DATES[1], DATES[0], DATES[2]]:
+        cube.cube_append(store, grid(date), date, chunks=(2, 8, 16))
+    series = cube.point_series(store, LON, LAT)
+    assert list(series.index) == list(pd.DatetimeIndex(DATES))
+    np.testing.assert_allclose(series.values, expected(DATES), rtol=1e-6)
+    assert series.name == 'snodas_1036'
+    part = cube.point_series(store, LON, LAT, start='2020-02-02', end='2020-02-03')
+    np.testing.assert_allclose(part.values, expected(DATES[1:3]), rtol=1e-6)
+    with pytest.raises(ValueError):
+        cube.point_series(store, -100.0, LAT)
+
+def test_build_cube_resumes(snodas_server, tmp_path):
+    for date in DATES:
+        snodas_server.serve(date.strftime('/SNODAS_unmasked_%Y%m%d.tar'), snodas_tar(date))
+    store = str(tmp_path / 'cube.zarr')
+    assert cube.build_cube(store, DATES[0], DATES[1], decoders=1) == 2
+    assert cube.build_cube(store, DATES[0], DATES[3], decoders=1) == 2
+    assert sum(snodas_server.requests.values()) == 4
+    np.testing.assert_allclose(cube.point_series(store, LON, LAT).values, expected(DATES), rtol=1e-6)
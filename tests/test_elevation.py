@@ -0,0 +1,67 @@
+import numpy as np
+import pytest
+
+import validation.Elevation as Elevation
+import validation.raster as raster
+
+# Cells per side of the synthetic SRTM tiles, 0.1 degrees apart
+SIZE = 11
+
+def surface(lons, lats):
+    """Elevation of the synthetic DEM, linear so bilinear sampling is exact."""
+    return 1000.0 + 400.0 * (np.asarray(lons) + 121) + 250.0 * (np.asarray(lats) - 45)
+
+def write_hgt(directory, lon, lat, nodata=()):
+    """Write SRTM tile of the surface with its south west corner at lon, lat."""
+    lons, lats = np.meshgrid(lon + np.arange(SIZE) / (SIZE - 1), lat + 1 - np.arange(SIZE) / (SIZE - 1))
+    values = np.round(surface(lons, lats)).astype('>i2')
+    for row, col in nodata:
+        values[row, col] = -32768
+    name = '%s%02d%s%03d.hgt' % ('N' if lat >= 0 else 'S', abs(lat), 'E' if lon >= 0 else 'W', abs(lon))
+    values.tofile(str(directory / name))
+
+@pytest.fixture
+def dem_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(raster, '_backend', raster.NumpyBackend())
+    # Tiles sharing the column at 120W, one with a nodata cell
+    write_hgt(tmp_path, -121, 45)
+    write_hgt(tmp_path, -120, 45, nodata=[(5, 8)])
+    return str(tmp_path)
+
+def test_tile_index_shared_edge(dem_dir):
+    west, east = sorted(Elevation.tile_index(dem_dir), key=lambda tile: tile['xmin'])
+    assert (west['own_cols'], west['own_rows']) == (SIZE - 1, SIZE)
+    assert (east['own_cols'], east['own_rows']) == (SIZE, SIZE)
+    np.testing.assert_allclose([west['xmin'], east['xmax']], [-121.05, -118.95])
+
+def test_sample_elevation_across_tiles(dem_dir):
+    # Points on both sides of the shared edge, in the half cell margins of each tile, and on cell centers
+    lons = np.array([-120.97, -120.04, -120.01, -120.0, -119.99, -119.96, -119.5, -119.0])
+    lats = np.array([45.03, 45.51, 45.97, 45.5, 45.02, 45.44, 45.0, 46.0])
+    np.testing.assert_allclose(Elevation.sample_elevation(lons, lats, dem_dir=dem_dir), surface(lons, lats), atol=0.5)
+
+def test_sample_elevation_nodata_and_outside(dem_dir):
+    # Next to the nodata cell at 119.2W 45.5N, and outside the tiles
+    lons = np.array([-119.17, -119.25, -122.0, -119.5])
+    lats = np.array([45.52, 45.45, 45.5, 47.0])
+    elevations = Elevation.sample_elevation(lons, lats, dem_dir=dem_dir)
+    assert np.isnan(elevations).all()
+
+def test_average_elevation_counts_shared_edge_once(dem_dir):
+    box = {'xmin' : -120.45, 'ymin' : 45.0, 'xmax' : -119.65, 'ymax' : 45.95}
+    lons, lats = np.meshgrid(np.arange(-120.4, -119.65, 0.1), np.arange(45.0, 45.95, 0.1))
+    expected = surface(lons, lats).mean()
+    assert Elevation.average_elevation(box, dem_dir=dem_dir) == pytest.approx(expected, abs=0.5)
+    with pytest.raises(ValueError):
+        Elevation.average_elevation({'xmin' : -110.0, 'ymin' : 40.0, 'xmax' : -109.0, 'ymax' : 41.0}, dem_dir=dem_dir)
+
+def test_el_data_reads_local_tiles(dem_dir, monkeypatch):
+    # Points are (latitude, longitude) as for the Google Elevation API, now sampled from local tiles
+    monkeypatch.setattr('socket.socket.connect', lambda *args: pytest.fail('el_data made a network request'))
+    points = [(45.25, -120.75), (45.5, -120.02), (45.75, -119.25)]
+    df = Elevation.el_data(points, dem_dir=dem_dir)
+    assert list(df.columns) == ['lat', 'long', 'elevation']
+    np.testing.assert_allclose(df['elevation'], surface(df['long'], df['lat']), atol=0.5)
+    monkeypatch.setenv('CSO_DEM_DIR', dem_dir)
+    merged = Elevation.merge_el_data(df.rename(columns={'lat' : 'latitude', 'long' : 'longitude'}))
+    np.testing.assert_allclose(merged['elevation'], df['elevation'])
@@ -0,0 +1,90 @@
+import json
+import os
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import validation.jobs as jobs
+
+from conftest import snodas_tar, snodas_values
+
+DATES = [datetime(2020, 2, day) for day in [1, 2, 3]]
+
+def tar_path(date):
+    return date.strftime('/SNODAS_unmasked_%Y%m%d.tar')
+
+def write_job(tmp_path, **fields):
+    """Write observations on the synthetic grid, two per date and one outside the region, and a job spec."""
+    rows = []
+    for date in DATES:
+        for row, col in [(3, 4), (10, 30)]:
+            rows.append({'longitude' : -120.0 + (col + 0.5) / 40, 'latitude' : 45.5 - (row + 0.5) / 40,
+                         'timestamp' : date.strftime('%Y-%m-%dT18:00:00Z'), 'depth' : 50.0})
+        rows.append({'longitude' : -110.0, 'latitude' : 45.2, 'timestamp' : date.strftime('%Y-%m-%dT18:00:00Z'),
+                     'depth' : 50.0})
+    pd.DataFrame(rows).to_csv(str(tmp_path / 'obs.csv'), index=False)
+    spec = dict({
+        'name' : 'test',
+        'region' : {'xmin' : -120.0, 'ymin' : 45.0, 'xmax' : -119.0, 'ymax' : 45.5},
+        'start' : '2020-02-01',
+        'end' : '2020-02-03',
+        'observations' : 'obs.csv',
+        'output' : 'run',
+        'workers' : 2
+    }, **fields)
+    with open(str(tmp_path / 'job.json'), 'w') as f:
+        json.dump(spec, f)
+    return jobs.load_job(str(tmp_path / 'job.json'))
+
+def test_run_job_resumes_failed_tasks(snodas_server, tmp_path):
+    job = write_job(tmp_path)
+    # The last date is not available yet, so its task fails
+    for date in DATES[:2]:
+        snodas_server.serve(tar_path(date), snodas_tar(date))
+    failed = jobs.run_job(job)
+    assert list(failed) == ['2020-02-03']
+    assert sorted(jobs.read_manifest(job)) == ['2020-02-01', '2020-02-02']
+    assert jobs.job_status(job) == {'total' : 3, 'done' : 2, 'remaining' : 1}
+    assert not os.path.exists(jobs.task_path(job, DATES[2]))
+
+    # Rerunning only runs the failed task
+    snodas_server.serve(tar_path(DATES[2]), snodas_tar(DATES[2]))
+    assert jobs.run_job(job) == {}
+    assert [snodas_server.requests[tar_path(date)] for date in DATES] == [1, 1, 2]
+    assert jobs.job_status(job) == {'total' : 3, 'done' : 3, 'remaining' : 0}
+    for date in DATES:
+        record = jobs.read_manifest(job)[date.strftime('%Y-%m-%d')]
+        assert record['rows'] == 2
+        df = pd.read_parquet(os.path.join(job['output'], record['path']))
+        expected = snodas_values(date, 1036)[[3, 10], [4, 30]] * 0.001
+        np.testing.assert_allclose(df['snodas_1036'], expected, rtol=1e-6)
+
+    # Nothing is left to run, unless restarting
+    assert jobs.run_job(job) == {}
+    assert [snodas_server.requests[tar_path(date)] for date in DATES] == [1, 1, 2]
+    assert jobs.run_job(job, restart=True) == {}
+    assert [snodas_server.requests[tar_path(date)] for date in DATES] == [2, 2, 3]
+
+def test_run_job_skips_manifest_tasks(snodas_server, tmp_path):
+    job = write_job(tmp_path)
+    os.makedirs(job['output'])
+    # Tasks finished by a killed run, which left a partial last line
+    with open(jobs.manifest_path(job), 'w') as f:
+        f.write(json.dumps({'date' : '2020-02-01', 'rows' : 2, 'path' : 'matchups/20200201.parquet'}) + '\n')
+        f.write('{"date" : "2020-02-02", "ro')
+    assert jobs.job_status(job) == {'total' : 3, 'done' : 1, 'remaining' : 2}
+    for date in DATES[1:]:
+        snodas_server.serve(tar_path(date), snodas_tar(date))
+    assert jobs.run_job(job) == {}
+    assert tar_path(DATES[0]) not in snodas_server.requests
+    assert jobs.job_status(job)['done'] == 3
+
+def test_load_job_checks_spec(tmp_path):
+    with pytest.raises(ValueError):
+        write_job(tmp_path, products=['snodas_1036', 'modis'])
+    with pytest.raises(ValueError):
+        write_job(tmp_path, products=['csnow'])
+    job = write_job(tmp_path, cache='cache')
+    assert job['cache'] == str(tmp_path / 'cache') and job['dem_dir'] is None
@@ -0,0 +1,130 @@
+import os
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import validation.matchups as matchups
+
+from conftest import GRID, snodas_tar, snodas_values
+
+DATES = [datetime(2020, 2, day) for day in [1, 2, 3]]
+REGIONS = {'east' : {'xmin' : -119.5, 'ymin' : 45.0, 'xmax' : -119.0, 'ymax' : 45.5}}
+
+def observations(dates, per_date=3):
+    """Observations at cell centers of the synthetic grid, a few per date on both sides of REGIONS."""
+    rows = []
+    for date in dates:
+        for i in range(per_date):
+            row, col = 2 + i, 5 + 12 * i
+            rows.append({
+                'id' : '%s-%d' % (date.strftime('%Y%m%d'), i),
+                'longitude' : -120.0 + (col + 0.5) / 40,
+                'latitude' : 45.5 - (row + 0.5) / 40,
+                'depth' : 10.0 * i,
+                'date' : date,
+                'expected' : snodas_values(date, 1036)[row, col] * 0.001
+            })
+    return pd.DataFrame(rows)
+
+@pytest.fixture
+def snodas(snodas_server):
+    for date in DATES:
+        snodas_server.serve(date.strftime('/SNODAS_unmasked_%Y%m%d.tar'), snodas_tar(date))
+    return snodas_server
+
+def downloads(server, date):
+    return server.requests.get(date.strftime('/SNODAS_unmasked_%Y%m%d.tar'), 0)
+
+def store_files(store):
+    return sorted(os.path.relpath(os.path.join(directory, name), store)
+                  for directory, _, names in os.walk(store) for name in names)
+
+def test_update_store_skips_matched(snodas, tmp_path):
+    store = str(tmp_path / 'matchups')
+    assert matchups.update_store(store, observations(DATES[:1]), regions=REGIONS) == 3
+    # Rerunning with new observations only samples the dates they fall on
+    assert matchups.update_store(store, observations(DATES[:2]), regions=REGIONS) == 3
+    assert [downloads(snodas, date) for date in DATES] == [1, 1, 0]
+    assert matchups.update_store(store, observations(DATES[:2]), regions=REGIONS) == 0
+    assert [downloads(snodas, date) for date in DATES] == [1, 1, 0]
+
+    df = matchups.read_matchups(store).sort_values('id')
+    assert list(df['id']) == sorted(observations(DATES[:2])['id'])
+    np.testing.assert_allclose(df['snodas_1036'], df['expected'], rtol=1e-6)
+    assert set(df['region']) == {'east', matchups.OTHER_REGION}
+    assert set(df['water_year'].astype(int)) == {2020}
+    assert (df['products'] == 'snodas_1036').all()
+
+def test_update_store_resumes_after_failure(snodas, tmp_path):
+    store = str(tmp_path / 'matchups')
+    # The last date is not available yet
+    del snodas.files[DATES[2].strftime('/SNODAS_unmasked_%Y%m%d.tar')]
+    with pytest.raises(Exception):
+        matchups.update_store(store, observations(DATES), regions=REGIONS)
+    assert sorted(matchups.matched_ids(store)) == sorted(observations(DATES[:2])['id'])
+
+    snodas.serve(DATES[2].strftime('/SNODAS_unmasked_%Y%m%d.tar'), snodas_tar(DATES[2]))
+    assert matchups.update_store(store, observations(DATES), regions=REGIONS) == 3
+    assert [downloads(snodas, date) for date in DATES[:2]] == [1, 1]
+    assert sorted(matchups.matched_ids(store)) == sorted(observations(DATES)['id'])
+
+def updated_store(tmp_path):
+    store = str(tmp_path / 'matchups')
+    for date in DATES:
+        matchups.update_store(store, observations([date]), regions=REGIONS)
+    return store
+
+def test_compact(snodas, tmp_path):
+    store = updated_store(tmp_path)
+    before = matchups.read_matchups(store).sort_values('id', ignore_index=True)
+    assert len(store_files(store)) == 2 * len(DATES)
+    matchups.compact(store)
+    files = store_files(store)
+    assert len(files) == 2 and all(os.path.basename(path).startswith('compact-') for path in files)
+    after = matchups.read_matchups(store).sort_values('id', ignore_index=True)
+    pd.testing.assert_frame_equal(after[before.columns], before)
+    # Compacted partitions are left alone
+    matchups.compact(store)
+    assert store_files(store) == files
+
+def test_compact_interrupted_after_rename(snodas, tmp_path, monkeypatch):
+    store = updated_store(tmp_path)
+    ids = sorted(observations(DATES)['id'])
+
+    def crash(path):
+        raise KeyboardInterrupt()
+    with monkeypatch.context() as patch:
+        patch.setattr(os, 'remove', crash)
+        with pytest.raises(KeyboardInterrupt):
+            matchups.compact(store)
+    # Both the compacted file and the files it replaces are in the partition, but rows are read once
+    assert matchups.COMPACT_MANIFEST in [os.path.basename(path) for path in store_files(store)]
+    assert sorted(matchups.matched_ids(store)) == ids
+    assert sorted(matchups.read_matchups(store)['id']) == ids
+
+    matchups.compact(store)
+    files = store_files(store)
+    assert len(files) == 2 and all(os.path.basename(path).startswith('compact-') for path in files)
+    assert sorted(matchups.read_matchups(store)['id']) == ids
+
+def test_compact_interrupted_before_rename(snodas, tmp_path, monkeypatch):
+    store = updated_store(tmp_path)
+    ids = sorted(observations(DATES)['id'])
+    replace = os.replace
+
+    def crash(src, dst):
+        if dst.endswith('.parquet'):
+            raise KeyboardInterrupt()
+        replace(src, dst)
+    with monkeypatch.context() as patch:
+        patch.setattr(os, 'replace', crash)
+        with pytest.raises(KeyboardInterrupt):
+            matchups.compact(store)
+    assert sorted(matchups.read_matchups(store)['id']) == ids
+
+    matchups.compact(store)
+    files = store_files(store)
+    assert len(files) == 2 and all(os.path.basename(path).startswith('compact-') for path in files)
+    assert sorted(matchups.read_matchups(store)['id']) == ids
@@ -0,0 +1,120 @@
+import json
+from datetime import datetime
+
+import pandas as pd
+import pytest
+
+import validation.observations as observations
+
+START = datetime(2020, 2, 1)
+HOUR = 3600 * 1000
+
+class Timeline(object):
+    """Stand-in for the MountainHub timeline, paging records newest first."""
+
+    def __init__(self):
+        self.records = []
+        self.params = []
+
+    def add(self, time, depth=50.0, lon=-120.5, lat=45.2):
+        """Add an observation reported at time, a datetime or milliseconds since the epoch."""
+        reported = time if isinstance(time, int) else observations.epoch_ms(time)
+        self.records.append({
+            'observation' : {
+                '_id' : 'obs%04d' % len(self.records),
+                'reported_at' : reported,
+                'location' : [lon, lat],
+                'type' : 'snow_conditions',
+                'details' : [{'snowpack_depth' : depth}]
+            },
+            'actor' : {'full_name' : 'Observer'}
+        })
+
+    def __call__(self, params):
+        self.params.append(params)
+        since, before, limit = int(params['since']), int(params['before']), int(params['limit'])
+        page = [record for record in self.records if since <= record['observation']['reported_at'] < before]
+        page.sort(key=lambda record: -record['observation']['reported_at'])
+        return json.dumps({'results' : page[:limit]}).encode('utf-8')
+
+@pytest.fixture
+def timeline(stand_in):
+    timeline = Timeline()
+    timeline.url = stand_in.serve('/timeline', timeline)
+    return timeline
+
+def window(timeline, since, before, page_size):
+    return observations.fetch_window(observations.epoch_ms(since), observations.epoch_ms(before),
+                                     url=timeline.url, page_size=page_size)
+
+@pytest.mark.parametrize('count, pages', [(25, 3), (20, 3), (5, 1), (0, 1)])
+def test_fetch_window_pages(timeline, count, pages):
+    for i in range(count):
+        timeline.add(observations.epoch_ms(START) + i * HOUR)
+    df = window(timeline, START, datetime(2020, 2, 3), page_size=10)
+    assert len(timeline.params) == pages
+    assert sorted(df['id']) == ['obs%04d' % i for i in range(count)]
+    # Each page ends before the oldest observation of the previous one
+    befores = [int(params['before']) for params in timeline.params]
+    assert befores == sorted(befores, reverse=True)
+
+def test_fetch_window_overlapping_pages(timeline):
+    # Pages of 4 end in the middle of observations sharing a time, so those are fetched twice
+    for time in [0, 1, 2, 2, 2, 3, 3, 4, 5, 5]:
+        timeline.add(observations.epoch_ms(START) + time * HOUR)
+    df = window(timeline, START, datetime(2020, 2, 2), page_size=4)
+    assert len(timeline.params) > 3
+    assert len(df) == 10
+    assert df['id'].is_unique
+
+def test_fetch_window_page_at_one_time(timeline):
+    for _ in range(5):
+        timeline.add(START)
+    with pytest.raises(ValueError):
+        window(timeline, START, datetime(2020, 2, 2), page_size=4)
+
+def test_fetch_observations_windows(timeline):
+    for day in range(20):
+        timeline.add(datetime(2020, 2, 1 + day, 12))
+    df = observations.fetch_observations(START, datetime(2020, 2, 21), window='7D', workers=3,
+                                         url=timeline.url, page_size=4)
+    assert len(df) == 20
+    assert df['id'].is_unique
+    since = sorted({int(params['since']) for params in timeline.params})
+    assert since == [observations.epoch_ms(edge) for edge in ['2020-02-01', '2020-02-08', '2020-02-15']]
+
+def test_ingest_resumes_from_store(timeline, tmp_path):
+    store = str(tmp_path / 'store')
+    for day in range(1, 6):
+        timeline.add(datetime(2020, 2, day, 12))
+    added = observations.ingest(store, since=START, until=datetime(2020, 2, 6), url=timeline.url, page_size=3)
+    assert added == 5
+    assert observations.read_state(store)['since'] == '2020-02-06T00:00:00'
+
+    # A late upload before the watermark, and new observations after it
+    timeline.add(datetime(2020, 2, 5, 18))
+    timeline.add(datetime(2020, 2, 6, 12))
+    timeline.add(datetime(2020, 2, 7, 12))
+    timeline.params = []
+    added = observations.ingest(store, until=datetime(2020, 2, 8), url=timeline.url, page_size=3)
+    assert added == 3
+    # Only the overlap before the watermark is fetched again
+    assert min(int(params['since']) for params in timeline.params) == observations.epoch_ms(datetime(2020, 2, 5))
+
+    df = observations.read_observations(store)
+    assert sorted(df['id']) == ['obs%04d' % i for i in range(8)]
+    assert set(df['water_year'].astype(int)) == {2020}
+    assert observations.ingest(store, until=datetime(2020, 2, 8), url=timeline.url, page_size=3) == 0
+
+def test_ingest_needs_since(timeline, tmp_path):
+    with pytest.raises(ValueError):
+        observations.ingest(str(tmp_path / 'store'), url=timeline.url)
+
+def test_ingest_normalizes(timeline, tmp_path):
+    store = str(tmp_path / 'store')
+    timeline.add(datetime(2020, 2, 1, 23), depth=42.0, lon=-119.75, lat=45.25)
+    observations.ingest(store, since=START, until=datetime(2020, 2, 2), url=timeline.url)
+    row = observations.read_observations(store).iloc[0]
+    assert (row['longitude'], row['latitude'], row['depth']) == (-119.75, 45.25, 42.0)
+    assert row['source'] == 'MountainHub' and row['author'] == 'Observer'
+    assert pd.Timestamp(row['date']) == pd.Timestamp('2020-02-01')
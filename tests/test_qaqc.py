@@ -0,0 +1,83 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+import validation.qaqc as qaqc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Rows as in CSO database exports, with locations in a wkt_geom column
+WKT_CSV = '''wkt_geom,id,author,depth,source,timestamp
+Point (-119.5 37.5),a,Ann,120,MountainHub,2020-02-01T10:00:00.000
+Point (-119.6 37.6),b,Ann,5,MountainHub,2020-02-01T11:00:00.000
+Point (-119.7 37.7),c,Bob,1000,MountainHub,2020-02-02T12:00:00.000
+Point (-149.3 61.8),d,Bob,5,SnowPilot,2020-02-02T13:00:00.000
+Point (-149.4 61.9),e,Bob,0,SnowPilot,2020-02-03T14:00:00.000
+'''
+
+def test_qaqc_file_wkt_csv(tmp_path):
+    path = tmp_path / 'cso.csv'
+    path.write_text(WKT_CSV)
+    output = str(tmp_path / 'flags.parquet')
+    summary = qaqc.qaqc_file(str(path), output=output, chunksize=2)
+    assert summary.loc[('MountainHub', 'Ann'), 'low'] == 1
+    assert summary.loc[('MountainHub', 'Bob'), 'max_depth'] == 1
+    # Low depths are only flagged in the notebook regions
+    assert summary.loc[('SnowPilot', 'Bob'), 'low'] == 0
+    assert summary.loc[('SnowPilot', 'Bob'), 'zero'] == 1
+    assert summary['count'].sum() == 5
+
+    flagged = pd.read_parquet(output)
+    np.testing.assert_allclose(flagged['longitude'], [-119.5, -119.6, -119.7, -149.3, -149.4])
+    np.testing.assert_allclose(flagged['latitude'], [37.5, 37.6, 37.7, 61.8, 61.9])
+    assert list(flagged['flags'] != 0) == [False, True, True, False, True]
+
+def test_qaqc_file_export():
+    summary = qaqc.qaqc_file(os.path.join(ROOT, 'cso_data_fromcsodb_alaska_since20191109.csv'))
+    assert summary['count'].sum() == 27
+
+def cluster():
+    """Observations within a few hundred meters on consecutive days, one far from the rest."""
+    rng = np.random.default_rng(7)
+    n = 9
+    df = pd.DataFrame({
+        'longitude' : -120.0 + rng.uniform(-0.002, 0.002, n),
+        'latitude' : 45.0 + rng.uniform(-0.002, 0.002, n),
+        'depth' : 100.0 + np.arange(n),
+        'timestamp' : pd.Timestamp('2020-02-01') + pd.to_timedelta(np.arange(n) % 3, unit='D')
+    })
+    # Planted outlier among the neighbors
+    df.loc[4, 'depth'] = 300.0
+    # Isolated observation, 40 km away
+    isolated = {'longitude' : -119.5, 'latitude' : 45.0, 'depth' : 300.0, 'timestamp' : pd.Timestamp('2020-02-01')}
+    # Observation at the cluster a month later, outside the time window
+    later = {'longitude' : -120.0, 'latitude' : 45.0, 'depth' : 10.0, 'timestamp' : pd.Timestamp('2020-03-01')}
+    return pd.concat([df, pd.DataFrame([isolated, later])], ignore_index=True)
+
+def test_neighbor_outliers_planted():
+    df = cluster()
+    result = qaqc.neighbor_outliers(df)
+    assert list(result.index[result['outlier']]) == [4]
+    assert (result['neighbors'][:9] == 8).all()
+    assert result.loc[4, 'neighbor_median'] == np.median(np.delete(df['depth'][:9].to_numpy(), 4))
+    assert result.loc[4, 'zscore'] > 3.5
+    assert (result['zscore'][:9].drop(4).abs() < 3.5).all()
+    # Splitting the queries into batches gives the same scores
+    pd.testing.assert_frame_equal(qaqc.neighbor_outliers(df, batch_size=4, workers=1), result)
+
+def test_neighbor_outliers_too_few_neighbors():
+    df = cluster()
+    result = qaqc.neighbor_outliers(df)
+    for i in [9, 10]:
+        assert result.loc[i, 'neighbors'] == 0
+        assert np.isnan(result.loc[i, 'zscore']) and not result.loc[i, 'outlier']
+    # Neighbors in the cluster but fewer than min_neighbors leave observations unscored
+    result = qaqc.neighbor_outliers(df, min_neighbors=9)
+    assert result['zscore'].isna().all() and not result['outlier'].any()
+
+def test_neighbor_outliers_snodas():
+    df = cluster().assign(snodas=105.0)
+    result = qaqc.neighbor_outliers(df, snodas='snodas')
+    assert list(result.index[result['snodas_outlier']]) == [4]
+    assert np.isnan(result.loc[9, 'snodas_zscore'])
@@ -0,0 +1,51 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import validation.rasterize as rasterize
+
+GRID = {'rows' : 4, 'cols' : 5, 'transform' : (1.0, 0.0, -120.0, 0.0, -1.0, 46.0), 'crs' : 'EPSG:4326'}
+
+def observations(lons, lats, depths, dates):
+    return pd.DataFrame({'longitude' : lons, 'latitude' : lats, 'depth' : depths, 'date' : pd.to_datetime(dates)})
+
+def test_aggregate():
+    keys, stats = rasterize.aggregate(np.array([3, 1, 3, 3]), np.array([1.0, 5.0, 2.0, 6.0]))
+    np.testing.assert_array_equal(keys, [1, 3])
+    np.testing.assert_array_equal(stats['count'], [1, 3])
+    np.testing.assert_allclose(stats['mean'], [5.0, 3.0])
+    np.testing.assert_array_equal(stats['min'], [5.0, 1.0])
+    np.testing.assert_array_equal(stats['max'], [5.0, 6.0])
+    np.testing.assert_allclose(stats['std'], [np.nan, np.std([1.0, 2.0, 6.0], ddof=1)])
+
+def test_aggregate_empty():
+    keys, stats = rasterize.aggregate(np.array([], dtype=np.int64), np.array([]))
+    assert len(keys) == 0
+    assert sorted(stats) == sorted(rasterize.CELL_STATS)
+    assert all(len(values) == 0 for values in stats.values())
+
+def test_rasterize():
+    df = observations([-119.5, -119.4, -117.5, -119.5], [45.5, 45.6, 43.5, 45.5], [10.0, 20.0, 30.0, 40.0],
+                      ['2020-02-01', '2020-02-01', '2020-02-01', '2020-02-02'])
+    cells = rasterize.rasterize(df, GRID)
+    assert list(cells['cell']) == [0, 12, 0]
+    assert list(cells['count']) == [2, 1, 1]
+    dense = rasterize.to_dense(cells, GRID)
+    assert dense.shape == (2, 4, 5)
+    assert dense.values[0, 0, 0] == 15.0
+    assert np.isnan(dense.values).sum() == 2 * 20 - 3
+
+@pytest.mark.parametrize('by_date', [True, False])
+def test_rasterize_without_observations_on_grid(by_date):
+    # Outside the grid, without a depth, and no rows at all
+    for df in [observations([-130.0], [45.0], [10.0], ['2020-02-01']),
+               observations([-119.5], [45.5], [np.nan], ['2020-02-01']),
+               observations([], [], [], [])]:
+        cells = rasterize.rasterize(df, GRID, by_date=by_date)
+        assert len(cells) == 0
+        assert list(cells.columns) == (['date'] if by_date else []) + ['cell', 'row', 'col'] + rasterize.CELL_STATS
+        dense = rasterize.to_dense(cells, GRID)
+        if by_date:
+            assert dense.shape == (0, 4, 5)
+        else:
+            assert dense.shape == (4, 5) and np.isnan(dense.values).all()
@@ -0,0 +1,81 @@
+import numpy as np
+import pytest
+import xarray as xr
+
+import validation.regrid as regrid
+
+# Source grid of 1 km EASE2 cells over the western US
+RES = 1000.9
+
+def ease2_grid(cols=60, rows=40, x0=-10000000.0):
+    x = x0 + RES * (np.arange(cols) + 0.5)
+    y = 4500000.0 - RES * (np.arange(rows) + 0.5)
+    xx, yy = np.meshgrid(x, y)
+    # Smooth field, so bilinear results only differ by rounding
+    data = ((xx - x[0]) / RES * 3 + (y[0] - yy) / RES * 7).astype(np.float32)
+    return xr.DataArray(data, dims=('y', 'x'), coords={'y' : y, 'x' : x})
+
+@pytest.mark.parametrize('method, atol', [('nearest', 0), ('bilinear', 1e-3)])
+def test_plan_matches_rioxarray(method, atol):
+    pytest.importorskip('rioxarray')
+    from rasterio.enums import Resampling
+
+    da = ease2_grid()
+    plan = regrid.regrid_plan(da['x'].values, da['y'].values, 'epsg:6933', 0.01, method=method)
+    out = regrid.regrid(da, plan)
+    expected = da.rio.write_crs('epsg:6933').rio.reproject('epsg:4326', resolution=0.01,
+                                                            resampling=Resampling[method], nodata=np.nan)
+    np.testing.assert_allclose(out['longitude'].values, expected['x'].values)
+    np.testing.assert_allclose(out['latitude'].values, expected['y'].values)
+    np.testing.assert_allclose(out.values, expected.values, rtol=0, atol=atol)
+    # Cells outside the source grid are NaN in both
+    assert np.isnan(out.values).any()
+
+def test_apply_plan_time_slices_and_nan():
+    da = ease2_grid()
+    plan = regrid.regrid_plan(da['x'].values, da['y'].values, 'epsg:6933', 0.01, method='bilinear')
+    stack = np.stack([da.values, da.values * 2])
+    stack[1, 10, 20] = np.nan
+    out = regrid.apply_plan(plan, stack)
+    assert out.shape == (2,) + tuple(plan['dst_shape'])
+    np.testing.assert_allclose(out[0], regrid.apply_plan(plan, da.values))
+    # Missing source cells are left out of the weights rather than spreading NaN
+    valid = ~np.isnan(out[0])
+    assert np.array_equal(np.isnan(out[1]), ~valid)
+    with pytest.raises(ValueError):
+        regrid.apply_plan(plan, stack[:, 1:])
+
+def test_cached_plan_invalidated_by_source_grid(tmp_path, monkeypatch):
+    plan_dir = str(tmp_path / 'plans')
+    computed = []
+    regrid_plan = regrid.regrid_plan
+    monkeypatch.setattr(regrid, 'regrid_plan', lambda *args: computed.append(args) or regrid_plan(*args))
+
+    da = ease2_grid()
+    args = (da['x'].values, da['y'].values, 'epsg:6933', 0.01)
+    plan = regrid.cached_plan(plan_dir, 'wus_001', *args)
+    assert regrid.plan_mismatch(regrid.load_plan(str(tmp_path / 'plans' / 'wus_001.npz')), *args) == []
+    cached = regrid.cached_plan(plan_dir, 'wus_001', *args)
+    assert len(computed) == 1
+    np.testing.assert_array_equal(cached['index'], plan['index'])
+
+    # The source grid moved by a cell; the saved plan no longer applies and is replaced
+    moved = ease2_grid(x0=-10000000.0 + RES)
+    moved_args = (moved['x'].values, moved['y'].values, 'epsg:6933', 0.01)
+    assert regrid.plan_mismatch(cached, *moved_args) == ['src_transform']
+    with pytest.raises(ValueError):
+        regrid.regrid(moved, cached)
+    replanned = regrid.cached_plan(plan_dir, 'wus_001', *moved_args)
+    assert len(computed) == 2
+    assert regrid.plan_mismatch(regrid.load_plan(str(tmp_path / 'plans' / 'wus_001.npz')), *moved_args) == []
+    np.testing.assert_allclose(regrid.regrid(moved, replanned).values,
+                               regrid.regrid(moved, regrid_plan(*moved_args)).values)
+
+    # Other shapes, CRSs, resolutions and methods also invalidate it
+    smaller = ease2_grid(cols=50)
+    assert 'src_shape' in regrid.plan_mismatch(replanned, smaller['x'].values, smaller['y'].values, 'epsg:6933', 0.01)
+    assert regrid.plan_mismatch(replanned, *moved_args[:2], 'epsg:3857', 0.01) == ['src_crs']
+    assert regrid.plan_mismatch(replanned, *moved_args[:3], 0.02) == ['resolution']
+    assert regrid.plan_mismatch(replanned, *moved_args, method='bilinear') == ['method']
+    # Plans saved without the grid description are recomputed
+    assert set(regrid.plan_mismatch({'index' : replanned['index']}, *moved_args)) >= {'src_shape', 'src_transform'}
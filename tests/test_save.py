@@ -0,0 +1,55 @@
+from datetime import datetime
+
+import netCDF4
+import numpy as np
+import pytest
+
+import validation.SNODAS as SNODAS
+import validation.utils as ut
+
+from conftest import snodas_tar, snodas_values
+
+DATES = [datetime(2020, 2, day) for day in [1, 2, 3]]
+
+@pytest.fixture
+def snodas_results(snodas_server):
+    for date in DATES:
+        snodas_server.serve(date.strftime('/SNODAS_unmasked_%Y%m%d.tar'), snodas_tar(date))
+    return lambda: SNODAS.snodas_range(DATES[0], DATES[-1], codes=(1034, 1036), decoders=1, backoff=0)
+
+def lock_checked(pairs):
+    """Pass pairs through, checking NetCDF writes do not hold the lock while the next one is made."""
+    for pair in pairs:
+        assert not ut.NETCDF_LOCK.locked()
+        yield pair
+
+def test_save_dates_product(snodas_results, tmp_path):
+    paths = ut.save_dates(SNODAS.product_dates(snodas_results(), 1036), str(tmp_path / 'sd_%Y%m%d.nc'),
+                          save=ut.save_netcdf, workers=2)
+    assert sorted(paths) == [str(tmp_path / date.strftime('sd_%Y%m%d.nc')) for date in DATES]
+    for date in DATES:
+        with netCDF4.Dataset(date.strftime(str(tmp_path / 'sd_%Y%m%d.nc'))) as nc:
+            np.testing.assert_array_equal(nc['Band1'][:], snodas_values(date, 1036))
+
+def test_save_dates_rejects_products(snodas_results, tmp_path):
+    with pytest.raises(ValueError):
+        ut.save_dates(snodas_results(), str(tmp_path / 'sd_%Y%m%d.nc'), save=ut.save_netcdf)
+
+def test_save_netcdf_lazy_layers(snodas_results, tmp_path):
+    pairs = sorted(SNODAS.product_dates(snodas_results(), 1034))
+    path = str(tmp_path / 'swe.nc')
+    ut.save_netcdf(lock_checked(pairs), path)
+    with netCDF4.Dataset(path) as nc:
+        assert nc['Band1'].shape == (len(DATES),) + snodas_values(DATES[0], 1034).shape
+        np.testing.assert_array_equal(nc['Band1'][2], snodas_values(DATES[2], 1034))
+        np.testing.assert_array_equal(nc['time'][:], [18293, 18294, 18295])
+
+def test_save_tiff_pairs(snodas_results, tmp_path):
+    rasterio = pytest.importorskip('rasterio')
+    pairs = SNODAS.product_dates(sorted(snodas_results(), key=lambda result: result[0]), 1036)
+    path = str(tmp_path / 'sd.tif')
+    ut.save_tiff(pairs, path)
+    with rasterio.open(path) as source:
+        assert source.count == len(DATES)
+        assert source.descriptions == tuple(date.strftime('%Y-%m-%d') for date in DATES)
+        np.testing.assert_array_equal(source.read(3), snodas_values(DATES[2], 1036))
@@ -0,0 +1,150 @@
+import io
+import tarfile
+from datetime import datetime
+
+import numpy as np
+import pytest
+
+import validation.SNODAS as SNODAS
+import validation.utils as ut
+from validation.cache import SnodasCache
+
+from conftest import GRID, snodas_tar, snodas_values
+
+DATE = datetime(2020, 2, 1)
+
+def archive_path(date):
+    return date.strftime('/SNODAS_unmasked_%Y%m%d.tar')
+
+def expected(date, code):
+    return snodas_values(date, code).astype(np.int16)
+
+@pytest.mark.parametrize('code, name', [
+    (1036, 'zz_ssmv11036tS__T0001TTNATS2020020105HP001.dat.gz'),
+    (1039, 'zz_ssmv11039lL00T0024TTNATS2020020105DP000.dat.gz'),
+    (1050, 'zz_ssmv11050lL00T0024TTNATS2020020105DP000.dat.gz')
+])
+def test_product_file_names(code, name):
+    assert SNODAS.snodas_file_format(DATE, code) % (code, 'dat') == name
+
+@pytest.mark.parametrize('stream', [False, True])
+def test_url_to_tar(stand_in, stream):
+    url = stand_in.serve('/a.tar', snodas_tar(DATE))
+    tar = ut.url_to_tar(url, stream=stream)
+    names = [member.name for member in tar]
+    tar.close()
+    assert names[0] == 'README.txt'
+    assert SNODAS.snodas_file_format(DATE, 1036) % (1036, 'dat') in names
+
+def test_stream_tar_closes_connection(stand_in):
+    url = stand_in.serve('/a.tar', snodas_tar(DATE))
+    with ut.stream_tar(url) as tar:
+        next(iter(tar))
+        response = tar.fileobj.fileobj
+    assert response.closed
+
+def test_retry_after_transient_failure(stand_in):
+    url = stand_in.serve('/a.tar', snodas_tar(DATE), failures=2)
+    data = ut.retry(ut.url_to_io, url, attempts=3, backoff=0)
+    assert data.getvalue() == snodas_tar(DATE)
+    assert stand_in.requests['/a.tar'] == 3
+
+def test_retry_gives_up(stand_in):
+    url = stand_in.serve('/a.tar', snodas_tar(DATE), failures=5)
+    with pytest.raises(IOError):
+        ut.retry(ut.url_to_io, url, attempts=2, backoff=0)
+    assert stand_in.requests['/a.tar'] == 2
+
+def test_snodas_ds(snodas_server):
+    snodas_server.serve(archive_path(DATE), snodas_tar(DATE))
+    ds = SNODAS.snodas_ds(DATE)
+    np.testing.assert_array_equal(ds.values[0], expected(DATE, 1036))
+    assert ds.attrs['nodatavals'] == (-9999.0,)
+    np.testing.assert_allclose(ds['x'].values[[0, -1]], [-119.9875, -119.0125])
+
+def test_snodas_ds_products(snodas_server):
+    snodas_server.serve(archive_path(DATE), snodas_tar(DATE))
+    ds = SNODAS.snodas_ds(DATE, codes=[1034, 1036])
+    assert snodas_server.requests[archive_path(DATE)] == 1
+    assert np.isnan(ds['snodas_1036'].values[0]).all()
+    np.testing.assert_allclose(ds['snodas_1036'].values[1:], expected(DATE, 1036)[1:] * 0.001, rtol=1e-6)
+
+def test_snodas_ds_cache_hit(snodas_server, tmp_path):
+    snodas_server.serve(archive_path(DATE), snodas_tar(DATE))
+    cache = SnodasCache(str(tmp_path))
+    first = SNODAS.snodas_ds(DATE, cache=cache)
+    second = SNODAS.snodas_ds(DATE, cache=cache)
+    assert snodas_server.requests[archive_path(DATE)] == 1
+    assert cache.hits == 1
+    np.testing.assert_array_equal(first.values, second.values)
+    assert tuple(second.attrs['transform']) == tuple(first.attrs['transform'])
+
+def test_snodas_range(snodas_server, tmp_path):
+    dates = [datetime(2020, 2, day) for day in [1, 2, 3]]
+    for date in dates:
+        # The second day fails once before being served
+        snodas_server.serve(archive_path(date), snodas_tar(date), failures=int(date.day == 2))
+    cache = SnodasCache(str(tmp_path))
+    results = dict(SNODAS.snodas_range(dates[0], dates[-1], codes=(1034, 1036), cache=cache,
+                                       downloads=2, decoders=1, max_in_flight=2, backoff=0))
+    assert sorted(results) == dates
+    for date in dates:
+        np.testing.assert_array_equal(results[date][1036].values[0], expected(date, 1036))
+        np.testing.assert_array_equal(results[date][1034].values[0], expected(date, 1034))
+    assert snodas_server.requests[archive_path(dates[1])] == 2
+
+    # All dates are now served from the cache
+    again = dict(SNODAS.snodas_range(dates[0], dates[-1], codes=(1034, 1036), cache=cache))
+    assert sorted(again) == dates
+    assert sum(snodas_server.requests.values()) == 4
+
+def test_snodas_range_skip_errors(snodas_server):
+    snodas_server.serve(archive_path(DATE), snodas_tar(DATE))
+    with pytest.warns(UserWarning):
+        results = dict(SNODAS.snodas_range(DATE, datetime(2020, 2, 2), decoders=1, attempts=1,
+                                           skip_errors=True))
+    assert list(results) == [DATE]
+
+def decode(data, code=1036, bbox=None):
+    tar = tarfile.open(fileobj=io.BytesIO(data), mode='r|')
+    return SNODAS.tar_to_snodas(tar, SNODAS.snodas_file_format(DATE, code), code=code, bbox=bbox)
+
+def data_first(data):
+    """Reorder archive so each .dat comes before its header."""
+    out = io.BytesIO()
+    with tarfile.open(fileobj=io.BytesIO(data)) as source, tarfile.open(fileobj=out, mode='w') as tar:
+        members = sorted(source.getmembers(), key=lambda member: '.dat' not in member.name)
+        for member in members:
+            tar.addfile(member, source.extractfile(member))
+    return out.getvalue()
+
+@pytest.mark.parametrize('order', [lambda data: data, data_first])
+@pytest.mark.parametrize('bbox', [
+    (-119.61, 45.11, -119.33, 45.29),
+    (-119.5, 45.2, -119.49, 45.21),
+    (-120.3, 45.3, -119.81, 45.7),
+    (-119.1, 44.9, -118.5, 45.05),
+    (-121.0, 44.0, -118.0, 46.0)
+])
+def test_tar_to_snodas_bbox(order, bbox, monkeypatch):
+    # A .dat before its header is windowed with the expected grid, here the synthetic one
+    monkeypatch.setitem(SNODAS.SNODAS_GRIDS, 'zz', dict(SNODAS.SNODAS_GRIDS['zz'], rows=GRID['rows'], cols=GRID['cols'],
+                        transform=(0.025, 0.0, GRID['xmin'], 0.0, -0.025, GRID['ymax'])))
+    data = order(snodas_tar(DATE))
+    full = decode(data)
+    window = decode(data, bbox=bbox)
+    # Cells of the full grid touching the bounding box
+    half = 0.0125
+    x, y = full['x'].values, full['y'].values
+    cols = (x + half > bbox[0]) & (x - half < bbox[2])
+    rows = (y + half > bbox[1]) & (y - half < bbox[3])
+    expected = full.isel(y=np.flatnonzero(rows), x=np.flatnonzero(cols))
+    np.testing.assert_array_equal(window.values, expected.values)
+    np.testing.assert_allclose(window['x'].values, expected['x'].values)
+    np.testing.assert_allclose(window['y'].values, expected['y'].values)
+    np.testing.assert_allclose(window.attrs['transform'], SNODAS.crop_snodas(full, bbox).attrs['transform'])
+    assert window.attrs['nodatavals'] == full.attrs['nodatavals']
+
+def test_tar_to_snodas_bbox_outside():
+    with pytest.raises(ValueError):
+        decode(snodas_tar(DATE), bbox=(-100.0, 30.0, -99.0, 31.0))
@@ -0,0 +1,85 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import validation.matchups as matchups
+import validation.stats as stats
+
+def synthetic_matchups(n=3000, seed=3):
+    """Matchups over two water years with missing values, groups and elevations."""
+    rng = np.random.default_rng(seed)
+    depth = rng.uniform(0, 300, n)
+    snodas = depth / 100 * rng.normal(1.0, 0.2, n) + rng.normal(0, 0.1, n)
+    depth[rng.random(n) < 0.05] = np.nan
+    snodas[rng.random(n) < 0.05] = np.nan
+    elevation = rng.uniform(0, 3000, n)
+    elevation[rng.random(n) < 0.1] = np.nan
+    return pd.DataFrame({
+        'id' : ['obs%05d' % i for i in range(n)],
+        'date' : pd.Timestamp('2019-06-01') + pd.to_timedelta(rng.integers(0, 500, n), unit='D'),
+        'region' : rng.choice(['alaska', 'sierra', 'rockies'], n),
+        'source' : rng.choice(['MountainHub', 'SnowPilot'], n),
+        'author' : rng.choice(['Ann', 'Bob', None], n),
+        'dem_elevation' : elevation,
+        'depth' : depth,
+        'snodas_1036' : snodas
+    })
+
+def assert_same_stats(merged, single):
+    pd.testing.assert_frame_equal(merged.result(), single.result(), rtol=1e-9)
+    for kind in ['observed', 'modeled', 'difference']:
+        pd.testing.assert_frame_equal(merged.histograms(kind), single.histograms(kind))
+
+@pytest.mark.parametrize('parts', [2, 7])
+def test_merge_matches_single_pass(parts):
+    df = synthetic_matchups()
+    single = stats.GroupedStats().update(df)
+    # Partitions in random order, some missing groups of others
+    rng = np.random.default_rng(parts)
+    split = rng.integers(0, parts, len(df))
+    merged = stats.GroupedStats()
+    for part in rng.permutation(parts):
+        merged.merge(stats.GroupedStats().update(df[split == part]))
+    assert_same_stats(merged, single)
+    # Partitions by group, so the merged statistics have their groups in another order
+    merged = stats.GroupedStats()
+    for _, group in df.sort_values('region', ascending=False).groupby('region', sort=False):
+        merged.merge(stats.GroupedStats().update(group))
+    assert_same_stats(merged, single)
+
+def test_single_pass_matches_groupby():
+    df = synthetic_matchups()
+    result = stats.GroupedStats(by=['region']).update(df).result()
+    valid = df.dropna(subset=['depth', 'snodas_1036'])
+    x = valid['depth'] / 100
+    d = valid['snodas_1036'] - x
+    groups = valid['region']
+    np.testing.assert_array_equal(result['count'], groups.value_counts().sort_index())
+    np.testing.assert_allclose(result['bias'], d.groupby(groups).mean().sort_index())
+    np.testing.assert_allclose(result['mae'], d.abs().groupby(groups).mean().sort_index())
+    np.testing.assert_allclose(result['rmse'], np.sqrt((d ** 2).groupby(groups).mean().sort_index()))
+    np.testing.assert_allclose(result['std'], d.groupby(groups).std().sort_index())
+    np.testing.assert_allclose(result['r'], [np.corrcoef(x[groups == name], valid['snodas_1036'][groups == name])[0, 1]
+                                             for name in result.index.get_level_values('region')])
+    np.testing.assert_allclose(result['difference_min'], d.groupby(groups).min().sort_index())
+    # Quantiles are estimated within histogram bins of 0.01
+    np.testing.assert_allclose(result['difference_p50'], d.groupby(groups).median().sort_index(), atol=0.01)
+
+def test_merge_rejects_other_bins():
+    with pytest.raises(ValueError):
+        stats.GroupedStats().merge(stats.GroupedStats(elevation_band=100))
+    with pytest.raises(ValueError):
+        stats.GroupedStats().merge(stats.GroupedStats(difference_edges=np.linspace(-1, 1, 11)))
+
+def test_matchup_stats_store(tmp_path):
+    df = synthetic_matchups()
+    df['water_year'] = matchups.water_year(df['date'])
+    store = str(tmp_path / 'matchups')
+    # Several files per partition, as written by updates
+    for i, rows in enumerate(np.array_split(np.arange(len(df)), 3)):
+        part = df.iloc[rows]
+        matchups.write_partitions(store, part, 'part%d' % i, partitions=['water_year', 'region'])
+    single = stats.GroupedStats().update(df)
+    assert_same_stats(stats.matchup_stats(store, workers=2), single)
+    filtered = stats.matchup_stats(store, filters=[('region', '=', 'alaska')], workers=2)
+    assert_same_stats(filtered, stats.GroupedStats().update(df[df['region'] == 'alaska']))
@@ -0,0 +1,196 @@
+import gc
+import os
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+import rioxarray
+from ease_lonlat import EASE2GRID, SUPPORTED_GRIDS
+from pyproj import Transformer
+import validation.cube as cube
+import validation.regrid as regrid
+import validation.utils as ut
+
+EASE2G_epsg_str = "epsg:6933"
+
+# Default chunking of (time, northing, easting) in C-SNOW stores
+CSNOW_CHUNKS = (32, 512, 512)
+
+def ease2grid_coords():
+    """Get cell center easting and northing of the EASE2_G1km C-SNOW grid."""
+    egrid = EASE2GRID(name='EASE2_G1km', **SUPPORTED_GRIDS['EASE2_G1km'])
+    eg_easting = [egrid.x_min + (i+0.5)*egrid.res for i in range(34704)]
+    # eg_northing = [egrid.y_max - (j+0.5)*egrid.res for j in range(4500)[::-1]]
+    eg_northing = [egrid.y_max - (j+0.5)*egrid.res for j in range(4500)]
+    return eg_easting, eg_northing
+
+def ease2_window(bounds, eg_easting, eg_northing):
+    """Get EASE2 row and column window covering a bounding box.
+
+    Cells touching the box are included, like rio.clip(all_touched=True).
+    EASE2 is a cylindrical projection, so a latitude/longitude box maps to
+    an axis-aligned box in easting and northing.
+
+    Keyword arguments:
+    bounds -- (minx, miny, maxx, maxy) in EASE2 meters, e.g. bbox_ease2_gs.total_bounds
+    eg_easting -- Cell center eastings from ease2grid_coords
+    eg_northing -- Cell center northings from ease2grid_coords
+
+    Returns:
+    Dictionary of northing (row) and easting (column) slices
+    """
+    minx, miny, maxx, maxy = bounds
+    easting = np.asarray(eg_easting)
+    northing = np.asarray(eg_northing)
+    half = abs(easting[1] - easting[0]) / 2
+    cols = np.flatnonzero((easting + half > minx) & (easting - half < maxx))
+    rows = np.flatnonzero((northing + half > miny) & (northing - half < maxy))
+    if len(cols) == 0 or len(rows) == 0:
+        raise ValueError('Bounds %s do not intersect the EASE2 grid' % (tuple(bounds),))
+    return {
+        'northing' : slice(int(rows[0]), int(rows[-1]) + 1),
+        'easting' : slice(int(cols[0]), int(cols[-1]) + 1)
+    }
+
+#@profile
+def open_process(nc_fpath, eg_easting, eg_northing, window=None, chunks=None):
+    """Open C-SNOW NetCDF and attach EASE2 coordinates and CRS.
+
+    With a window, only that part of the grid is selected before anything
+    is read, so memory use depends on the window rather than the full grid.
+
+    Keyword arguments:
+    nc_fpath -- Path of C-SNOW NetCDF file
+    eg_easting -- Cell center eastings from ease2grid_coords
+    eg_northing -- Cell center northings from ease2grid_coords
+    window -- Dictionary of northing and easting slices from ease2_window (default full grid)
+    chunks -- Dask chunks to open file with (default None, not chunked)
+    """
+    ds = xr.open_dataset(nc_fpath, cache=False, chunks=chunks)
+    ds = ds.rename_dims(dims_dict={"ease2_x": "easting", "ease2_y": "northing"})
+    if window is not None:
+        ds = ds.isel(window)
+        eg_easting = np.asarray(eg_easting)[window['easting']]
+        eg_northing = np.asarray(eg_northing)[window['northing']]
+
+    # calculate the y coordinate (cell center) for row j (base 0 from the top)
+    ds.coords["northing"] = eg_northing
+    ds["northing"].attrs = dict(
+        axis='Y',
+        long_name='EASE2_G1km Northing',
+        standard_name='projection_y_coordinate',
+        units='m'
+    )
+
+    # calculate the x coordinate (cell center) for col i (base 0 from the left)
+    ds.coords["easting"] = eg_easting
+    ds["easting"].attrs = dict(
+        axis='X',
+        long_name='EASE2_G1km Easting',
+        standard_name='projection_x_coordinate',
+        units='m'
+    )
+
+    clean_ds = (
+        ds
+        .rio.set_spatial_dims('easting', 'northing')
+        .rio.write_crs(EASE2G_epsg_str)
+    )
+
+    # Add `grid_mapping` global and variable attributes
+    grid_mapping_name = "spatial_ref"
+    clean_ds.attrs['grid_mapping'] = grid_mapping_name
+    clean_ds['snd'].attrs['grid_mapping'] = grid_mapping_name
+
+    return clean_ds
+
+#@profile
+def add_timecoord(ds, date_tindex):
+    """Add time (date) dimension and coordinate
+    """
+    date_da = xr.DataArray([date_tindex], coords=[('time', [date_tindex])])
+    ds["snd"] = ds.snd.expand_dims(time=date_da)
+    ds["time"].attrs = dict(
+        axis='T',
+        long_name='Date',
+        standard_name='time'
+    )
+
+    return ds
+
+def ingest(dates, dpath, bounds, store, geometry=None, chunks=CSNOW_CHUNKS):
+    """Clip daily C-SNOW files to a window and append them to a zarr store.
+
+    Each day is read only over the EASE2 window covering bounds and is
+    written out before the next day is opened, so memory use does not grow
+    with the number of days. Dates already in the store are skipped, so an
+    interrupted run can be resumed.
+
+    Keyword arguments:
+    dates -- Dates to ingest
+    dpath -- Directory containing SD_%Y%m%d.nc files
+    bounds -- (minx, miny, maxx, maxy) in EASE2 meters, e.g. bbox_ease2_gs.total_bounds
+    store -- Path of zarr store to append to
+    geometry -- Geometries in EASE2 to clip each window to (default None, window only)
+    chunks -- Chunk sizes along (time, northing, easting) (default CSNOW_CHUNKS)
+
+    Returns:
+    Number of dates written
+    """
+    eg_easting, eg_northing = ease2grid_coords()
+    window = ease2_window(bounds, eg_easting, eg_northing)
+    done = cube.cube_dates(str(store))
+
+    written = 0
+    for date in pd.DatetimeIndex(dates):
+        if date in done:
+            continue
+        fname = f"SD_{date.strftime('%Y%m%d')}.nc"
+        ds = open_process(os.path.join(dpath, fname), eg_easting, eg_northing, window=window)
+        ds = add_timecoord(ds, date)
+        ds = ds.transpose('time', 'northing', 'easting')
+        if geometry is not None:
+            ds = ds.rio.clip(geometry, all_touched=True)
+        ds = ds.load()
+
+        # Attribute conflicts with the grid_mapping encoding rioxarray sets
+        del ds.snd.attrs['grid_mapping']
+        if not os.path.exists(store):
+            encoding = {'snd' : {'dtype' : 'float32', 'chunks' : chunks}}
+            ds.to_zarr(store, mode='w', encoding=encoding)
+        else:
+            ds.to_zarr(store, append_dim='time')
+        written += 1
+
+        ds.close()
+        del ds
+        gc.collect()
+
+    return written
+
+def sample_store(store, date, lons, lats):
+    """Sample a C-SNOW zarr store at points for one date.
+
+    Keyword arguments:
+    store -- Path of zarr store written by ingest
+    date -- Date to sample
+    lons -- Array of longitudes
+    lats -- Array of latitudes
+
+    Returns:
+    Array of snow depths, NaN for missing cells and points outside the store
+    """
+    ds = xr.open_zarr(str(store))
+    date = pd.Timestamp(date)
+    if date not in ds.indexes['time']:
+        return np.full(len(lons), np.nan)
+    transformer = Transformer.from_crs('epsg:4326', EASE2G_epsg_str, always_xy=True)
+    x, y = transformer.transform(np.asarray(lons, dtype=np.float64), np.asarray(lats, dtype=np.float64))
+    transform = regrid.coords_transform(ds['easting'].values, ds['northing'].values)
+    shape = (ds.sizes['northing'], ds.sizes['easting'])
+    rows, cols, valid = ut.grid_indices(np.asarray(x), np.asarray(y), transform, shape)
+
+    grid = ds.snd.sel(time=date).values
+    values = grid[rows, cols].astype(np.float64)
+    values[~valid] = np.nan
+    return values
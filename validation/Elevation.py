@@ -1,82 +1,228 @@
-import pandas as pd
-import requests
-import validation.utils as ut
+import os
+import glob
+from functools import lru_cache
+
+import numpy as np
 import validation.creds as creds
+import validation.metrics as metrics
+import validation.raster as raster
+
+# File extensions recognized as DEM tiles
+DEM_EXTENSIONS = ['tif', 'tiff', 'vrt', 'img', 'hgt']
+
+# Rows and columns of the blocks DEM tiles are read in, bounding memory for large single-file DEMs
+BLOCK_SIZE = 512
+
+def dem_directory(dem_dir=None):
+    """Get directory of DEM tiles.
+
+    Keyword arguments:
+    dem_dir -- Directory to use (default CSO_DEM_DIR environment variable, then dem_dir credential)
+    """
+    dem_dir = dem_dir or os.environ.get('CSO_DEM_DIR') or creds.get_credential('dem_dir')
+    if not dem_dir:
+        raise ValueError('No DEM directory given; set CSO_DEM_DIR or the dem_dir credential')
+    return os.path.abspath(os.path.expanduser(dem_dir))
+
+@lru_cache(maxsize=8)
+@metrics.timed('Elevation.tile_index')
+def tile_index(dem_dir):
+    """Build index of DEM tiles in directory.
 
-BASE_ELEVATION_URL = 'https://maps.googleapis.com/maps/api/elevation/json'
+    Tiles must be in geographic (longitude/latitude) coordinates. The index
+    is built once per directory and process. Tiles are read with the raster
+    backend (see raster.backend); without GDAL or rasterio only SRTM .hgt
+    tiles are found.
 
-def el_data(points=[]):
-    """Retrieves elevation data from Google Elevation API.
+    Adjacent SRTM tiles share their edge row or column. Such a shared east
+    column or south row belongs to the neighboring tile, and is excluded by
+    the own_cols and own_rows of the tile, so areas are not counted twice.
 
     Keyword arguments:
-    points -- List of coordinates to retrieve elevation data at
+    dem_dir -- Directory containing DEM tiles
+
+    Returns:
+    Tuple of dictionaries with path, transform, width, height, own_cols,
+    own_rows, nodata and bounds of each tile
     """
+    backend = raster.backend()
     records = []
-    # Split into batches for API requests
-    for batch in ut.batches(points, 256):
-        params = {
-            'locations': "|".join([",".join([str(point[0]), str(point[1])]) for point in points]),
-            'key': creds.get_credential('google_key')
-        }
-        print(params)
-        response = requests.get(BASE_ELEVATION_URL, params=params)
-        data = response.json()
-
-        if 'results' not in data:
-            raise ValueError(data)
-
-        records.extend(data['results'])
-    parsed = [{ 'lat' : point[0], 'long' : point[1], **parse_elevation(record)} for point, record in zip(points, records)]
-    df = pd.DataFrame.from_records(parsed)
-    return df
+    for extension in DEM_EXTENSIONS:
+        for path in sorted(glob.glob(os.path.join(dem_dir, '**', '*.' + extension), recursive=True)):
+            info = backend.info(path)
+            if info is None:
+                continue
+            a, _, c, _, e, f = info['transform']
+            width, height = info['cols'], info['rows']
+            records.append({
+                'path' : path,
+                'transform' : (a, 0.0, c, 0.0, e, f),
+                'width' : width,
+                'height' : height,
+                'nodata' : info['nodata'],
+                'xmin' : c,
+                'xmax' : c + a * width,
+                'ymin' : f + e * height,
+                'ymax' : f
+            })
+    if not records:
+        raise ValueError('No DEM tiles found in %s' % dem_dir)
 
-def parse_elevation(record):
-    """Parses record returned by Google Elevation API into standard format.
+    for tile in records:
+        a, _, _, _, e, _ = tile['transform']
+        # Centers of the last column and row, compared to first centers of other tiles
+        east = tile['xmax'] - a / 2
+        south = tile['ymin'] - e / 2
+        tol = 1e-6 * abs(a)
+        shares_east = shares_south = False
+        for other in records:
+            if other is tile:
+                continue
+            overlaps_y = other['ymin'] < tile['ymax'] and other['ymax'] > tile['ymin']
+            overlaps_x = other['xmin'] < tile['xmax'] and other['xmax'] > tile['xmin']
+            shares_east |= overlaps_y and abs(other['xmin'] + a / 2 - east) < tol
+            shares_south |= overlaps_x and abs(other['ymax'] + e / 2 - south) < tol
+        tile['own_cols'] = tile['width'] - int(shares_east)
+        tile['own_rows'] = tile['height'] - int(shares_south)
+    return tuple(records)
+
+def read_window(tile, row0, row1, col0, col1):
+    """Read window of DEM tile as float array with NaN for nodata.
 
     Keyword arguments:
-    record -- Segment of JSON returned by Google Elevation API
+    tile -- Tile of tile index
+    row0, row1 -- First and last row of window (inclusive)
+    col0, col1 -- First and last column of window (inclusive)
     """
-    return {
-        'elevation' : record['elevation']
-    }
+    with metrics.span('Elevation.read_window') as span:
+        values = raster.backend().read(tile['path'], row0, row1 + 1, col0, col1 + 1).astype(np.float64)
+        span.add('bytes_out', values.nbytes)
+    if tile['nodata'] is not None:
+        values[values == tile['nodata']] = np.nan
+    return values
+
+@metrics.timed('Elevation.sample_elevation')
+def sample_elevation(lons, lats, dem_dir=None):
+    """Sample elevations at points using bilinear interpolation.
 
-def average_elevation(box, grid_size = 16):
-    """Approximates elevation over a bounding box using a grid of points.
+    Points are assigned to tiles through the tile index. Within a tile,
+    points are grouped into blocks of BLOCK_SIZE cells, and each occupied
+    block is read once over the window covering its points, so memory use
+    does not grow with the extent of the points.
+
+    Keyword arguments:
+    lons -- Array of longitudes
+    lats -- Array of latitudes
+    dem_dir -- Directory containing DEM tiles (see dem_directory)
+
+    Returns:
+    Array of elevations, NaN outside the DEM or next to nodata cells
+    """
+    tiles = tile_index(dem_directory(dem_dir))
+    metrics.count('points', len(lons))
+    lons = np.asarray(lons, dtype=np.float64)
+    lats = np.asarray(lats, dtype=np.float64)
+    elevations = np.full(len(lons), np.nan)
+    remaining = np.ones(len(lons), dtype=bool)
+
+    # Points between the cell centers of a tile first, then those in the half cell margins,
+    # so points near an edge shared with another tile are interpolated rather than clamped
+    passes = [(tile, margin) for margin in [0.5, 0.0] for tile in tiles]
+    for tile, margin in passes:
+        dx = margin * tile['transform'][0]
+        dy = -margin * tile['transform'][4]
+        inside = remaining & (lons >= tile['xmin'] + dx) & (lons <= tile['xmax'] - dx) & \
+            (lats >= tile['ymin'] + dy) & (lats <= tile['ymax'] - dy)
+        if not inside.any():
+            continue
+        remaining &= ~inside
+        idx = np.flatnonzero(inside)
+
+        # Fractional pixel coordinates relative to cell centers
+        a, _, c, _, e, f = tile['transform']
+        col = np.clip((lons[idx] - c) / a - 0.5, 0, tile['width'] - 1)
+        row = np.clip((lats[idx] - f) / e - 0.5, 0, tile['height'] - 1)
+        col0 = np.minimum(np.floor(col).astype(np.intp), tile['width'] - 2).clip(0)
+        row0 = np.minimum(np.floor(row).astype(np.intp), tile['height'] - 2).clip(0)
+        col1 = np.minimum(col0 + 1, tile['width'] - 1)
+        row1 = np.minimum(row0 + 1, tile['height'] - 1)
+
+        wx = col - col0
+        wy = row - row0
+
+        blocks = (row0 // BLOCK_SIZE) * (tile['width'] // BLOCK_SIZE + 1) + col0 // BLOCK_SIZE
+        order = np.argsort(blocks, kind='stable')
+        starts = np.flatnonzero(np.r_[True, blocks[order][1:] != blocks[order][:-1]])
+        for members in np.split(order, starts[1:]):
+            top, left = row0[members].min(), col0[members].min()
+            window = read_window(tile, top, row1[members].max(), left, col1[members].max())
+            r0, r1 = row0[members] - top, row1[members] - top
+            c0, c1 = col0[members] - left, col1[members] - left
+            x, y = wx[members], wy[members]
+            elevations[idx[members]] = (
+                window[r0, c0] * (1 - x) * (1 - y) +
+                window[r0, c1] * x * (1 - y) +
+                window[r1, c0] * (1 - x) * y +
+                window[r1, c1] * x * y
+            )
+
+    return elevations
+
+def el_data(points=[], dem_dir=None):
+    """Retrieves elevation data from local DEM tiles.
+
+    Keyword arguments:
+    points -- List of (latitude, longitude) coordinates to retrieve elevation data at
+    dem_dir -- Directory containing DEM tiles (see dem_directory)
+    """
+    import pandas as pd
+
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    elevations = sample_elevation(points[:, 1], points[:, 0], dem_dir=dem_dir)
+    return pd.DataFrame({'lat' : points[:, 0], 'long' : points[:, 1], 'elevation' : elevations})
+
+def average_elevation(box, grid_size = 16, dem_dir=None):
+    """Computes mean elevation of all DEM cells over a bounding box.
+
+    Cells are read in blocks of BLOCK_SIZE, and edges shared by adjacent
+    tiles are counted once (see tile_index).
 
     Keyword arguments:
     box -- Dictionary representing box to retrieve elevation data over
-    grid_size -- Number of intervals used in each direction to approximate elevation
+    grid_size -- Unused, kept for compatibility with the point-grid approximation
+    dem_dir -- Directory containing DEM tiles (see dem_directory)
     """
-    # Restrict grid size to fit in API request
-    grid_size = min(grid_size, 16)
-    points = []
-    for lat in ut.intervals(box['ymin'], box['ymax'], grid_size):
-        for long in ut.intervals(box['xmin'], box['xmax'], grid_size):
-            points.append((lat, long))
-
-    params = {
-        'locations': "|".join([",".join(['%.4f' % point[0], '%.4f' % point[1]]) for point in points]),
-        'key': config.GOOGLE_API_KEY
-    }
-    print(params)
-    response = requests.get(BASE_ELEVATION_URL, params=params)
-    print(response.text)
-    data = response.json()
-
-    if 'results' not in data:
-        raise ValueError(data)
-
-    records = data['results']
-    elevations = [record['elevation'] for record in records]
-    print(sum(elevations) / len(elevations))
-    return sum(elevations) / len(elevations)
-
-def merge_el_data(df):
+    tiles = tile_index(dem_directory(dem_dir))
+    total = 0.0
+    count = 0
+    for tile in tiles:
+        if tile['xmax'] <= box['xmin'] or tile['xmin'] >= box['xmax'] or \
+                tile['ymax'] <= box['ymin'] or tile['ymin'] >= box['ymax']:
+            continue
+        a, _, c, _, e, f = tile['transform']
+        # Cells whose centers fall inside the box (tolerance absorbs rounding of box edges)
+        col0 = int(np.clip(np.ceil((box['xmin'] - c) / a - 0.5 - 1e-9), 0, tile['width'] - 1))
+        col1 = int(np.clip(np.floor((box['xmax'] - c) / a - 0.5 + 1e-9), 0, tile['own_cols'] - 1))
+        row0 = int(np.clip(np.ceil((box['ymax'] - f) / e - 0.5 - 1e-9), 0, tile['height'] - 1))
+        row1 = int(np.clip(np.floor((box['ymin'] - f) / e - 0.5 + 1e-9), 0, tile['own_rows'] - 1))
+        for top in range(row0, row1 + 1, BLOCK_SIZE):
+            for left in range(col0, col1 + 1, BLOCK_SIZE):
+                values = read_window(tile, top, min(top + BLOCK_SIZE - 1, row1),
+                                     left, min(left + BLOCK_SIZE - 1, col1))
+                total += np.nansum(values)
+                count += np.count_nonzero(~np.isnan(values))
+
+    if count == 0:
+        raise ValueError('No DEM data inside box %s' % box)
+    return total / count
+
+def merge_el_data(df, dem_dir=None):
     """Merges elevation data with snow depth observations data.
 
     Keyword arguments:
     df -- Dataframe of SNODAS data to add elevation data to
+    dem_dir -- Directory containing DEM tiles (see dem_directory)
     """
-    points = list(zip(df['latitude'], df['longitude']))
-    elevations = el_data(points)
-    return pd.merge(df, elevations)
+    df = df.copy()
+    df['elevation'] = sample_elevation(df['longitude'], df['latitude'], dem_dir=dem_dir)
+    return df
@@ -2,14 +2,62 @@ import re
 import os
 import tarfile
 import gzip
-from datetime import datetime, timedelta
+import warnings
+from collections import deque
+from contextlib import ExitStack
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, FIRST_COMPLETED, wait
+from datetime import datetime
 from io import BytesIO
-from osgeo import gdal, gdal_array, osr
 
 import numpy as np
-import xarray as xr
+import validation.metrics as metrics
 import validation.utils as ut
 
+# Factors converting stored SNODAS integers to physical units
+# (meters for depths and fluxes, kg/m^2 for precipitation, K for temperature)
+PRODUCT_SCALES = {
+    1025 : 0.1,
+    1034 : 0.001,
+    1036 : 0.001,
+    1038 : 1.0,
+    1039 : 0.00001,
+    1044 : 0.00001,
+    1050 : 0.00001
+}
+
+# File names of SNODAS products after the us_/zz_ssmv prefix, as strftime
+# formats. 1025 is solid precipitation; liquid precipitation (SlL00)
+# shares its product code.
+PRODUCT_FILES = {
+    1025 : '0%%iSlL01T0024TTNATS%Y%m%d05DP001',
+    1034 : '1%%itS__T0001TTNATS%Y%m%d05HP001',
+    1036 : '1%%itS__T0001TTNATS%Y%m%d05HP001',
+    1038 : '1%%iwS__A0024TTNATS%Y%m%d05DP001',
+    1039 : '1%%ilL00T0024TTNATS%Y%m%d05DP000',
+    1044 : '1%%ibS__T0024TTNATS%Y%m%d05DP000',
+    1050 : '1%%ilL00T0024TTNATS%Y%m%d05DP000'
+}
+
+# Expected grids by file name prefix, used to locate a window in .dat
+# files that come before their header in the archive. Extents shifted by
+# a fraction of a cell over the years, so these are refined by the header.
+SNODAS_GRIDS = {
+    'us' : {
+        'rows' : 3351,
+        'cols' : 6935,
+        'dtype' : np.dtype('>i2'),
+        'nodata' : -9999.0,
+        'transform' : (1 / 120, 0.0, -124.733749999998, 0.0, -1 / 120, 52.8745833333323)
+    },
+    'zz' : {
+        'rows' : 4096,
+        'cols' : 8192,
+        'dtype' : np.dtype('>i2'),
+        'nodata' : -9999.0,
+        'transform' : (1 / 120, 0.0, -130.516666666661, 0.0, -1 / 120, 58.2333333333310)
+    }
+}
+
 def snodas_url(date):
     """Get url of SNODAS data for given date.
 
@@ -22,26 +70,36 @@ def snodas_url(date):
         return date.strftime('ftp://sidads.colorado.edu/DATASETS/NOAA/G02158/unmasked/%Y/%m_%b/SNODAS_unmasked_%Y%m%d.tar')
 
 
-def snodas_file_format(date):
+def snodas_file_format(date, code=None):
     """Get format string for gzipped SNODAS files for given date.
 
     Keyword arguments:
     date -- Date to fetch SNODAS data for
+    code -- SNODAS product code, for products not named like snow depth (default None)
     """
+    name = PRODUCT_FILES[code] if code is not None else PRODUCT_FILES[1036]
     if date >= datetime(2003,9,30) and date < datetime(2010,1,1):
-        return date.strftime('us_ssmv1%%itS__T0001TTNATS%Y%m%d05HP001.%%s.gz')
+        return date.strftime('us_ssmv' + name + '.%%s.gz')
     elif date >= datetime(2010,1,1):
-        return date.strftime('zz_ssmv1%%itS__T0001TTNATS%Y%m%d05HP001.%%s.gz')
+        return date.strftime('zz_ssmv' + name + '.%%s.gz')
 
+def snodas_masked(date):
+    """Check whether SNODAS data for given date comes from the masked archive.
+
+    Keyword arguments:
+    date -- Date to fetch SNODAS data for
+    """
+    return date < datetime(2010,1,1)
 
 
 # Remove lines longer than 256 characters from header (GDAL requirement)
 def clean_header(hdr):
     """Remove lines longer than 256 characters from header (GDAL requirement)."""
     new_hdr = BytesIO()
-    for line in hdr:
-        if len(line) <= 256:
-            new_hdr.write(line)
+    with metrics.span('SNODAS.clean_header'):
+        for line in hdr:
+            if len(line) <= 256:
+                new_hdr.write(line)
 
     # Cleanup
     new_hdr.write(b'')
@@ -61,58 +119,677 @@ def clean_paths(paths, tar):
         new_paths.append(path)
     return new_paths
 
-def tar_to_snodas(tar, gz_format, code=1036):
+def tar_members(tar, paths):
+    """Find members of tar in a single forward pass.
+
+    Works with tar objects opened in stream mode ('r|'), where members
+    can only be read in archive order. Members that are not requested are
+    skipped without being kept, and the archive is not read past the last
+    requested member.
+
+    Keyword arguments:
+    tar -- tar object
+    paths -- Paths of files to find in archive
+
+    Yields:
+    (path, file object) tuples in archive order
+    """
+    remaining = set(paths)
+    for member in tar:
+        # Some paths in tar file have ./ preceeding, some do not
+        name = member.name[2:] if member.name.startswith('./') else member.name
+        if name not in remaining:
+            continue
+        remaining.discard(name)
+        yield name, tar.extractfile(member)
+        if not remaining:
+            break
+
+    if remaining:
+        raise KeyError('Files not found in archive: %s' % ', '.join(sorted(remaining)))
+
+def gunzip_to_vsimem(file, vsi_path, chunk_size=1048576):
+    """Decompress gzipped file into GDAL virtual file in chunks.
+
+    Keyword arguments:
+    file -- Gzipped file object
+    vsi_path -- Path of virtual file to write
+    chunk_size -- Number of decompressed bytes written at a time
+    """
+    from osgeo import gdal
+
+    gz_file = gzip.GzipFile(fileobj=file, mode='r')
+    vsi_file = gdal.VSIFOpenL(vsi_path, 'wb')
+    try:
+        with metrics.span('SNODAS.gunzip', file='dat') as span:
+            while True:
+                chunk = gz_file.read(chunk_size)
+                if not chunk:
+                    break
+                gdal.VSIFWriteL(chunk, 1, len(chunk), vsi_file)
+                span.add('bytes_out', len(chunk))
+    finally:
+        gdal.VSIFCloseL(vsi_file)
+        gz_file.close()
+
+def parse_header(hdr):
+    """Parse SNODAS header into dictionary of fields.
+
+    Keyword arguments:
+    hdr -- Iterable of header lines (bytes)
+    """
+    header = {}
+    for line in hdr:
+        key, sep, value = line.decode('latin-1').partition(':')
+        if sep:
+            header[key.strip()] = value.strip()
+    return header
+
+def header_grid(header):
+    """Get grid geometry from parsed SNODAS header.
+
+    Keyword arguments:
+    header -- Dictionary returned by parse_header
+
+    Returns:
+    Dictionary with rows, cols, dtype, nodata and (a, b, c, d, e, f) affine transform
+    """
+    rows = int(header['Number of rows'])
+    cols = int(header['Number of columns'])
+    xmin = float(header['Minimum x-axis coordinate'])
+    xmax = float(header['Maximum x-axis coordinate'])
+    ymin = float(header['Minimum y-axis coordinate'])
+    ymax = float(header['Maximum y-axis coordinate'])
+    nbytes = int(header.get('Data bytes per pixel', 2))
+    return {
+        'rows' : rows,
+        'cols' : cols,
+        # SNODAS grids are big-endian signed integers
+        'dtype' : np.dtype('>i%d' % nbytes),
+        'nodata' : float(header.get('No data value', -9999)),
+        'transform' : ((xmax - xmin) / cols, 0.0, xmin, 0.0, -(ymax - ymin) / rows, ymax)
+    }
+
+def grid_to_snodas(values, grid):
+    """Wrap SNODAS values in xarray dataset with the layout of xr.open_rasterio.
+
+    Keyword arguments:
+    values -- 2D array of grid values
+    grid -- Dictionary returned by header_grid
+    """
+    import xarray as xr
+
+    a, _, c, _, e, f = grid['transform']
+    rows, cols = values.shape
+    return xr.DataArray(
+        values[np.newaxis],
+        dims=('band', 'y', 'x'),
+        coords={
+            'band' : [1],
+            'y' : f + e * (np.arange(rows) + 0.5),
+            'x' : c + a * (np.arange(cols) + 0.5)
+        },
+        attrs={
+            'transform' : grid['transform'],
+            'crs' : '+init=epsg:4326',
+            'res' : (a, -e),
+            'is_tiled' : 0,
+            'nodatavals' : (grid['nodata'],),
+            'scales' : (1.0,),
+            'offsets' : (0.0,),
+            'AREA_OR_POINT' : 'Area'
+        }
+    )
+
+def dat_to_snodas(data, header):
+    """Convert raw SNODAS .dat bytes to xarray dataset without copying.
+
+    Keyword arguments:
+    data -- Bytes-like object with decompressed .dat contents
+    header -- Dictionary returned by parse_header
+    """
+    grid = header_grid(header)
+    values = np.frombuffer(data, dtype=grid['dtype'], count=grid['rows'] * grid['cols'])
+    return grid_to_snodas(values.reshape(grid['rows'], grid['cols']), grid)
+
+def read_snodas(dat_path, hdr_path):
+    """Read uncompressed SNODAS .dat/.txt pair as memory-mapped xarray dataset.
+
+    Keyword arguments:
+    dat_path -- Path of uncompressed .dat file
+    hdr_path -- Path of uncompressed .txt header file
+    """
+    with open(hdr_path, 'rb') as hdr:
+        grid = header_grid(parse_header(hdr))
+    values = np.memmap(dat_path, dtype=grid['dtype'], mode='r', shape=(grid['rows'], grid['cols']))
+    return grid_to_snodas(values, grid)
+
+def gunzip_into(gz_file, buffer):
+    """Decompress gzipped file directly into preallocated buffer.
+
+    Keyword arguments:
+    gz_file -- GzipFile to read from
+    buffer -- Writable buffer to fill
+    """
+    view = memoryview(buffer).cast('B')
+    filled = 0
+    while filled < len(view):
+        n = gz_file.readinto(view[filled:])
+        if not n:
+            raise EOFError('SNODAS data ended after %d of %d bytes' % (filled, len(view)))
+        filled += n
+    return buffer
+
+def bbox_window(grid, bbox, margin=0):
+    """Get rows and columns of grid cells touching a bounding box.
+
+    Keyword arguments:
+    grid -- Dictionary returned by header_grid
+    bbox -- (xmin, ymin, xmax, ymax) in longitude and latitude
+    margin -- Number of extra cells on each side (default 0)
+
+    Returns:
+    (first row, end row, first column, end column) tuple, ends exclusive
+    """
+    a, _, c, _, e, f = grid['transform']
+    xmin, ymin, xmax, ymax = bbox
+    col0 = max(int(np.floor((xmin - c) / a)) - margin, 0)
+    col1 = min(int(np.ceil((xmax - c) / a)) + margin, grid['cols'])
+    row0 = max(int(np.floor((ymax - f) / e)) - margin, 0)
+    row1 = min(int(np.ceil((ymin - f) / e)) + margin, grid['rows'])
+    if col1 <= col0 or row1 <= row0:
+        raise ValueError('Bounding box %s does not intersect SNODAS grid' % (tuple(bbox),))
+    return row0, row1, col0, col1
+
+def window_grid(grid, window):
+    """Get grid geometry of a window.
+
+    Keyword arguments:
+    grid -- Dictionary returned by header_grid
+    window -- Tuple returned by bbox_window
+    """
+    row0, row1, col0, col1 = window
+    a, b, c, d, e, f = grid['transform']
+    return dict(grid, rows=row1 - row0, cols=col1 - col0,
+                transform=(a, b, c + col0 * a, d, e, f + row0 * e))
+
+def gunzip_window(gz_file, grid, window, block_rows=256):
+    """Decompress only the rows of a window from a gzipped .dat file.
+
+    Rows before the window are decompressed into a small scratch buffer
+    and dropped, and nothing past the last row of the window is read, so
+    memory use depends on the window rather than on the full grid.
+
+    Keyword arguments:
+    gz_file -- GzipFile to read from
+    grid -- Dictionary returned by header_grid
+    window -- Tuple returned by bbox_window
+    block_rows -- Number of rows decompressed at a time (default 256)
+
+    Returns:
+    2D array of window values
+    """
+    row0, row1, col0, col1 = window
+    row_bytes = grid['cols'] * grid['dtype'].itemsize
+    scratch = bytearray(block_rows * row_bytes)
+    view = memoryview(scratch)
+
+    skipped = 0
+    while skipped < row0:
+        n = min(block_rows, row0 - skipped)
+        gunzip_into(gz_file, view[:n * row_bytes])
+        skipped += n
+
+    values = np.empty((row1 - row0, col1 - col0), dtype=grid['dtype'])
+    for start in range(0, row1 - row0, block_rows):
+        n = min(block_rows, row1 - row0 - start)
+        gunzip_into(gz_file, view[:n * row_bytes])
+        rows = np.frombuffer(scratch, dtype=grid['dtype'], count=n * grid['cols']).reshape(n, grid['cols'])
+        values[start:start + n] = rows[:, col0:col1]
+    return values
+
+def crop_snodas(ds, bbox):
+    """Crop SNODAS dataset to the cells touching a bounding box.
+
+    Keyword arguments:
+    ds -- xarray dataset returned by snodas_ds
+    bbox -- (xmin, ymin, xmax, ymax) in longitude and latitude
+    """
+    grid = {'rows' : ds.sizes['y'], 'cols' : ds.sizes['x'], 'transform' : ds.attrs['transform']}
+    window = bbox_window(grid, bbox)
+    row0, row1, col0, col1 = window
+    cropped = ds.isel(y=slice(row0, row1), x=slice(col0, col1))
+    cropped.attrs['transform'] = window_grid(grid, window)['transform']
+    return cropped
+
+def decode_archive(tar, formats, bbox=None):
+    """Decode SNODAS products from an archive in a single forward pass.
+
+    Each .dat is decompressed straight into the array backing its dataset;
+    when its header comes first in the archive, that array is allocated up
+    front. With a bbox, only the rows covering it are decompressed, and no
+    .dat is decompressed past its last row (see gunzip_window). A .dat
+    before its header is windowed with the expected grid plus a one cell
+    margin, then cropped once the header is read.
+
+    Keyword arguments:
+    tar -- tar object, may be opened in stream mode
+    formats -- Dictionary of product code to format for its gzipped files
+    bbox -- (xmin, ymin, xmax, ymax) in longitude and latitude to decode (default None, full grid)
+
+    Returns:
+    Dictionary of xarray datasets keyed by product code
+    """
+    members = {}
+    for code, gz_format in formats.items():
+        for extension in ['dat', 'txt']:
+            members[gz_format % (code, extension)] = (code, extension)
+    headers = {}
+    data = {}
+    windows = {}
+    expected = {}
+
+    for path, file in tar_members(tar, list(members)):
+        code, extension = members[path]
+        header = headers.get(code)
+        gz_file = gzip.GzipFile(fileobj=file, mode='r')
+        with metrics.span('SNODAS.gunzip', file=extension) as span:
+            if extension == 'txt':
+                headers[code] = parse_header(gz_file)
+            elif bbox is not None:
+                if header is not None:
+                    grid = header_grid(header)
+                    windows[code] = bbox_window(grid, bbox)
+                else:
+                    grid = expected[code] = SNODAS_GRIDS[os.path.basename(formats[code])[:2]]
+                    windows[code] = bbox_window(grid, bbox, margin=1)
+                data[code] = gunzip_window(gz_file, grid, windows[code])
+                # Every row up to the end of the window is decompressed
+                span.add('bytes_out', windows[code][1] * grid['cols'] * grid['dtype'].itemsize)
+            elif header is not None:
+                grid = header_grid(header)
+                data[code] = gunzip_into(gz_file, bytearray(grid['rows'] * grid['cols'] * grid['dtype'].itemsize))
+                span.add('bytes_out', len(data[code]))
+            else:
+                data[code] = gz_file.read()
+                span.add('bytes_out', len(data[code]))
+        gz_file.close()
+    tar.close()
+
+    grids = {}
+    with metrics.span('SNODAS.to_xarray'):
+        for code in formats:
+            if bbox is None:
+                grids[code] = dat_to_snodas(data[code], headers[code])
+                continue
+            grid = header_grid(headers[code])
+            window = windows[code]
+            exact = bbox_window(grid, bbox)
+            values = data[code]
+            if window != exact:
+                # The window was located with the expected grid, before the header was read
+                inside = exact[0] >= window[0] and exact[1] <= window[1] and \
+                    exact[2] >= window[2] and exact[3] <= window[3]
+                if (grid['rows'], grid['cols']) != (expected[code]['rows'], expected[code]['cols']) or not inside:
+                    raise ValueError('SNODAS grid of product %d does not match expected grid' % code)
+                values = values[exact[0] - window[0]:exact[1] - window[0], exact[2] - window[2]:exact[3] - window[2]]
+            grids[code] = grid_to_snodas(values, window_grid(grid, exact))
+    return grids
+
+def tar_to_snodas(tar, gz_format, code=1036, engine='numpy', bbox=None):
     """Converts snodas tar archive to xarray dataset.
 
+    The archive is read in a single forward pass, so tar may be opened in
+    stream mode (see utils.url_to_tar). See decode_archive for how the
+    numpy engine decodes and windows grids.
+
     Keyword arguments:
     tar -- tar object
     gz_format -- format for gzipped files in archive
     code -- SNODAS product code (default 1036 [Snow Depth])
+    engine -- Decoder to use, 'numpy' or 'gdal' (default 'numpy')
+    bbox -- (xmin, ymin, xmax, ymax) in longitude and latitude to decode (default None, full grid)
 
     Returns:
     xarray dataset
     """
+    if engine not in ['numpy', 'gdal']:
+        raise ValueError('Unknown SNODAS engine: %s' % engine)
+
+    with metrics.span('SNODAS.tar_to_snodas', code=code, engine=engine):
+        if engine == 'gdal':
+            ds = tar_to_snodas_gdal(tar, gz_format, code=code)
+            return ds if bbox is None else crop_snodas(ds, bbox)
+        return decode_archive(tar, {code : gz_format}, bbox=bbox)[code]
+
+def tar_to_products(tar, date, codes, bbox=None):
+    """Decode several SNODAS products from one pass over an archive.
+
+    Keyword arguments:
+    tar -- tar object, may be opened in stream mode
+    date -- Date of archive
+    codes -- SNODAS product codes to decode
+    bbox -- (xmin, ymin, xmax, ymax) in longitude and latitude to decode (default None, full grid)
+
+    Returns:
+    Dictionary of xarray datasets keyed by product code
+    """
+    with metrics.span('SNODAS.tar_to_products', codes=','.join(str(code) for code in codes)):
+        return decode_archive(tar, {code : snodas_file_format(date, code) for code in codes}, bbox=bbox)
+
+def products_dataset(grids):
+    """Combine SNODAS product grids into one dataset of physical values.
+
+    Each product becomes a float32 variable snodas_<code>, scaled by
+    PRODUCT_SCALES and with nodata as NaN, on the shared y/x coordinates.
+
+    Keyword arguments:
+    grids -- Dictionary of xarray datasets keyed by product code, e.g. from tar_to_products
+    """
+    import xarray as xr
+
+    first = next(iter(grids.values()))
+    data_vars = {}
+    for code, da in grids.items():
+        if tuple(da.attrs['transform']) != tuple(first.attrs['transform']) or da.shape != first.shape:
+            raise ValueError('SNODAS product %d is on a different grid' % code)
+        values = da.values.reshape(da.shape[-2:])
+        scaled = values.astype(np.float32)
+        scaled *= np.float32(PRODUCT_SCALES.get(code, 1.0))
+        scaled[values == da.attrs['nodatavals'][0]] = np.nan
+        data_vars['snodas_%d' % code] = (('y', 'x'), scaled, {'product_code' : code})
+    return xr.Dataset(
+        data_vars,
+        coords={'y' : first['y'].values, 'x' : first['x'].values},
+        attrs={key : first.attrs[key] for key in ['transform', 'crs', 'res'] if key in first.attrs}
+    )
+
+def tar_to_snodas_gdal(tar, gz_format, code=1036):
+    """Converts snodas tar archive to xarray dataset using GDAL.
+
+    The archive is read in a single forward pass, so tar may be opened in
+    stream mode (see utils.url_to_tar).
+
+    Keyword arguments:
+    tar -- tar object
+    gz_format -- format for gzipped files in archive
+    code -- SNODAS product code (default 1036 [Snow Depth])
+
+    Returns:
+    xarray dataset with the attributes of the numpy engine
+    """
+    import rioxarray
+    from osgeo import gdal
 
     extensions = ['dat', 'txt']
     # Untar and extract files
     gz_paths = [gz_format % (code, extension) for extension in extensions]
-    vsi_paths = ['/vsimem/' + path[:-3] for path in gz_paths]
-
-    # Some paths in tar file have ./ preceeding, some do not
-    # Use clean_tar_paths to find and use correct paths
-    gz_paths = clean_paths(gz_paths, tar)
-
-    gz_files = [tar.extractfile(path) for path in gz_paths]
-    dat_file, hdr_file = [gzip.GzipFile(fileobj=file, mode='r') for file in gz_files]
+    vsi_paths = {path : '/vsimem/' + path[:-3] for path in gz_paths}
+    dat_path, hdr_path = gz_paths
 
-    # Read data into buffers
-    hdr_file = clean_header(hdr_file)
-    dat = dat_file.read()
-    hdr = hdr_file.read()
+    # Decompress straight into virtual files, without intermediate buffers
+    for path, file in tar_members(tar, gz_paths):
+        if path == dat_path:
+            gunzip_to_vsimem(file, vsi_paths[path])
+        else:
+            hdr_file = clean_header(gzip.GzipFile(fileobj=file, mode='r'))
+            gdal.FileFromMemBuffer(vsi_paths[path], hdr_file.read())
+            hdr_file.close()
 
-    # Convert to GDAL Dataset
-    gdal.FileFromMemBuffer(vsi_paths[0], dat)
-    gdal.FileFromMemBuffer(vsi_paths[1], hdr)
-#    ds = gdal.Open(vsi_paths[1])
-    ds = xr.open_rasterio(vsi_paths[1])
+    # Read through GDAL into memory, since the virtual files are removed below
+    with metrics.span('SNODAS.gdal_decode'):
+        ds = rioxarray.open_rasterio(vsi_paths[hdr_path], mask_and_scale=False).load()
+    a, b, c, d, e, f = tuple(ds.rio.transform())[:6]
+    ds.attrs.update({
+        'transform' : (a, b, c, d, e, f),
+        'crs' : '+init=epsg:4326',
+        'res' : (a, -e),
+        'nodatavals' : (ds.rio.nodata,)
+    })
 
     # Close / Unlink Virtual Files
     tar.close()
-    dat_file.close()
-    hdr_file.close()
-    gdal.Unlink(vsi_paths[0])
-    gdal.Unlink(vsi_paths[1])
+    gdal.Unlink(vsi_paths[dat_path])
+    gdal.Unlink(vsi_paths[hdr_path])
 
     return ds
 
-def snodas_ds(date, code=1036):
-    """Get SNODAS data as GDAL dataset for specific date.
+def snodas_ds(date, code=1036, cache=None, bbox=None, codes=None):
+    """Get SNODAS data as xarray dataset for specific date.
+
+    With a bbox only that window is decoded (see decode_archive), and the
+    download stops once it is complete. Cached grids are cropped to the
+    bbox; windows are not added to the cache.
+
+    With codes, all products are extracted from a single download and
+    decode pass and returned as one dataset of physical values (see
+    products_dataset). Products found in the cache are not decoded again.
 
     Keyword arguments:
     date -- datetime object
     code -- integer specifying SNODAS product (default 1036 [Snow Depth])
+    cache -- SnodasCache to read grids from and store them in (default None)
+    bbox -- (xmin, ymin, xmax, ymax) in longitude and latitude (default None, full grid)
+    codes -- List of SNODAS product codes to return as one dataset (default None, code only)
+
+    Returns:
+    xarray DataArray of stored values for code, or with codes an xarray
+    Dataset of physical values with one variable per product
+    """
+    masked = snodas_masked(date)
+    products = [code] if codes is None else list(codes)
+    with metrics.span('SNODAS.snodas_ds', codes=','.join(str(c) for c in products)) as span:
+        grids = {}
+        for c in products:
+            ds = cache.get(date, masked, c) if cache is not None else None
+            if ds is not None:
+                span.add('cache_hits', 1)
+                grids[c] = ds if bbox is None else crop_snodas(ds, bbox)
+
+        missing = [c for c in products if c not in grids]
+        if missing:
+            with ut.stream_tar(snodas_url(date)) as tar:
+                decoded = tar_to_products(tar, date, missing, bbox=bbox)
+            if cache is not None and bbox is None:
+                for c, ds in decoded.items():
+                    cache.put(date, masked, c, ds)
+            grids.update(decoded)
+
+        if codes is None:
+            return grids[code]
+        return products_dataset({c : grids[c] for c in products})
+
+def decode_snodas(data, date, codes, bbox=None):
+    """Decode SNODAS products from raw tar bytes in a single pass.
+
+    Runs in worker processes, so grids are loaded into memory before being
+    returned.
+
+    Keyword arguments:
+    data -- Bytes of SNODAS tar archive
+    date -- Date of archive
+    codes -- List of SNODAS product codes to decode
+    bbox -- (xmin, ymin, xmax, ymax) in longitude and latitude to decode (default None, full grid)
+
+    Returns:
+    Dictionary of xarray datasets keyed by product code
+    """
+    tar = tarfile.open(fileobj=BytesIO(data), mode='r|')
+    grids = tar_to_products(tar, date, codes, bbox=bbox)
+    return {code : grid.load() for code, grid in grids.items()}
+
+def snodas_range(start, end, codes=(1036,), **kwargs):
+    """Fetch SNODAS data for a range of dates concurrently.
+
+    Keyword arguments:
+    start -- First date to fetch
+    end -- Last date to fetch (inclusive)
+    codes -- SNODAS product codes to fetch (default (1036,) [Snow Depth])
+    kwargs -- Additional arguments passed to snodas_dates
+
+    Yields:
+    (date, grids) tuples, where grids is a dictionary of xarray datasets keyed by product code
+    """
+    import pandas as pd
+
+    return snodas_dates(pd.date_range(start, end, freq='D'), codes=codes, **kwargs)
+
+def snodas_dates(dates, codes=(1036,), cache=None, downloads=4, decoders=None,
+                 max_in_flight=8, attempts=3, backoff=2.0, skip_errors=False, dataset=False,
+                 io_pool=None, cpu_pool=None):
+    """Fetch SNODAS data for a sequence of dates concurrently.
+
+    Archives are downloaded on a thread pool and decoded on a process pool.
+    At most max_in_flight archives are held in memory between download and
+    decoding. Results are yielded as soon as each date completes, so they do
+    not arrive in date order.
+
+    Keyword arguments:
+    dates -- Dates to fetch
+    codes -- SNODAS product codes to fetch (default (1036,) [Snow Depth])
+    cache -- SnodasCache to read grids from and store them in (default None)
+    downloads -- Number of concurrent downloads (default 4)
+    decoders -- Number of decoding processes (default number of CPUs)
+    max_in_flight -- Maximum number of archives downloading or awaiting decoding (default 8)
+    attempts -- Maximum download attempts per date (default 3)
+    backoff -- Seconds to wait after first failed attempt, doubled after each retry
+    skip_errors -- Warn and skip dates that fail instead of raising (default False)
+    dataset -- Yield each date's products as one dataset (see products_dataset) (default False)
+    io_pool -- Thread pool to download on, kept open for reuse (default new pool of downloads threads)
+    cpu_pool -- Process pool to decode on, kept open for reuse (default new pool of decoders processes)
+
+    All products of a date are decoded in a single pass over its archive.
+    Downloads are reported to metrics sinks; decoding happens in worker
+    processes, whose spans are only reported to sinks registered there.
+
+    Yields:
+    (date, grids) tuples, where grids is a dictionary of xarray datasets keyed by product code
+    """
+    import pandas as pd
+
+    codes = list(codes)
+    queue = deque()
+    for date in dates:
+        date = pd.Timestamp(date).to_pydatetime()
+        if cache is not None:
+            grids = {code : cache.get(date, snodas_masked(date), code) for code in codes}
+            if all(grid is not None for grid in grids.values()):
+                yield date, products_dataset(grids) if dataset else grids
+                continue
+        queue.append(date)
+
+    with ExitStack() as pools:
+        if io_pool is None:
+            io_pool = pools.enter_context(ThreadPoolExecutor(downloads))
+        if cpu_pool is None:
+            cpu_pool = pools.enter_context(ProcessPoolExecutor(decoders))
+        # Each date in flight has exactly one pending future (download or decode)
+        pending = {}
+        while queue or pending:
+            while queue and len(pending) < max_in_flight:
+                date = queue.popleft()
+                download = io_pool.submit(ut.retry, ut.url_to_io, snodas_url(date),
+                                          attempts=attempts, backoff=backoff)
+                pending[download] = ('download', date)
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage, date = pending.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    if not skip_errors:
+                        for other in pending:
+                            other.cancel()
+                        raise
+                    warnings.warn('Failed to fetch SNODAS data for %s: %s' % (date.strftime('%Y-%m-%d'), e))
+                    continue
+
+                if stage == 'download':
+                    decode = cpu_pool.submit(decode_snodas, result.getvalue(), date, codes)
+                    pending[decode] = ('decode', date)
+                else:
+                    if cache is not None:
+                        for code, grid in result.items():
+                            cache.put(date, snodas_masked(date), code, grid)
+                    yield date, products_dataset(result) if dataset else result
+
+def product_dates(results, code=1036):
+    """Select one product from the results of snodas_dates or snodas_range.
+
+    Keyword arguments:
+    results -- Iterable of (date, grids) tuples, grids keyed by product code or combined by products_dataset
+    code -- SNODAS product code to select (default 1036 [Snow Depth])
+
+    Yields:
+    (date, DataArray) tuples, e.g. to save with utils.save_dates
+    """
+    import xarray as xr
+
+    for date, grids in results:
+        if isinstance(grids, xr.Dataset):
+            yield date, grids['snodas_%d' % code]
+        else:
+            yield date, grids[code]
+
+def sample_grid(ds, x, y, scale=1.0):
+    """Sample SNODAS grid at points.
+
+    Keyword arguments:
+    ds -- xarray dataset returned by snodas_ds
+    x -- Array of longitudes
+    y -- Array of latitudes
+    scale -- Factor applied to sampled values (default 1.0)
+
+    Returns:
+    Array of sampled values, NaN for nodata and points outside the grid
+    """
+    grid = ds.values
+    if grid.ndim == 3:
+        grid = grid[0]
+    rows, cols, valid = ut.grid_indices(x, y, ds.attrs['transform'], grid.shape)
+
+    values = grid[rows, cols].astype(np.float64)
+    nodata = ds.attrs.get('nodatavals', (None,))[0]
+    if nodata is not None:
+        values[values == nodata] = np.nan
+    values[~valid] = np.nan
+    return values * scale
+
+def sample_points(obs, code=1036, cache=None, scale=None):
+    """Sample SNODAS data for each observation.
+
+    Each day is fetched once, whatever the times of its observations, and
+    all of its observations are gathered with a single array index.
+
+    Keyword arguments:
+    obs -- Dataframe with latitude, longitude and date columns
+    code -- integer specifying SNODAS product (default 1036 [Snow Depth])
+    cache -- SnodasCache to read grids from and store them in (default None)
+    scale -- Factor applied to sampled values (default PRODUCT_SCALES[code])
+
+    Returns:
+    Series of sampled values aligned with obs
     """
-    url = snodas_url(date)
-    gz_format = snodas_file_format(date)
-    tar = ut.url_to_tar(url)
-    return tar_to_snodas(tar, gz_format, code=code)
+    import pandas as pd
+
+    if scale is None:
+        scale = PRODUCT_SCALES.get(code, 1.0)
+
+    lons = obs['longitude'].to_numpy(dtype=np.float64)
+    lats = obs['latitude'].to_numpy(dtype=np.float64)
+    # SNODAS grids are daily, so observations are grouped by day rather than by timestamp
+    dates = pd.to_datetime(obs['date']).dt.normalize().to_numpy()
+    values = np.full(len(obs), np.nan)
+
+    # Group observation positions by date without a Python-level groupby
+    unique_dates, inverse = np.unique(dates, return_inverse=True)
+    order = np.argsort(inverse, kind='stable')
+    bounds = np.searchsorted(inverse[order], np.arange(len(unique_dates) + 1))
+
+    for i, date in enumerate(unique_dates):
+        idx = order[bounds[i]:bounds[i + 1]]
+        ds = snodas_ds(pd.Timestamp(date).to_pydatetime(), code=code, cache=cache)
+        values[idx] = sample_grid(ds, lons[idx], lats[idx], scale=scale)
+
+    return pd.Series(values, index=obs.index, name='snodas_%d' % code)
@@ -5,4 +5,19 @@ from __future__ import (division,
                         print_function,
                         unicode_literals)
 
-__all__ = ['SNODAS']
+import importlib
+
+__all__ = ['CSNOW', 'SNODAS', 'archive', 'cache', 'cli', 'climatology', 'composite', 'cube', 'jobs', 'matchups',
+           'metrics', 'observations', 'qaqc', 'raster', 'rasterize', 'regrid', 'stats']
+
+# Submodules are imported on first access, so importing the package only
+# loads what is used
+SUBMODULES = __all__ + ['Elevation', 'creds', 'utils']
+
+def __getattr__(name):
+    if name in SUBMODULES:
+        return importlib.import_module('.' + name, __name__)
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
+
+def __dir__():
+    return sorted(set(globals()) | set(SUBMODULES))
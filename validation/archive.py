@@ -0,0 +1,356 @@
+import os
+import glob
+import json
+import zlib
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+from xarray.backends import BackendArray
+from xarray.core import indexing
+import validation.utils as ut
+
+# Name of index file written in archive directories
+INDEX_FILE = '_index.npz'
+
+# HDF5 and netCDF bookkeeping attributes left out of the index
+INTERNAL_ATTRS = ['DIMENSION_LIST', 'REFERENCE_LIST', 'CLASS', 'NAME', '_Netcdf4Dimid',
+                  '_Netcdf4Coordinates', '_nc3_strict', '_NCProperties']
+
+def json_value(value):
+    """Convert attribute value to a JSON serializable value."""
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+    if isinstance(value, np.ndarray):
+        return [json_value(v) for v in value.tolist()]
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+def variable_attrs(var):
+    """Get attributes of netCDF4 variable or dataset, without bookkeeping attributes."""
+    return {name : json_value(var.getncattr(name)) for name in var.ncattrs() if name not in INTERNAL_ATTRS}
+
+def file_times(nc, path):
+    """Get days since 1970-01-01 of the time steps of a netCDF file.
+
+    Times are read from the time variable, or parsed from the file name
+    (see utils.date_from_file) for 2D files.
+    """
+    import netCDF4
+
+    if 'time' in nc.variables and 'time' in nc.dimensions:
+        time = nc.variables['time']
+        dates = netCDF4.num2date(time[:], time.units, getattr(time, 'calendar', 'standard'),
+                                 only_use_cftime_datetimes=False, only_use_python_datetimes=True)
+        dates = pd.DatetimeIndex([pd.Timestamp(str(date)) for date in np.atleast_1d(dates)])
+    else:
+        dates = pd.DatetimeIndex([ut.date_from_file(os.path.basename(path))])
+    return ((dates - pd.Timestamp('1970-01-01')) / pd.Timedelta(days=1)).to_numpy(dtype=np.float64)
+
+def scan_file(path):
+    """Read layout of a daily netCDF4 file without reading its data.
+
+    Grid variables are those with the two trailing dimensions of the
+    largest variable, and either no other dimension or a leading time
+    dimension chunked one step at a time. Their chunk byte ranges are
+    read from the HDF5 chunk index. Other variables, such as coordinates
+    and grid mappings, are read whole.
+
+    Keyword arguments:
+    path -- Path of netCDF4 file
+
+    Returns:
+    Dictionary with template (metadata shared by files of an archive),
+    times, and offsets and sizes arrays of shape (steps, chunk rows,
+    chunk columns) per grid variable, sizes being 0 for unwritten chunks
+    """
+    import h5py
+    import netCDF4
+
+    nc = netCDF4.Dataset(path)
+    h5 = h5py.File(path, 'r')
+    try:
+        largest = max(nc.variables.values(), key=lambda v: (v.ndim >= 2, v.size))
+        if largest.ndim < 2:
+            raise ValueError('No grid variables in %s' % path)
+        grid_dims = list(largest.dimensions[-2:])
+        times = file_times(nc, path)
+        template = {'attrs' : variable_attrs(nc), 'grid_dims' : grid_dims,
+                    'shape' : [len(nc.dimensions[dim]) for dim in grid_dims], 'variables' : {}, 'static' : {}}
+        offsets = {}
+        sizes = {}
+        static = {}
+        for name, var in nc.variables.items():
+            dims = list(var.dimensions)
+            if dims[-2:] != grid_dims or dims[:-2] not in ([], ['time']):
+                if 'time' not in dims:
+                    var.set_auto_maskandscale(False)
+                    static[name] = np.asarray(var[:])
+                    template['static'][name] = {'dims' : dims, 'attrs' : variable_attrs(var)}
+                continue
+            ds = h5[name]
+            if ds.chunks is None:
+                raise ValueError('Variable %s of %s is not chunked' % (name, path))
+            if ds.fletcher32 or ds.scaleoffset is not None or ds.compression not in (None, 'gzip'):
+                raise ValueError('Unsupported HDF5 filters on %s of %s' % (name, path))
+            if len(dims) == 3 and ds.chunks[0] != 1:
+                raise ValueError('Time chunks of %s in %s are not one step' % (name, path))
+            chunks = list(ds.chunks[-2:])
+            template['variables'][name] = {
+                'dtype' : ds.dtype.str,
+                'chunks' : chunks,
+                'shuffle' : bool(ds.shuffle),
+                'compression' : ds.compression,
+                'attrs' : variable_attrs(var)
+            }
+            steps = len(times) if len(dims) == 3 else 1
+            grid = (steps, -(-template['shape'][0] // chunks[0]), -(-template['shape'][1] // chunks[1]))
+            offsets[name] = np.zeros(grid, dtype=np.int64)
+            sizes[name] = np.zeros(grid, dtype=np.int64)
+            for i in range(ds.id.get_num_chunks()):
+                info = ds.id.get_chunk_info(i)
+                if info.filter_mask:
+                    raise ValueError('Chunk of %s in %s skips filters' % (name, path))
+                index = (info.chunk_offset[0] if len(dims) == 3 else 0,
+                         info.chunk_offset[-2] // chunks[0], info.chunk_offset[-1] // chunks[1])
+                offsets[name][index] = info.byte_offset
+                sizes[name][index] = info.size
+    finally:
+        h5.close()
+        nc.close()
+    return {'template' : template, 'static' : static, 'times' : times, 'offsets' : offsets, 'sizes' : sizes}
+
+def read_index(path):
+    """Read archive index, or None if it does not exist.
+
+    Keyword arguments:
+    path -- Path of index file
+
+    Returns:
+    Dictionary with template, files (list of name, size, mtime and number
+    of steps), static arrays, times and offsets and sizes arrays per
+    variable, all with one entry per step in time order
+    """
+    if not os.path.exists(path):
+        return None
+    with np.load(path, allow_pickle=False) as npz:
+        meta = json.loads(npz['meta'].tobytes().decode('utf-8'))
+        index = {
+            'template' : meta['template'],
+            'files' : meta['files'],
+            'times' : npz['times'],
+            'step_files' : npz['step_files'],
+            'static' : {name : npz['static_' + name] for name in meta['template']['static']},
+            'offsets' : {name : npz['offsets_' + name] for name in meta['template']['variables']},
+            'sizes' : {name : npz['sizes_' + name] for name in meta['template']['variables']}
+        }
+    return index
+
+def write_index(path, index):
+    """Write archive index atomically.
+
+    Keyword arguments:
+    path -- Path of index file
+    index -- Dictionary as returned by read_index
+    """
+    meta = json.dumps({'template' : index['template'], 'files' : index['files']})
+    arrays = {'meta' : np.frombuffer(meta.encode('utf-8'), dtype=np.uint8),
+              'times' : index['times'], 'step_files' : index['step_files']}
+    for name, values in index['static'].items():
+        arrays['static_' + name] = values
+    for name in index['template']['variables']:
+        arrays['offsets_' + name] = index['offsets'][name]
+        arrays['sizes_' + name] = index['sizes'][name]
+    # np.savez appends .npz to names without it
+    tmp_path = path + '.tmp.npz'
+    np.savez(tmp_path, **arrays)
+    os.replace(tmp_path, path)
+
+def check_template(template, expected, path):
+    """Check that file has the same grid variables and layout as the archive."""
+    def layout(template):
+        variables = {name : {key : info[key] for key in ['dtype', 'chunks', 'shuffle', 'compression']}
+                     for name, info in template['variables'].items()}
+        return template['grid_dims'], template['shape'], variables
+    if layout(template) != layout(expected):
+        raise ValueError('Layout of %s differs from the archive index' % path)
+
+def update_index(archive_dir, pattern='*.nc', index_path=None):
+    """Build or update the reference index of a directory of daily netCDF4 files.
+
+    Only files that are new or changed since the index was written are
+    scanned, and only their metadata and HDF5 chunk indexes are read.
+    Removed files are dropped from the index. All files must share
+    grid variables, shape and chunk layout, as files written by
+    utils.save_netcdf or C-SNOW SD_%Y%m%d.nc files do.
+
+    Keyword arguments:
+    archive_dir -- Directory of netCDF4 files
+    pattern -- Glob pattern of files to index (default '*.nc')
+    index_path -- Path of index file (default INDEX_FILE in archive_dir)
+
+    Returns:
+    Dictionary as returned by read_index
+    """
+    archive_dir = os.path.abspath(archive_dir)
+    index_path = index_path or os.path.join(archive_dir, INDEX_FILE)
+    old = read_index(index_path)
+
+    # Steps of files kept from the old index, keyed by file name
+    kept = {}
+    if old is not None:
+        for i, entry in enumerate(old['files']):
+            steps = np.flatnonzero(old['step_files'] == i)
+            kept[entry['name']] = (entry, {
+                'times' : old['times'][steps],
+                'offsets' : {name : values[steps] for name, values in old['offsets'].items()},
+                'sizes' : {name : values[steps] for name, values in old['sizes'].items()}
+            })
+
+    template = old['template'] if old is not None else None
+    static = old['static'] if old is not None else {}
+    files = {}
+    for path in sorted(glob.glob(os.path.join(archive_dir, pattern))):
+        name = os.path.relpath(path, archive_dir)
+        stat = os.stat(path)
+        entry = {'name' : name, 'size' : stat.st_size, 'mtime' : stat.st_mtime_ns}
+        previous = kept.get(name)
+        if previous is not None and previous[0]['size'] == entry['size'] and previous[0]['mtime'] == entry['mtime']:
+            files[name] = previous
+            continue
+        scanned = scan_file(path)
+        if template is None:
+            template = scanned['template']
+            static = scanned['static']
+        else:
+            check_template(scanned['template'], template, path)
+        entry['steps'] = len(scanned['times'])
+        files[name] = (entry, scanned)
+    if template is None:
+        raise ValueError('No files matching %s in %s' % (pattern, archive_dir))
+
+    ordered = sorted(files.values(), key=lambda item: (item[1]['times'][0], item[0]['name']))
+    index = {
+        'template' : template,
+        'files' : [entry for entry, _ in ordered],
+        'times' : np.concatenate([steps['times'] for _, steps in ordered]),
+        'step_files' : np.concatenate([np.full(len(steps['times']), i, dtype=np.int32)
+                                       for i, (_, steps) in enumerate(ordered)]),
+        'static' : static,
+        'offsets' : {name : np.concatenate([steps['offsets'][name] for _, steps in ordered])
+                     for name in template['variables']},
+        'sizes' : {name : np.concatenate([steps['sizes'][name] for _, steps in ordered])
+                   for name in template['variables']}
+    }
+    write_index(index_path, index)
+    return index
+
+class IndexedArray(BackendArray):
+    """Lazy array of a grid variable, reading chunks through the archive index.
+
+    Keyword arguments:
+    root -- Archive directory
+    index -- Dictionary as returned by read_index
+    name -- Name of variable
+    """
+
+    def __init__(self, root, index, name):
+        info = index['template']['variables'][name]
+        self.root = root
+        self.paths = [os.path.join(root, entry['name']) for entry in index['files']]
+        self.step_files = index['step_files']
+        self.offsets = index['offsets'][name]
+        self.sizes = index['sizes'][name]
+        self.chunks = tuple(info['chunks'])
+        self.compressed = info['compression'] == 'gzip'
+        self.shuffle = info['shuffle']
+        self.fill = info['attrs'].get('_FillValue', 0)
+        self.dtype = np.dtype(info['dtype'])
+        self.shape = (len(self.step_files),) + tuple(index['template']['shape'])
+
+    def __getitem__(self, key):
+        return indexing.explicit_indexing_adapter(key, self.shape, indexing.IndexingSupport.BASIC, self.read)
+
+    def read_chunk(self, f, step, i, j):
+        f.seek(int(self.offsets[step, i, j]))
+        data = f.read(int(self.sizes[step, i, j]))
+        if self.compressed:
+            data = zlib.decompress(data)
+        values = np.frombuffer(data, dtype=np.uint8)
+        if self.shuffle and self.dtype.itemsize > 1:
+            values = np.ascontiguousarray(values.reshape(self.dtype.itemsize, -1).T)
+        return values.view(self.dtype).reshape(self.chunks)
+
+    def read(self, key):
+        """Read a basic (integer and slice) selection."""
+        ranges = []
+        for k, size in zip(key, self.shape):
+            if isinstance(k, slice):
+                ranges.append(range(*k.indices(size)))
+            else:
+                ranges.append(range(int(k), int(k) + 1))
+        # Read the bounding window of each selected step, then apply steps of slices
+        bounds = [(min(r), max(r) + 1) if len(r) else (0, 0) for r in ranges[1:]]
+        (row0, row1), (col0, col1) = bounds
+        window = np.full((len(ranges[0]), row1 - row0, col1 - col0), self.fill, dtype=self.dtype)
+        ch, cw = self.chunks
+        files = {}
+        try:
+            for n, step in enumerate(ranges[0]):
+                path = self.paths[self.step_files[step]]
+                for i in range(row0 // ch, -(-row1 // ch)):
+                    for j in range(col0 // cw, -(-col1 // cw)):
+                        if not self.sizes[step, i, j]:
+                            continue
+                        if path not in files:
+                            files[path] = open(path, 'rb')
+                        chunk = self.read_chunk(files[path], step, i, j)
+                        r0, r1 = max(row0, i * ch), min(row1, (i + 1) * ch)
+                        c0, c1 = max(col0, j * cw), min(col1, (j + 1) * cw)
+                        window[n, r0 - row0:r1 - row0, c0 - col0:c1 - col0] = \
+                            chunk[r0 - i * ch:r1 - i * ch, c0 - j * cw:c1 - j * cw]
+        finally:
+            for f in files.values():
+                f.close()
+        window = window[:, ::ranges[1].step or 1, ::ranges[2].step or 1] if len(window) else window
+        squeeze = tuple(axis for axis, k in enumerate(key) if not isinstance(k, slice))
+        return window.squeeze(axis=squeeze) if squeeze else window
+
+def open_index(archive_dir, index_path=None, decode=True):
+    """Open an indexed archive as one lazy dataset along time.
+
+    Only the index is read; data chunks are read from the netCDF files
+    when values are accessed.
+
+    Keyword arguments:
+    archive_dir -- Directory of netCDF4 files
+    index_path -- Path of index file (default INDEX_FILE in archive_dir)
+    decode -- Whether to apply CF decoding, e.g. masking fill values (default True)
+
+    Returns:
+    xarray Dataset with time and grid dimensions
+    """
+    archive_dir = os.path.abspath(archive_dir)
+    index = read_index(index_path or os.path.join(archive_dir, INDEX_FILE))
+    if index is None:
+        raise ValueError('No index in %s; run update_index first' % archive_dir)
+    template = index['template']
+    dims = ('time',) + tuple(template['grid_dims'])
+    variables = {}
+    for name, info in template['variables'].items():
+        data = indexing.LazilyIndexedArray(IndexedArray(archive_dir, index, name))
+        variables[name] = xr.Variable(dims, data, attrs=info['attrs'])
+    grid_mappings = {info['attrs'].get('grid_mapping') for info in template['variables'].values()}
+    for name, info in template['static'].items():
+        values = index['static'][name]
+        attrs = info['attrs']
+        if name in grid_mappings and not info['dims']:
+            # Grid mappings only carry attributes; their value is never written, so it reads as the fill value
+            values = np.zeros((), dtype=values.dtype)
+            attrs = {key : value for key, value in attrs.items() if key not in ['_FillValue', 'missing_value']}
+        variables[name] = xr.Variable(info['dims'], values, attrs=attrs)
+    variables['time'] = xr.Variable(('time',), index['times'],
+                                    attrs={'units' : 'days since 1970-01-01', 'calendar' : 'standard'})
+    ds = xr.Dataset(variables, attrs=template['attrs'])
+    return xr.decode_cf(ds) if decode else ds
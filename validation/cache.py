@@ -0,0 +1,187 @@
+import os
+import json
+import zipfile
+import tempfile
+from contextlib import contextmanager
+
+import numpy as np
+import xarray as xr
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Default cache size limit (bytes)
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+
+class SnodasCache(object):
+    """Persistent on-disk cache of extracted SNODAS grids.
+
+    Grids are keyed by date, masked/unmasked archive and product code and
+    stored as compressed .npz files. When the total size of the cache goes
+    over max_bytes, least recently used entries are evicted. Writes are
+    atomic and eviction is guarded by a lock file, so several processes can
+    share one cache directory.
+
+    Keyword arguments:
+    path -- Directory to store cached grids in
+    max_bytes -- Size limit of the cache in bytes (default 2 GiB)
+    """
+
+    def __init__(self, path, max_bytes=DEFAULT_MAX_BYTES):
+        self.path = os.path.abspath(os.path.expanduser(path))
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(self.path, exist_ok=True)
+
+    def key(self, date, masked, code):
+        """Get file name of cache entry.
+
+        Keyword arguments:
+        date -- datetime object
+        masked -- Whether grid comes from the masked archive
+        code -- SNODAS product code
+        """
+        kind = 'masked' if masked else 'unmasked'
+        return date.strftime('SNODAS_%s_%d_%%Y%%m%%d.npz' % (kind, code))
+
+    def get(self, date, masked, code):
+        """Get cached grid, or None if it is not in the cache.
+
+        Keyword arguments:
+        date -- datetime object
+        masked -- Whether grid comes from the masked archive
+        code -- SNODAS product code
+        """
+        path = os.path.join(self.path, self.key(date, masked, code))
+        try:
+            with np.load(path, allow_pickle=False) as npz:
+                da = npz_to_dataarray(npz)
+            # Mark entry as recently used
+            os.utime(path)
+        except (FileNotFoundError, ValueError, OSError, EOFError, zipfile.BadZipFile):
+            # Entry missing, evicted by another process, or truncated
+            self.misses += 1
+            return None
+        self.hits += 1
+        return da
+
+    def put(self, date, masked, code, da):
+        """Store grid in the cache and evict old entries if needed.
+
+        Keyword arguments:
+        date -- datetime object
+        masked -- Whether grid comes from the masked archive
+        code -- SNODAS product code
+        da -- xarray DataArray to store
+        """
+        path = os.path.join(self.path, self.key(date, masked, code))
+        # Write to temporary file and rename so readers never see partial entries
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez_compressed(f, **dataarray_to_npz(da))
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self.evict()
+
+    def entries(self):
+        """List cache entries as (path, size, last access time) tuples."""
+        entries = []
+        for name in os.listdir(self.path):
+            if not name.endswith('.npz'):
+                continue
+            path = os.path.join(self.path, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((path, stat.st_size, stat.st_mtime))
+        return entries
+
+    def evict(self):
+        """Remove least recently used entries until cache fits in max_bytes."""
+        with self.lock():
+            entries = sorted(self.entries(), key=lambda entry: entry[2])
+            total = sum(entry[1] for entry in entries)
+            for path, size, _ in entries:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+                self.evictions += 1
+
+    def clear(self):
+        """Remove all entries from the cache."""
+        with self.lock():
+            for path, _, _ in self.entries():
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    def stats(self):
+        """Get cache counters and current size."""
+        entries = self.entries()
+        return {
+            'hits' : self.hits,
+            'misses' : self.misses,
+            'evictions' : self.evictions,
+            'entries' : len(entries),
+            'bytes' : sum(entry[1] for entry in entries),
+            'max_bytes' : self.max_bytes
+        }
+
+    @contextmanager
+    def lock(self):
+        """Hold exclusive lock on cache directory."""
+        with open(os.path.join(self.path, '.lock'), 'w') as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+def dataarray_to_npz(da):
+    """Convert DataArray to dictionary of arrays for np.savez.
+
+    Keyword arguments:
+    da -- xarray DataArray to convert
+    """
+    # numpy scalars and arrays in attrs are not JSON serializable
+    to_json = lambda obj: obj.tolist() if hasattr(obj, 'tolist') else list(obj)
+    arrays = {
+        'values' : da.values,
+        'dims' : np.array(da.dims),
+        'attrs' : np.array(json.dumps(da.attrs, default=to_json))
+    }
+    for dim in da.dims:
+        if dim in da.coords:
+            arrays['coord_' + dim] = da.coords[dim].values
+    return arrays
+
+def npz_to_dataarray(npz):
+    """Convert arrays loaded from np.load back to DataArray.
+
+    Keyword arguments:
+    npz -- NpzFile returned by np.load
+    """
+    dims = [str(dim) for dim in npz['dims']]
+    coords = {dim : npz['coord_' + dim] for dim in dims if 'coord_' + dim in npz.files}
+    # JSON turns tuples (transform, res, nodatavals) into lists
+    attrs = {
+        key : tuple(value) if isinstance(value, list) else value
+        for key, value in json.loads(str(npz['attrs'])).items()
+    }
+    return xr.DataArray(npz['values'], dims=dims, coords=coords, attrs=attrs)
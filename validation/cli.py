@@ -0,0 +1,71 @@
+import sys
+import logging
+import argparse
+
+# Commands import what they use, so --help and light commands start fast
+
+def run(args):
+    import validation.jobs as jobs
+    job = jobs.load_job(args.job)
+    failed = jobs.run_job(job, workers=args.workers, restart=args.restart)
+    return 1 if failed else 0
+
+def status(args):
+    import validation.jobs as jobs
+    job = jobs.load_job(args.job)
+    summary = jobs.job_status(job)
+    print('%s: %d of %d dates done, %d remaining' %
+          (job['name'], summary['done'], summary['total'], summary['remaining']))
+    return 0
+
+def ingest(args):
+    import validation.observations as observations
+    bbox = dict(zip(['xmin', 'ymin', 'xmax', 'ymax'], args.bbox)) if args.bbox else None
+    added = observations.ingest(args.store, since=args.since, bbox=bbox, workers=args.workers)
+    print('%s: %d observations added' % (args.store, added))
+    return 0
+
+def index(args):
+    import validation.archive as archive
+    result = archive.update_index(args.archive, pattern=args.pattern)
+    print('%s: %d files, %d days indexed' % (args.archive, len(result['files']), len(result['times'])))
+    return 0
+
+def parser():
+    """Build argument parser of the validation command."""
+    parser = argparse.ArgumentParser(prog='validation', description='Validate snow observations against gridded products.')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    run_parser = commands.add_parser('run', help='Run or resume a validation job')
+    run_parser.add_argument('job', help='Path of job spec JSON file')
+    run_parser.add_argument('--workers', type=int, default=None, help='Number of worker processes')
+    run_parser.add_argument('--restart', action='store_true', help='Discard progress and rerun all dates')
+    run_parser.set_defaults(func=run)
+
+    status_parser = commands.add_parser('status', help='Show progress of a validation job')
+    status_parser.add_argument('job', help='Path of job spec JSON file')
+    status_parser.set_defaults(func=status)
+
+    ingest_parser = commands.add_parser('ingest', help='Fetch new observations into an observation store')
+    ingest_parser.add_argument('store', help='Directory of observation store')
+    ingest_parser.add_argument('--since', default=None, help='Earliest date of observations for a new store')
+    ingest_parser.add_argument('--bbox', type=float, nargs=4, metavar=('XMIN', 'YMIN', 'XMAX', 'YMAX'),
+                               default=None, help='Bounds of observations for a new store')
+    ingest_parser.add_argument('--workers', type=int, default=4, help='Number of concurrent requests')
+    ingest_parser.set_defaults(func=ingest)
+
+    index_parser = commands.add_parser('index', help='Build or update the reference index of a NetCDF archive')
+    index_parser.add_argument('archive', help='Directory of daily NetCDF files')
+    index_parser.add_argument('--pattern', default='*.nc', help='Glob pattern of files to index')
+    index_parser.set_defaults(func=index)
+    return parser
+
+def main(argv=None):
+    """Entry point of the validation command."""
+    args = parser().parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    return args.func(args)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,303 @@
+import os
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+import validation.utils as ut
+import validation.SNODAS as SNODAS
+
+# Quantiles estimated for each day of year
+CLIMATOLOGY_QUANTILES = (0.25, 0.5, 0.75)
+
+class RunningMoments(object):
+    """Per-pixel count, mean and variance updated one grid at a time (Welford).
+
+    Keyword arguments:
+    shape -- Shape of grids
+    """
+
+    def __init__(self, shape):
+        self.count = np.zeros(shape, dtype=np.uint16)
+        self.mean = np.zeros(shape, dtype=np.float32)
+        self.m2 = np.zeros(shape, dtype=np.float32)
+
+    def update(self, values):
+        """Add grid to running moments. NaN pixels are skipped.
+
+        Keyword arguments:
+        values -- Grid of values
+        """
+        valid = ~np.isnan(values)
+        x = values[valid]
+        self.count[valid] += 1
+        delta = x - self.mean[valid]
+        mean = self.mean[valid] + delta / self.count[valid]
+        self.m2[valid] += delta * (x - mean)
+        self.mean[valid] = mean
+
+    def std(self):
+        """Get sample standard deviation (NaN where count < 2)."""
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.count > 1, np.sqrt(self.m2 / (self.count - 1.0)), np.nan)
+
+class DayStack(object):
+    """Stored values of one day of year across years, for exact per-pixel quantiles.
+
+    A climatology has one value per year for each pixel and day of year,
+    too few for streaming quantile estimates to be accurate, so values are
+    kept in their stored integer type and quantiles computed exactly once
+    all years are in.
+
+    Keyword arguments:
+    shape -- Shape of grids
+    years -- Maximum number of grids
+    dtype -- Type of stored values (default int16, as in SNODAS archives)
+    nodata -- Stored value of missing pixels (default -9999)
+    """
+
+    def __init__(self, shape, years, dtype=np.int16, nodata=-9999):
+        self.values = np.empty((years,) + tuple(shape), dtype=dtype)
+        self.nodata = nodata
+        self.n = 0
+
+    def update(self, values, nodata=None):
+        """Add grid of stored values.
+
+        Keyword arguments:
+        values -- Grid of stored values, NaN or nodata for missing pixels
+        nodata -- Missing value of grid (default nodata of stack)
+        """
+        missing = np.isnan(values) if values.dtype.kind == 'f' else np.zeros(values.shape, dtype=bool)
+        if nodata is not None and nodata != self.nodata:
+            missing |= values == nodata
+        layer = self.values[self.n]
+        layer[...] = np.where(missing, self.nodata, values)
+        self.n += 1
+
+    def quantiles(self, quantiles=CLIMATOLOGY_QUANTILES, scale=1.0, block_rows=256):
+        """Get exact quantiles per pixel, interpolated linearly as np.nanquantile does.
+
+        Rows are processed in blocks, so temporary arrays stay small.
+
+        Keyword arguments:
+        quantiles -- Quantiles to compute (default CLIMATOLOGY_QUANTILES)
+        scale -- Factor converting stored values to physical units (default 1.0)
+        block_rows -- Number of rows processed at a time (default 256)
+
+        Returns:
+        Array of shape (quantiles,) + grid shape, NaN where no year has a value
+        """
+        rows = self.values.shape[1]
+        result = np.full((len(quantiles),) + self.values.shape[1:], np.nan, dtype=np.float32)
+        for row0 in range(0, rows, block_rows):
+            block = self.values[:self.n, row0:row0 + block_rows].astype(np.float32)
+            block[block == self.nodata] = np.nan
+            # NaNs sort last, so the valid values of each pixel come first
+            block.sort(axis=0)
+            count = (~np.isnan(block)).sum(axis=0)
+            for i, q in enumerate(quantiles):
+                position = np.maximum(count - 1, 0) * q
+                low = np.floor(position).astype(np.intp)
+                high = np.minimum(low + 1, np.maximum(count - 1, 0))
+                lower = np.take_along_axis(block, low[np.newaxis], axis=0)[0]
+                upper = np.take_along_axis(block, high[np.newaxis], axis=0)[0]
+                values = lower + (upper - lower) * (position - low)
+                result[i, row0:row0 + block_rows] = np.where(count > 0, values * scale, np.nan)
+        return result
+
+def day_of_year(dates):
+    """Get day of year on a 366 day calendar, so dates after February 29 line up across years.
+
+    Keyword arguments:
+    dates -- DatetimeIndex or array of dates
+    """
+    dates = pd.DatetimeIndex(dates)
+    leap = dates.is_leap_year
+    doy = dates.dayofyear.to_numpy()
+    return np.where(~leap & (dates.month > 2), doy + 1, doy)
+
+def doy_dates(doy, start_year, end_year):
+    """Get dates falling on day of year (366 day calendar) in range of years.
+
+    Keyword arguments:
+    doy -- Day of year, 1 to 366
+    start_year -- First year
+    end_year -- Last year (inclusive)
+    """
+    # 2000 is a leap year, so every day of the 366 day calendar exists
+    reference = datetime(2000, 1, 1) + pd.Timedelta(days=int(doy) - 1)
+    dates = []
+    for year in range(start_year, end_year + 1):
+        try:
+            date = reference.replace(year=year)
+        except ValueError:
+            # February 29 in a non-leap year
+            continue
+        if date >= datetime(2003, 9, 30):
+            dates.append(date)
+    return dates
+
+def align_grid(ds, transform, shape):
+    """Sample SNODAS grid onto target grid using nearest cell centers.
+
+    Masked and unmasked SNODAS grids have different extents; this brings
+    both onto one climatology grid.
+
+    Keyword arguments:
+    ds -- xarray dataset returned by SNODAS.snodas_ds
+    transform -- Affine transform of target grid
+    shape -- Shape of target grid as (rows, columns)
+    """
+    a, _, c, _, e, f = transform[:6]
+    x = c + a * (np.arange(shape[1]) + 0.5)
+    y = f + e * (np.arange(shape[0]) + 0.5)
+    xx, yy = np.meshgrid(x, y)
+    return SNODAS.sample_grid(ds, xx.ravel(), yy.ravel()).reshape(shape)
+
+def build_climatology(store, start_year, end_year, code=1036, doys=None, transform=None,
+                      shape=None, quantiles=CLIMATOLOGY_QUANTILES, cache=None, **kwargs):
+    """Build day-of-year climatology rasters from SNODAS archive.
+
+    Each grid is fetched once and folded into running moments for its day
+    of year, and its stored values kept for exact quantiles (see
+    DayStack), so memory is bounded by one day of year's grids. Download
+    and decoding pools are shared by all days of year. Days of year
+    already in the store are skipped, so an interrupted build can be rerun
+    with the same arguments.
+
+    Keyword arguments:
+    store -- Path of zarr store to write climatology to
+    start_year -- First year of climatology
+    end_year -- Last year of climatology (inclusive)
+    code -- integer specifying SNODAS product (default 1036 [Snow Depth])
+    doys -- Days of year (366 day calendar) to build (default all)
+    transform -- Affine transform of climatology grid (default expected grid of the archive of start_year, see SNODAS.SNODAS_GRIDS)
+    shape -- Shape of climatology grid (default expected grid of the archive of start_year)
+    quantiles -- Quantiles to estimate (default CLIMATOLOGY_QUANTILES)
+    cache -- SnodasCache to read grids from and store them in (default None)
+    kwargs -- Additional arguments passed to SNODAS.snodas_dates, e.g. downloads and decoders
+
+    Returns:
+    Number of days of year written
+    """
+    scale = SNODAS.PRODUCT_SCALES.get(code, 1.0)
+    done = set()
+    if os.path.exists(store):
+        with xr.open_zarr(store) as existing:
+            done = set(existing['doy'].values.tolist())
+            transform = tuple(existing.attrs['transform'])
+            shape = existing['mean'].shape[1:]
+    if transform is None or shape is None:
+        # Masked and unmasked grids differ, so the grid is not taken from
+        # whichever date is fetched first
+        first = max(datetime(start_year, 1, 1), datetime(2003, 9, 30))
+        grid = SNODAS.SNODAS_GRIDS['us' if SNODAS.snodas_masked(first) else 'zz']
+        transform = tuple(transform or grid['transform'])
+        shape = tuple(shape or (grid['rows'], grid['cols']))
+    transform = tuple(transform[:6])
+    shape = tuple(shape)
+
+    written = 0
+    with ThreadPoolExecutor(kwargs.pop('downloads', 4)) as io_pool, \
+            ProcessPoolExecutor(kwargs.pop('decoders', None)) as cpu_pool:
+        for doy in range(1, 367) if doys is None else doys:
+            if doy in done:
+                continue
+            dates = doy_dates(doy, start_year, end_year)
+            moments = None
+            for date, grids in SNODAS.snodas_dates(dates, codes=[code], cache=cache, io_pool=io_pool,
+                                                   cpu_pool=cpu_pool, **kwargs):
+                ds = grids[code]
+                if moments is None:
+                    moments = RunningMoments(shape)
+                    stack = DayStack(shape, len(dates))
+                nodata = ds.attrs['nodatavals'][0]
+                if tuple(ds.attrs['transform'][:6]) == transform and ds.shape[-2:] == shape:
+                    stored = ds.values[0]
+                else:
+                    # Stored values on the climatology grid, NaN for nodata
+                    stored = align_grid(ds, transform, shape)
+                values = stored.astype(np.float32)
+                values[values == nodata] = np.nan
+                values *= scale
+                moments.update(values)
+                stack.update(stored, nodata=nodata)
+
+            if moments is None:
+                continue
+            write_doy(store, doy, moments, stack.quantiles(quantiles, scale=scale), quantiles, transform, code)
+            written += 1
+    return written
+
+def write_doy(store, doy, moments, quantile_values, quantiles, transform, code):
+    """Append one day of year to climatology store.
+
+    Keyword arguments:
+    store -- Path of zarr store
+    doy -- Day of year (366 day calendar)
+    moments -- RunningMoments for day of year
+    quantile_values -- Array of quantiles per pixel, e.g. from DayStack.quantiles
+    quantiles -- Quantiles of quantile_values
+    transform -- Affine transform of climatology grid
+    code -- SNODAS product code
+    """
+    rows, cols = moments.mean.shape
+    a, _, c, _, e, f = transform[:6]
+    data = {
+        'count' : moments.count,
+        'mean' : np.where(moments.count > 0, moments.mean, np.nan).astype(np.float32),
+        'std' : moments.std().astype(np.float32)
+    }
+    for q, values in zip(quantiles, quantile_values):
+        data['q%02d' % round(q * 100)] = values.astype(np.float32)
+
+    ds = xr.Dataset(
+        {name : (('doy', 'y', 'x'), values[np.newaxis]) for name, values in data.items()},
+        coords={
+            'doy' : [doy],
+            'y' : f + e * (np.arange(rows) + 0.5),
+            'x' : c + a * (np.arange(cols) + 0.5)
+        },
+        attrs={
+            'transform' : [float(v) for v in transform[:6]],
+            'code' : code,
+            'quantiles' : list(quantiles)
+        }
+    )
+    if os.path.exists(store):
+        ds.to_zarr(store, append_dim='doy')
+    else:
+        ds.to_zarr(store, mode='w', encoding={name : {'chunks' : (1, 256, 256)} for name in data})
+
+def sample_climatology(store, obs, stat='q50'):
+    """Look up climatology statistic for each observation.
+
+    Keyword arguments:
+    store -- Path of zarr store written by build_climatology
+    obs -- Dataframe with latitude, longitude and date columns
+    stat -- Statistic to look up: count, mean, std or qNN (default 'q50')
+
+    Returns:
+    Series of climatology values aligned with obs
+    """
+    values = np.full(len(obs), np.nan)
+    with xr.open_zarr(store) as ds:
+        da = ds[stat]
+        doys = ds['doy'].values
+        lookup = np.full(367, -1)
+        lookup[doys] = np.arange(len(doys))
+
+        index = lookup[day_of_year(pd.to_datetime(obs['date']))]
+        rows, cols, valid = ut.grid_indices(obs['longitude'], obs['latitude'],
+                                            ds.attrs['transform'], da.shape[1:])
+        valid &= index >= 0
+        if valid.any():
+            points = da.isel(
+                doy=xr.DataArray(index[valid], dims='points'),
+                y=xr.DataArray(rows[valid], dims='points'),
+                x=xr.DataArray(cols[valid], dims='points'))
+            values[valid] = points.values
+
+    return pd.Series(values, index=obs.index, name='snodas_%s' % stat)
@@ -0,0 +1,131 @@
+import tempfile
+import warnings
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+# Percentiles emitted for each bin besides the median
+COMPOSITE_QUANTILES = (0.25, 0.75)
+
+def grid_values(da):
+    """Get 2D float32 values of a daily grid, with nodata as NaN.
+
+    Accepts SNODAS.snodas_ds output (band, y, x) as well as C-SNOW grids
+    with or without a length-one time dimension.
+
+    Keyword arguments:
+    da -- xarray DataArray of one day
+    """
+    for dim in ['band', 'time']:
+        if dim in da.dims:
+            da = da.isel({dim : 0})
+    values = da.values.astype(np.float32)
+    nodata = da.attrs.get('nodatavals', (None,))[0]
+    if nodata is not None:
+        values[values == nodata] = np.nan
+    return da, values
+
+def close_bin(stack, start, template, quantiles):
+    """Compute composite statistics for a closed bin.
+
+    Keyword arguments:
+    stack -- Array of shape (days, rows, columns) with NaN for missing days
+    start -- Start date of bin
+    template -- 2D DataArray whose dimensions and coordinates are used for the output
+    quantiles -- Percentiles to compute besides the median
+    """
+    count = (~np.isnan(stack)).sum(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        total = np.nansum(stack, axis=0)
+        mean = np.where(count > 0, total / np.maximum(count, 1), np.nan)
+    # nanquantile warns on all-NaN pixels, which are expected (e.g. ocean)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        values = np.nanquantile(stack, (0.5,) + tuple(quantiles), axis=0)
+
+    data = {
+        'median' : values[0],
+        'mean' : mean,
+        'count' : count
+    }
+    for q, percentile in zip(quantiles, values[1:]):
+        data['p%02d' % round(q * 100)] = percentile
+
+    dims = ('time',) + template.dims
+    coords = {dim : template[dim] for dim in template.dims if dim in template.coords}
+    coords['time'] = [pd.Timestamp(start)]
+    return xr.Dataset(
+        {name : (dims, value.astype(np.int16 if name == 'count' else np.float32)[np.newaxis])
+         for name, value in data.items()},
+        coords=coords,
+        attrs={key : value for key, value in template.attrs.items() if key != 'nodatavals'}
+    )
+
+def composite(grids, freq='10D', origin=None, quantiles=COMPOSITE_QUANTILES, spill_dir=None):
+    """Compute temporal composites from a stream of daily grids.
+
+    Grids are consumed one at a time, and each bin is emitted as soon as a
+    grid from a later bin arrives. Only the current bin's days are held,
+    in memory or in a memory-mapped file under spill_dir, so memory
+    depends on bin length times grid size rather than on the whole period.
+    Bins are labelled by start date, like xr.Dataset.resample.
+
+    Keyword arguments:
+    grids -- Iterable of (date, DataArray) in date order, e.g. from SNODAS.snodas_ds or C-SNOW stores
+    freq -- Fixed bin length, a whole number of days (default '10D')
+    origin -- Start of first bin (default date of first grid)
+    quantiles -- Percentiles to compute besides the median (default COMPOSITE_QUANTILES)
+    spill_dir -- Directory to keep bin state in as memory-mapped files (default None, in memory)
+
+    Yields:
+    xarray Dataset per bin with median, mean, count and pNN variables
+    """
+    freq = pd.to_timedelta(freq)
+    days = freq.days
+    if days < 1 or freq != pd.Timedelta(days=days):
+        raise ValueError('Bin length must be a whole number of days: %s' % freq)
+
+    stack = None
+    start = None
+    template = None
+    spill = None
+    try:
+        for date, da in grids:
+            date = pd.Timestamp(date).normalize()
+            if origin is None:
+                origin = date
+            origin = pd.Timestamp(origin).normalize()
+            bin_start = origin + ((date - origin) // freq) * freq
+
+            if start is not None and bin_start < start:
+                raise ValueError('Grids must be in date order: %s after bin starting %s' %
+                                 (date.date(), start.date()))
+            if start is not None and bin_start > start:
+                yield close_bin(stack, start, template, quantiles)
+                start = None
+
+            template, values = grid_values(da)
+            if start is None:
+                start = bin_start
+                shape = (days,) + values.shape
+                if stack is None or stack.shape != shape:
+                    if spill is not None:
+                        # The grid changed; drop the previous bin's file before making a new one
+                        stack = None
+                        spill.close()
+                        spill = None
+                    if spill_dir is not None:
+                        spill = tempfile.NamedTemporaryFile(dir=spill_dir, suffix='.dat')
+                        stack = np.memmap(spill, dtype=np.float32, mode='w+', shape=shape)
+                    else:
+                        stack = np.empty(shape, dtype=np.float32)
+                stack[:] = np.nan
+            stack[(date - start).days] = values
+
+        if start is not None:
+            yield close_bin(stack, start, template, quantiles)
+    finally:
+        if spill is not None:
+            del stack
+            spill.close()
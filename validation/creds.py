@@ -8,22 +8,60 @@ from __future__ import (division,
 import os
 import json
 
+# Parsed configuration file and the modification time it was read at
+_config = {'path' : None, 'mtime' : None, 'data' : {}}
+
+def config_path():
+    """Get path of the configuration file, ~/.csoconfig.json."""
+    return os.path.join(os.environ.get('HOME'), '.csoconfig.json')
+
+# Keys stored in the configuration file
+CREDENTIAL_KEYS = ['google_key', 'dem_dir', 'raster_backend']
 
 def set_credential(**kwargs):
-    google_creds = kwargs.get('google_key', '')
+    """Store credentials and settings in the configuration file.
+
+    Given keys are merged into the existing file, which is written
+    atomically; other keys are kept.
+
+    Keyword arguments:
+    google_key -- Google API key
+    dem_dir -- Directory of DEM tiles (see Elevation.dem_directory)
+    raster_backend -- Raster backend, one of raster.RASTER_BACKENDS (see raster.backend)
+    """
+    unknown = [key for key in kwargs if key not in CREDENTIAL_KEYS]
+    if unknown:
+        raise ValueError('Unknown credentials %s; use %s' % (', '.join(unknown), ', '.join(CREDENTIAL_KEYS)))
+    if kwargs.get('raster_backend'):
+        import validation.raster as raster
+        if kwargs['raster_backend'] not in raster.RASTER_BACKENDS:
+            raise ValueError('Unknown raster backend %s; use one of %s' %
+                             (kwargs['raster_backend'], ', '.join(raster.RASTER_BACKENDS)))
+
+    configfile = config_path()
+    data = dict(load_config(), **kwargs)
+    with open(configfile + '.tmp', 'w') as f:
+        f.write(json.dumps(data))
+    os.replace(configfile + '.tmp', configfile)
+    _config.update(path=configfile, mtime=os.stat(configfile).st_mtime_ns, data=data)
+
+def load_config():
+    """Get contents of the configuration file, or an empty dictionary if there is none.
 
-    home_dir = os.environ.get('HOME')
-    configfile = os.path.join(home_dir, '.csoconfig.json')
-    if not os.path.exists(configfile):
-        with open(configfile, 'w') as f:
-            f.write(json.dumps({'google_key': google_creds}))
+    The file is parsed once and read again only when it changes, so
+    credentials can be looked up in loops without touching the disk
+    beyond a stat call.
+    """
+    configfile = config_path()
+    try:
+        mtime = os.stat(configfile).st_mtime_ns
+    except OSError:
+        return {}
+    if _config['path'] != configfile or _config['mtime'] != mtime:
+        with open(configfile) as f:
+            data = json.load(f)
+        _config.update(path=configfile, mtime=mtime, data=data)
+    return _config['data']
 
 def get_credential(key):
-    home_dir = os.environ.get('HOME')
-    configfile = os.path.join(home_dir, '.csoconfig.json')
-    if not os.path.exists(configfile):
-        return None
-    else:
-        data=open(configfile).read()
-        json_data = json.loads(data)
-        return json_data.get('google_key')
+    return load_config().get(key)
@@ -0,0 +1,160 @@
+import os
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+import validation.utils as ut
+import validation.SNODAS as SNODAS
+
+# Default chunking of (time, y, x), for point series: a multi-year series
+# reads one chunk per 32 days. A map of one day decompresses the 32 days of
+# its chunk row, so cubes mostly read as daily maps should use chunks=(1, 256, 256).
+CUBE_CHUNKS = (32, 256, 256)
+
+def cube_dates(store):
+    """Get dates already written to cube.
+
+    Keyword arguments:
+    store -- Path of zarr store
+
+    Returns:
+    Set of pandas Timestamps (empty if store does not exist)
+    """
+    if not os.path.exists(store):
+        return set()
+    with xr.open_zarr(store) as ds:
+        return set(pd.DatetimeIndex(ds['time'].values))
+
+def grid_dataset(da, date, code=1036):
+    """Convert SNODAS grid to single-day dataset ready for writing to cube.
+
+    Keyword arguments:
+    da -- xarray dataset returned by SNODAS.snodas_ds
+    date -- Date of grid
+    code -- SNODAS product code of grid (default 1036 [Snow Depth])
+    """
+    if 'band' in da.dims:
+        da = da.isel(band=0, drop=True)
+    da = da.expand_dims(time=[pd.Timestamp(date)])
+    attrs = {
+        'transform' : [float(v) for v in da.attrs['transform'][:6]],
+        'crs' : str(da.attrs.get('crs', '')),
+        'scale' : SNODAS.PRODUCT_SCALES.get(code, 1.0)
+    }
+    da.attrs = attrs
+    return da.to_dataset(name='snodas_%d' % code)
+
+def cube_append(store, da, date, code=1036, chunks=CUBE_CHUNKS, overwrite=False):
+    """Append one day of SNODAS data to chunked zarr cube.
+
+    Writing a date that is already in the cube does nothing unless
+    overwrite is set, in which case its slice is rewritten in place. Dates
+    may be written in any order. Masked and unmasked SNODAS grids have
+    different extents and must go into separate cubes.
+
+    Keyword arguments:
+    store -- Path of zarr store
+    da -- xarray dataset returned by SNODAS.snodas_ds
+    date -- Date of grid
+    code -- SNODAS product code of grid (default 1036 [Snow Depth])
+    chunks -- Chunk sizes along (time, y, x) (default CUBE_CHUNKS)
+    overwrite -- Whether to rewrite dates already in the cube (default False)
+
+    Returns:
+    True if data was written
+    """
+    ds = grid_dataset(da, date, code=code)
+    name = 'snodas_%d' % code
+    nodata = da.attrs.get('nodatavals', (None,))[0]
+
+    if not os.path.exists(store):
+        encoding = {name : {'chunks' : chunks}}
+        if nodata is not None:
+            encoding[name]['_FillValue'] = ds[name].dtype.type(nodata)
+        ds.to_zarr(store, mode='w', encoding=encoding)
+        return True
+
+    with xr.open_zarr(store) as existing:
+        if existing[name].shape[1:] != ds[name].shape[1:]:
+            raise ValueError('Grid shape %s does not match cube shape %s' %
+                             (ds[name].shape[1:], existing[name].shape[1:]))
+        times = pd.DatetimeIndex(existing['time'].values)
+
+    if pd.Timestamp(date) in times:
+        if not overwrite:
+            return False
+        index = times.get_loc(pd.Timestamp(date))
+        ds.drop_vars(['x', 'y']).to_zarr(store, region={'time' : slice(index, index + 1)})
+        return True
+
+    ds.to_zarr(store, append_dim='time')
+    return True
+
+def build_cube(store, start, end, code=1036, cache=None, **kwargs):
+    """Build or resume zarr cube of daily SNODAS grids.
+
+    Dates already in the cube are not fetched again, so an interrupted
+    build can be rerun with the same arguments.
+
+    Keyword arguments:
+    store -- Path of zarr store
+    start -- First date to add
+    end -- Last date to add (inclusive)
+    code -- integer specifying SNODAS product (default 1036 [Snow Depth])
+    cache -- SnodasCache to read grids from and store them in (default None)
+    kwargs -- Additional arguments passed to SNODAS.snodas_range
+
+    Returns:
+    Number of dates written
+    """
+    done = cube_dates(store)
+    written = 0
+    for first, last in date_runs(pd.date_range(start, end, freq='D').difference(done)):
+        for date, grids in SNODAS.snodas_range(first, last, codes=[code], cache=cache, **kwargs):
+            written += cube_append(store, grids[code], date, code=code)
+    return written
+
+def date_runs(dates):
+    """Split sorted dates into runs of consecutive days.
+
+    Keyword arguments:
+    dates -- Sorted DatetimeIndex
+
+    Yields:
+    (first, last) date tuples
+    """
+    if len(dates) == 0:
+        return
+    breaks = np.flatnonzero(np.diff(dates.values) != np.timedelta64(1, 'D'))
+    starts = np.concatenate([[0], breaks + 1])
+    ends = np.concatenate([breaks, [len(dates) - 1]])
+    for first, last in zip(starts, ends):
+        yield dates[first], dates[last]
+
+def point_series(store, lon, lat, code=1036, start=None, end=None):
+    """Read time series at a point from zarr cube.
+
+    Only the chunks containing the point are read.
+
+    Keyword arguments:
+    store -- Path of zarr store
+    lon -- Longitude of point
+    lat -- Latitude of point
+    code -- SNODAS product code stored in cube (default 1036 [Snow Depth])
+    start -- First date of series (default start of cube)
+    end -- Last date of series (default end of cube)
+
+    Returns:
+    Series of values in physical units indexed by date
+    """
+    name = 'snodas_%d' % code
+    with xr.open_zarr(store) as ds:
+        da = ds[name]
+        rows, cols, valid = ut.grid_indices([lon], [lat], da.attrs['transform'], da.shape[1:])
+        if not valid[0]:
+            raise ValueError('Point (%s, %s) is outside the cube grid' % (lon, lat))
+        series = da.isel(y=rows[0], x=cols[0]).load().to_series()
+
+    series = series.sort_index().loc[start:end] * da.attrs['scale']
+    series.name = name
+    return series
@@ -0,0 +1,314 @@
+import os
+import re
+import json
+import logging
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import validation.qaqc as qaqc
+
+logger = logging.getLogger(__name__)
+
+# Products a job can sample observations against
+JOB_PRODUCTS = re.compile(r'^(snodas_\d{4}|csnow|elevation)$')
+
+# Defaults for optional job spec fields
+JOB_DEFAULTS = {
+    'products' : ['snodas_1036'],
+    'cache' : None,
+    'csnow_store' : None,
+    'dem_dir' : None,
+    'workers' : None
+}
+
+def load_job(path):
+    """Read and check a job spec.
+
+    A job spec is a JSON file such as:
+
+        {
+            "name" : "alaska_wy2020",
+            "region" : {"xmin" : -170, "ymin" : 51, "xmax" : -130, "ymax" : 72},
+            "start" : "2019-10-01",
+            "end" : "2020-09-30",
+            "products" : ["snodas_1036", "csnow", "elevation"],
+            "observations" : "cso_data.csv",
+            "output" : "runs/alaska_wy2020"
+        }
+
+    Relative paths are resolved against the directory of the spec. Optional
+    fields are cache (SnodasCache directory), csnow_store (zarr store written
+    by CSNOW.ingest, required for csnow), dem_dir (see Elevation.dem_directory)
+    and workers (number of processes).
+
+    Keyword arguments:
+    path -- Path of job spec file
+
+    Returns:
+    Dictionary of job settings
+    """
+    with open(path) as f:
+        job = dict(JOB_DEFAULTS, **json.load(f))
+    missing = [key for key in ['name', 'region', 'start', 'end', 'observations', 'output'] if key not in job]
+    if missing:
+        raise ValueError('Job spec %s is missing %s' % (path, ', '.join(missing)))
+    unknown = [product for product in job['products'] if not JOB_PRODUCTS.match(product)]
+    if unknown:
+        raise ValueError('Unknown products in job spec %s: %s' % (path, ', '.join(unknown)))
+    if 'csnow' in job['products'] and not job['csnow_store']:
+        raise ValueError('Job spec %s samples csnow but has no csnow_store' % path)
+
+    here = os.path.dirname(os.path.abspath(path))
+    for key in ['observations', 'output', 'cache', 'csnow_store', 'dem_dir']:
+        if job[key]:
+            job[key] = os.path.join(here, os.path.expanduser(job[key]))
+    return job
+
+def normalize_observations(df):
+    """Add longitude, latitude and date columns to observations.
+
+    Coordinates are taken from longitude/latitude columns, lat/long columns
+    as in MountainHub exports, or parsed from a WKT point column as in CSO
+    database exports. Dates are UTC days of the timestamp column, given as
+    strings or milliseconds since the epoch; without a date or timestamp
+    column, no date is added.
+
+    Keyword arguments:
+    df -- Dataframe of observations
+    """
+    import pandas as pd
+
+    df = df.copy()
+    if 'longitude' not in df.columns and 'long' in df.columns:
+        df['longitude'] = df['long'].astype(np.float64)
+        df['latitude'] = df['lat'].astype(np.float64)
+    if 'longitude' not in df.columns and 'wkt_geom' in df.columns:
+        coords = df['wkt_geom'].str.extract(r'\(\s*(\S+)\s+(\S+)\s*\)').astype(np.float64)
+        df['longitude'] = coords[0]
+        df['latitude'] = coords[1]
+    if 'date' not in df.columns and 'timestamp' in df.columns:
+        timestamps = utc_timestamps(df['timestamp'])
+        df['date'] = timestamps.dt.tz_localize(None).dt.normalize()
+    else:
+        df['date'] = pd.to_datetime(df['date']).dt.normalize()
+    return df
+
+def utc_timestamps(timestamps):
+    """Parse timestamps as timezone-aware UTC datetimes.
+
+    Keyword arguments:
+    timestamps -- Series of date strings, datetimes or milliseconds since the epoch
+    """
+    import pandas as pd
+
+    if pd.api.types.is_numeric_dtype(timestamps):
+        return pd.to_datetime(timestamps, unit='ms', utc=True)
+    return pd.to_datetime(timestamps, utc=True)
+
+def job_observations(job):
+    """Read observations of a job inside its region and date range.
+
+    Keyword arguments:
+    job -- Dictionary returned by load_job
+    """
+    import pandas as pd
+
+    region = job['region']
+    start = pd.Timestamp(job['start'])
+    end = pd.Timestamp(job['end'])
+    chunks = []
+    for chunk in qaqc.read_chunks(job['observations']):
+        chunk = normalize_observations(chunk)
+        inside = (chunk['longitude'] >= region['xmin']) & (chunk['longitude'] <= region['xmax']) & \
+            (chunk['latitude'] >= region['ymin']) & (chunk['latitude'] <= region['ymax']) & \
+            (chunk['date'] >= start) & (chunk['date'] <= end)
+        chunks.append(chunk[inside])
+    if not chunks:
+        return pd.DataFrame(columns=['longitude', 'latitude', 'date'])
+    return pd.concat(chunks, ignore_index=True)
+
+def task_path(job, date):
+    """Get path of the matchup file written by a task.
+
+    Keyword arguments:
+    job -- Dictionary returned by load_job
+    date -- Date of task
+    """
+    import pandas as pd
+
+    return os.path.join(job['output'], 'matchups', '%s.parquet' % pd.Timestamp(date).strftime('%Y%m%d'))
+
+def manifest_path(job):
+    """Get path of the manifest of completed tasks.
+
+    Keyword arguments:
+    job -- Dictionary returned by load_job
+    """
+    return os.path.join(job['output'], 'manifest.jsonl')
+
+def read_manifest(job):
+    """Read manifest of completed tasks.
+
+    A partially written last line, left by a killed run, is ignored.
+
+    Keyword arguments:
+    job -- Dictionary returned by load_job
+
+    Returns:
+    Dictionary of date string to manifest record
+    """
+    path = manifest_path(job)
+    done = {}
+    if not os.path.exists(path):
+        return done
+    with open(path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            done[record['date']] = record
+    return done
+
+def record_task(job, record):
+    """Append completed task to manifest.
+
+    Keyword arguments:
+    job -- Dictionary returned by load_job
+    record -- Dictionary with at least a date key
+    """
+    path = manifest_path(job)
+    # A partial last line left by a killed run must not swallow the record
+    partial = False
+    if os.path.exists(path) and os.path.getsize(path):
+        with open(path, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            partial = f.read(1) != b'\n'
+    with open(path, 'a') as f:
+        f.write(('\n' if partial else '') + json.dumps(record) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+def sample_products(obs, date, products, cache=None, csnow_store=None, dem_dir=None):
+    """Sample products at observations of one date.
+
+    All SNODAS products are taken from a single download of the day's
+    archive (see SNODAS.snodas_ds).
+
+    Keyword arguments:
+    obs -- Dataframe of normalized observations on date
+    date -- Date of observations
+    products -- Products to sample, e.g. ['snodas_1036', 'csnow', 'elevation']
+    cache -- Directory of SnodasCache (default None)
+    csnow_store -- Path of zarr store written by CSNOW.ingest, for csnow (default None)
+    dem_dir -- Directory of DEM tiles, for elevation (see Elevation.dem_directory)
+
+    Returns:
+    Copy of obs with a column per product: snodas_<code>, csnow_snd and dem_elevation
+    """
+    import pandas as pd
+
+    lons = obs['longitude'].to_numpy(dtype=np.float64)
+    lats = obs['latitude'].to_numpy(dtype=np.float64)
+    out = obs.copy()
+    # Readers are imported here so workers only load those the job uses
+    codes = [int(product.split('_')[1]) for product in products if product.startswith('snodas_')]
+    if codes:
+        import validation.SNODAS as SNODAS
+        import validation.utils as ut
+        from validation.cache import SnodasCache
+        ds = SNODAS.snodas_ds(pd.Timestamp(date).to_pydatetime(), codes=codes,
+                              cache=SnodasCache(cache) if cache else None)
+        rows, cols, valid = ut.grid_indices(lons, lats, ds.attrs['transform'], (ds.sizes['y'], ds.sizes['x']))
+        for code in codes:
+            values = ds['snodas_%d' % code].values[rows, cols]
+            out['snodas_%d' % code] = np.where(valid, values, np.nan)
+    if 'csnow' in products:
+        import validation.CSNOW as CSNOW
+        out['csnow_snd'] = CSNOW.sample_store(csnow_store, date, lons, lats)
+    if 'elevation' in products:
+        import validation.Elevation as Elevation
+        out['dem_elevation'] = Elevation.sample_elevation(lons, lats, dem_dir=dem_dir)
+    return out
+
+def run_task(job, date, obs):
+    """Sample products for observations of one date and write matchup file.
+
+    Keyword arguments:
+    job -- Dictionary returned by load_job
+    date -- Date of observations
+    obs -- Dataframe of normalized observations on date
+
+    Returns:
+    Number of rows written
+    """
+    out = sample_products(obs, date, job['products'], cache=job['cache'],
+                          csnow_store=job['csnow_store'], dem_dir=job['dem_dir'])
+    path = task_path(job, date)
+    tmp_path = path + '.tmp'
+    out.to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, path)
+    return len(out)
+
+def run_job(job, workers=None, restart=False):
+    """Run job as per-date tasks on a process pool, resuming completed work.
+
+    Each completed task is appended to the manifest as soon as it finishes,
+    so a killed run picks up at the first unfinished date. Failed tasks are
+    reported and left out of the manifest, to be retried on the next run.
+
+    Keyword arguments:
+    job -- Dictionary returned by load_job
+    workers -- Number of processes (default job workers, then CPU count)
+    restart -- Discard manifest and rerun all tasks (default False)
+
+    Returns:
+    Dictionary of date string to error message for failed tasks
+    """
+    import pandas as pd
+
+    os.makedirs(os.path.join(job['output'], 'matchups'), exist_ok=True)
+    if restart and os.path.exists(manifest_path(job)):
+        os.remove(manifest_path(job))
+    done = read_manifest(job)
+
+    obs = job_observations(job)
+    # One pass over the observations splits them into per-date tasks
+    by_date = dict(iter(obs.groupby(obs['date'].dt.normalize(), sort=True)))
+    todo = [date for date in by_date if date.strftime('%Y-%m-%d') not in done]
+    logger.info('%s: %d dates, %d done, %d to run', job['name'], len(by_date), len(by_date) - len(todo), len(todo))
+
+    failed = {}
+    with ProcessPoolExecutor(max_workers=workers or job['workers']) as executor:
+        futures = {executor.submit(run_task, job, date, by_date[date]) : date for date in todo}
+        for i, future in enumerate(as_completed(futures)):
+            key = futures[future].strftime('%Y-%m-%d')
+            try:
+                rows = future.result()
+            except Exception:
+                failed[key] = traceback.format_exc()
+                logger.error('[%d/%d] %s failed:\n%s', i + 1, len(todo), key, failed[key])
+                continue
+            record_task(job, {
+                'date' : key,
+                'rows' : rows,
+                'path' : os.path.relpath(task_path(job, key), job['output']),
+                'finished' : pd.Timestamp.now('UTC').tz_localize(None).isoformat()
+            })
+            logger.info('[%d/%d] %s: %d observations', i + 1, len(todo), key, rows)
+    return failed
+
+def job_status(job):
+    """Summarize progress of a job.
+
+    Keyword arguments:
+    job -- Dictionary returned by load_job
+
+    Returns:
+    Dictionary with total, done and remaining task counts
+    """
+    done = read_manifest(job)
+    dates = job_observations(job)['date'].dt.strftime('%Y-%m-%d').unique()
+    finished = sum(1 for date in dates if date in done)
+    return {'total' : len(dates), 'done' : finished, 'remaining' : len(dates) - finished}
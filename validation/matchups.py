@@ -0,0 +1,353 @@
+import os
+import json
+import uuid
+
+import numpy as np
+import validation.jobs as jobs
+import validation.qaqc as qaqc
+
+# Columns the store is partitioned by, as water_year=<year>/region=<name> directories
+MATCHUP_PARTITIONS = ['water_year', 'region']
+
+# Region of observations outside all regions given to update_store
+OTHER_REGION = 'other'
+
+# Hidden file recording the files a compaction replaces, in each partition it compacts
+COMPACT_MANIFEST = '.compact.json'
+
+# Observation columns identifying an observation without an id column
+ID_COLUMNS = ['longitude', 'latitude', 'timestamp', 'date', 'author', 'source']
+
+def water_year(dates):
+    """Get water years (October to September, named after the year they end) of dates.
+
+    Keyword arguments:
+    dates -- Series or array of datetimes
+    """
+    import pandas as pd
+
+    dates = pd.DatetimeIndex(dates)
+    return np.where(dates.month >= 10, dates.year + 1, dates.year).astype(np.int32)
+
+def assign_regions(df, regions=None):
+    """Get region name of each observation.
+
+    Regions are tested in order and the first containing an observation
+    wins; observations outside all regions are assigned OTHER_REGION.
+
+    Keyword arguments:
+    df -- Dataframe of observations with longitude and latitude columns
+    regions -- Dictionary of name to {'xmin', 'ymin', 'xmax', 'ymax'} bounds (default None, all in OTHER_REGION)
+    """
+    names = np.full(len(df), OTHER_REGION, dtype=object)
+    unassigned = np.ones(len(df), dtype=bool)
+    lons = df['longitude'].to_numpy(dtype=np.float64)
+    lats = df['latitude'].to_numpy(dtype=np.float64)
+    for name, box in (regions or {}).items():
+        inside = unassigned & (lons >= box['xmin']) & (lons <= box['xmax']) & \
+            (lats >= box['ymin']) & (lats <= box['ymax'])
+        names[inside] = name
+        unassigned &= ~inside
+    return names
+
+def observation_ids(df):
+    """Get identifier of each observation as a string.
+
+    The id column is used when present, as in CSO database exports;
+    otherwise ids are hashes of the location, time, author and source.
+
+    Keyword arguments:
+    df -- Dataframe of normalized observations
+    """
+    import pandas as pd
+
+    if 'id' in df.columns:
+        return df['id'].astype(str).to_numpy(dtype=object)
+    columns = [column for column in ID_COLUMNS if column in df.columns]
+    hashes = pd.util.hash_pandas_object(df[columns], index=False).to_numpy()
+    return np.char.mod('%016x', hashes).astype(object)
+
+def compactions(store):
+    """Get compactions recorded in the manifests of a store.
+
+    Keyword arguments:
+    store -- Directory of store
+
+    Yields:
+    Tuples of manifest path, compacted file path and list of replaced file paths
+    """
+    for directory, _, names in os.walk(store):
+        if COMPACT_MANIFEST not in names:
+            continue
+        path = os.path.join(directory, COMPACT_MANIFEST)
+        with open(path) as f:
+            manifest = json.load(f)
+        yield (path, os.path.join(directory, manifest['compacted']),
+               [os.path.join(directory, name) for name in manifest['replaced']])
+
+def replaced_files(store):
+    """Get absolute paths of files replaced by a compacted file that is in place.
+
+    These are only left in a store by a compaction that stopped before
+    removing them.
+
+    Keyword arguments:
+    store -- Directory of store
+    """
+    replaced = set()
+    for _, compacted, files in compactions(store):
+        if os.path.exists(compacted):
+            replaced.update(os.path.abspath(path) for path in files)
+    return replaced
+
+def store_dataset(store):
+    """Open partitioned Parquet store as a pyarrow dataset, or return None if it is empty.
+
+    Files written with different observation columns are read with the
+    union of their schemas, missing columns being null. Columns whose
+    types cannot be reconciled are read as strings. Files an interrupted
+    compaction already replaced are left out (see compact).
+
+    Keyword arguments:
+    store -- Directory of store
+    """
+    import pyarrow as pa
+    import pyarrow.dataset as pds
+
+    if not os.path.isdir(store):
+        return None
+    dataset = pds.dataset(store, format='parquet', partitioning='hive')
+    replaced = replaced_files(store)
+    fragments = [fragment for fragment in dataset.get_fragments() if os.path.abspath(fragment.path) not in replaced]
+    if not fragments:
+        return None
+    schemas = [fragment.physical_schema for fragment in fragments] + [dataset.partitioning.schema]
+    fields = {}
+    for schema in schemas:
+        for field in schema:
+            fields.setdefault(field.name, []).append(pa.schema([field]))
+    unified = []
+    for name, columns in fields.items():
+        try:
+            unified.append(pa.unify_schemas(columns, promote_options='permissive').field(name))
+        except (pa.ArrowTypeError, pa.ArrowInvalid):
+            # Sources disagree on the type, e.g. string or epoch timestamps
+            unified.append(pa.field(name, pa.large_string()))
+    schema = pa.schema(unified)
+    if replaced:
+        return pds.dataset([fragment.path for fragment in fragments], schema=schema, format='parquet',
+                           partitioning='hive', partition_base_dir=store)
+    return pds.dataset(store, schema=schema, format='parquet', partitioning='hive')
+
+def matched_ids(store):
+    """Get ids of observations in matchup store; only the id column is read.
+
+    Keyword arguments:
+    store -- Directory of matchup store
+    """
+    import pandas as pd
+
+    dataset = store_dataset(store)
+    if dataset is None:
+        return pd.Index([], dtype=object)
+    return pd.Index(dataset.to_table(columns=['id']).column('id').to_numpy(zero_copy_only=False))
+
+def read_matchups(store, columns=None, filters=None):
+    """Read matchups from store.
+
+    Filters are pushed down to the reader: partitions not matching filters
+    on water_year and region are not opened, and row groups are skipped
+    using Parquet statistics.
+
+    Keyword arguments:
+    store -- Directory of matchup store
+    columns -- List of columns to read (default None, all)
+    filters -- pyarrow expression or list of (column, op, value) tuples,
+        e.g. [('water_year', '=', 2020), ('region', '=', 'alaska')] (default None)
+
+    Returns:
+    Dataframe of matchups
+    """
+    import pandas as pd
+    import pyarrow.dataset as pds
+    import pyarrow.parquet as pq
+
+    dataset = store_dataset(store)
+    if dataset is None:
+        return pd.DataFrame(columns=columns)
+    if filters is not None and not isinstance(filters, pds.Expression):
+        filters = pq.filters_to_expression(filters)
+    return dataset.to_table(columns=columns, filter=filters).to_pandas()
+
+def provenance(date, products, cache=None, csnow_store=None, dem_dir=None):
+    """Get provenance columns of matchups sampled on date.
+
+    Keyword arguments:
+    date -- Date of observations
+    products -- Products sampled (see jobs.sample_products)
+    cache -- Directory of SnodasCache (default None)
+    csnow_store -- Path of zarr store written by CSNOW.ingest (default None)
+    dem_dir -- Directory of DEM tiles (default None)
+
+    Returns:
+    Dictionary of column name to value
+    """
+    import pandas as pd
+
+    columns = {
+        'products' : ','.join(products),
+        'matched_at' : pd.Timestamp.now('UTC').tz_localize(None)
+    }
+    if any(product.startswith('snodas_') for product in products):
+        import validation.SNODAS as SNODAS
+        columns['snodas_source'] = SNODAS.snodas_url(pd.Timestamp(date).to_pydatetime())
+    if 'csnow' in products:
+        columns['csnow_source'] = os.path.abspath(csnow_store)
+    if 'elevation' in products:
+        import validation.Elevation as Elevation
+        columns['dem_source'] = Elevation.dem_directory(dem_dir)
+    return columns
+
+def write_partitions(store, df, name, partitions=MATCHUP_PARTITIONS):
+    """Write rows as one new file in each of their partitions.
+
+    Files are written under a temporary name and renamed into place, so
+    readers never see partial files.
+
+    Keyword arguments:
+    store -- Directory of store
+    df -- Dataframe with partition columns
+    name -- Base name of files written
+    partitions -- Columns to partition by (default MATCHUP_PARTITIONS)
+    """
+    import pyarrow.parquet as pq
+
+    for keys, group in df.groupby(partitions, sort=False):
+        directory = os.path.join(store, *['%s=%s' % (column, key) for column, key in zip(partitions, keys)])
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, '%s.parquet' % name)
+        # Dataset discovery skips hidden files
+        tmp_path = os.path.join(directory, '.%s.tmp' % name)
+        pq.write_table(qaqc.pa_table(group.drop(columns=partitions)), tmp_path)
+        os.replace(tmp_path, path)
+
+def update_store(store, observations, products=['snodas_1036'], regions=None,
+                 cache=None, csnow_store=None, dem_dir=None, chunksize=100000):
+    """Sample products at observations not yet in the matchup store and add them.
+
+    Observations already in the store, by id (see observation_ids), are
+    skipped without being sampled, so rerunning after new observations
+    arrive only downloads and samples the dates they fall on. Each date is
+    written as soon as it is sampled, so an interrupted update resumes
+    where it stopped.
+
+    The store is a Parquet dataset partitioned by water year and region
+    (see MATCHUP_PARTITIONS). Matchups keep all observation columns, an
+    id column, a column per product (see jobs.sample_products) and
+    provenance columns (see provenance).
+
+    Keyword arguments:
+    store -- Directory of matchup store
+    observations -- Dataframe of observations, or path of CSV, Parquet or GeoJSON file
+    products -- Products to sample (default ['snodas_1036'])
+    regions -- Dictionary of region name to bounds (see assign_regions)
+    cache -- Directory of SnodasCache (default None)
+    csnow_store -- Path of zarr store written by CSNOW.ingest, for csnow (default None)
+    dem_dir -- Directory of DEM tiles, for elevation (see Elevation.dem_directory)
+    chunksize -- Number of rows of observations file read at a time (default 100000)
+
+    Returns:
+    Number of observations added
+    """
+    import pandas as pd
+
+    chunks = [observations] if isinstance(observations, pd.DataFrame) else \
+        qaqc.read_chunks(observations, chunksize=chunksize)
+    done = matched_ids(store)
+    new = []
+    for chunk in chunks:
+        chunk = jobs.normalize_observations(chunk)
+        chunk['id'] = observation_ids(chunk)
+        new.append(chunk[~chunk['id'].isin(done)])
+    obs = pd.concat(new, ignore_index=True) if new else pd.DataFrame()
+    obs = obs.drop_duplicates('id')
+    if obs.empty:
+        return 0
+
+    obs['water_year'] = water_year(obs['date'])
+    obs['region'] = assign_regions(obs, regions)
+    added = 0
+    for date, group in obs.groupby('date'):
+        out = jobs.sample_products(group, date, products, cache=cache, csnow_store=csnow_store, dem_dir=dem_dir)
+        out = out.assign(**provenance(date, products, cache=cache, csnow_store=csnow_store, dem_dir=dem_dir))
+        write_partitions(store, out, '%s-%s' % (pd.Timestamp(date).strftime('%Y%m%d'), uuid.uuid4().hex[:8]))
+        added += len(out)
+    return added
+
+def finish_compactions(store):
+    """Complete or roll back compactions interrupted in a store.
+
+    A compaction whose file was renamed into place is completed by
+    removing the files it replaced; otherwise its temporary file is
+    removed and the partition keeps its files.
+
+    Keyword arguments:
+    store -- Directory of store
+    """
+    for manifest, compacted, files in list(compactions(store)):
+        if os.path.exists(compacted):
+            stale = files
+        else:
+            directory, name = os.path.split(compacted)
+            stale = [os.path.join(directory, '.%s.tmp' % os.path.splitext(name)[0])]
+        for path in stale:
+            if os.path.exists(path):
+                os.remove(path)
+        os.remove(manifest)
+
+def compact(store):
+    """Rewrite each partition of a matchup or observation store as a single file.
+
+    Updates add a file per date and partition; compacting keeps reads of
+    a store that has been updated many times fast.
+
+    Before the compacted file is renamed into place, a manifest listing
+    the files it replaces is written to the partition. Readers skip those
+    files while the compacted file is present, so rows are never read
+    twice, and an interrupted compaction is finished by the next one.
+
+    Keyword arguments:
+    store -- Directory of store
+    """
+    import pyarrow as pa
+    import pyarrow.dataset as pds
+    import pyarrow.parquet as pq
+
+    if not os.path.isdir(store):
+        return
+    finish_compactions(store)
+    dataset = store_dataset(store)
+    if dataset is None:
+        return
+    paths = {}
+    partitions = set()
+    for fragment in dataset.get_fragments():
+        paths.setdefault(os.path.dirname(fragment.path), []).append(fragment.path)
+        # The partitioning of a dataset opened with a schema lists all its columns
+        partitions.update(pds.get_partition_keys(fragment.partition_expression))
+    schema = pa.schema([field for field in dataset.schema if field.name not in partitions])
+    for directory, files in paths.items():
+        if len(files) < 2:
+            continue
+        table = pds.dataset(files, schema=schema, format='parquet').to_table()
+        name = 'compact-%s' % uuid.uuid4().hex[:8]
+        tmp_path = os.path.join(directory, '.%s.tmp' % name)
+        pq.write_table(table, tmp_path)
+        manifest = os.path.join(directory, COMPACT_MANIFEST)
+        with open(manifest + '.tmp', 'w') as f:
+            json.dump({'compacted' : '%s.parquet' % name, 'replaced' : [os.path.basename(old) for old in files]}, f)
+        os.replace(manifest + '.tmp', manifest)
+        os.replace(tmp_path, os.path.join(directory, '%s.parquet' % name))
+        for old in files:
+            os.remove(old)
+        os.remove(manifest)
@@ -0,0 +1,264 @@
+import os
+import sys
+import json
+import time
+import logging
+import resource
+import threading
+from contextlib import contextmanager
+from functools import wraps
+
+# Sinks receiving events; instrumentation is disabled while this is empty
+SINKS = []
+
+_local = threading.local()
+
+def max_rss():
+    """Get high-water resident set size of this process in bytes."""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+def emit(event):
+    for sink in list(SINKS):
+        sink.emit(event)
+
+class Span(object):
+    """Timed region of work that reports an event to the sinks when it ends.
+
+    Counters such as bytes transferred are added with add(), either on the
+    span itself or through count() from code running inside it.
+    """
+
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+        self.counters = {}
+
+    def add(self, counter, value):
+        self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def __enter__(self):
+        if not hasattr(_local, 'stack'):
+            _local.stack = []
+        stack = _local.stack
+        self.parent = stack[-1].name if stack else None
+        stack.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        duration = time.perf_counter() - self.start
+        _local.stack.pop()
+        emit({
+            'type' : 'span',
+            'name' : self.name,
+            'labels' : self.labels,
+            'parent' : self.parent,
+            'duration' : duration,
+            'counters' : self.counters,
+            'max_rss' : max_rss(),
+            'error' : exc_type.__name__ if exc_type is not None else None
+        })
+        return False
+
+class NullSpan(object):
+    """Span used while instrumentation is disabled; does nothing."""
+
+    def add(self, counter, value):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+NULL_SPAN = NullSpan()
+
+def span(name, **labels):
+    """Time a block of work.
+
+    Returns a shared no-op span when no sinks are registered, so
+    instrumented code costs one list check when disabled.
+
+    Keyword arguments:
+    name -- Name of span, e.g. 'SNODAS.gunzip'
+    labels -- Labels attached to the event, e.g. code=1036
+    """
+    if not SINKS:
+        return NULL_SPAN
+    return Span(name, labels)
+
+def count(counter, value):
+    """Add to a counter of every open span in this thread.
+
+    Keyword arguments:
+    counter -- Name of counter, e.g. 'bytes_in'
+    value -- Amount to add
+    """
+    if not SINKS:
+        return
+    for span in getattr(_local, 'stack', ()):
+        span.add(counter, value)
+
+def timed(name=None):
+    """Decorate function to run inside a span named after it.
+
+    Keyword arguments:
+    name -- Name of span (default module.function)
+    """
+    def decorator(func):
+        span_name = name or '%s.%s' % (func.__module__.rpartition('.')[2], func.__name__)
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not SINKS:
+                return func(*args, **kwargs)
+            with Span(span_name, {}):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+class CountingReader(object):
+    """File wrapper counting bytes read into the open spans."""
+
+    def __init__(self, file, counter='bytes_in'):
+        self.file = file
+        self.counter = counter
+
+    def read(self, *args):
+        data = self.file.read(*args)
+        count(self.counter, len(data))
+        return data
+
+    def readinto(self, buffer):
+        n = self.file.readinto(buffer)
+        count(self.counter, n or 0)
+        return n
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+def counted(file, counter='bytes_in'):
+    """Wrap file object to count bytes read, or return it as is when disabled.
+
+    Keyword arguments:
+    file -- File object to wrap
+    counter -- Name of counter (default 'bytes_in')
+    """
+    if not SINKS:
+        return file
+    return CountingReader(file, counter)
+
+def add_sink(sink):
+    """Register sink and enable instrumentation."""
+    SINKS.append(sink)
+    return sink
+
+def remove_sink(sink):
+    """Unregister sink; instrumentation is disabled once no sinks remain."""
+    if sink in SINKS:
+        SINKS.remove(sink)
+
+@contextmanager
+def recording(sink=None):
+    """Enable instrumentation for a block of code.
+
+    Keyword arguments:
+    sink -- Sink to register (default new MemorySink)
+
+    Yields:
+    The sink
+    """
+    sink = add_sink(sink if sink is not None else MemorySink())
+    try:
+        yield sink
+    finally:
+        remove_sink(sink)
+
+class LogSink(object):
+    """Sink writing each event as a JSON log record."""
+
+    def __init__(self, logger=None, level=logging.INFO):
+        self.logger = logger or logging.getLogger('validation.metrics')
+        self.level = level
+
+    def emit(self, event):
+        self.logger.log(self.level, json.dumps(event, default=str))
+
+class MemorySink(object):
+    """Sink aggregating events per span name and labels."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.spans = {}
+            self.max_rss = 0
+
+    def emit(self, event):
+        key = (event['name'], tuple(sorted((k, str(v)) for k, v in event['labels'].items())))
+        with self.lock:
+            stats = self.spans.get(key)
+            if stats is None:
+                stats = self.spans[key] = {'count' : 0, 'errors' : 0, 'total' : 0.0,
+                                           'min' : float('inf'), 'max' : 0.0, 'counters' : {}}
+            stats['count'] += 1
+            stats['errors'] += event['error'] is not None
+            stats['total'] += event['duration']
+            stats['min'] = min(stats['min'], event['duration'])
+            stats['max'] = max(stats['max'], event['duration'])
+            for counter, value in event['counters'].items():
+                stats['counters'][counter] = stats['counters'].get(counter, 0) + value
+            self.max_rss = max(self.max_rss, event['max_rss'])
+
+    def summary(self):
+        """Get aggregated spans as a list of dictionaries, slowest first."""
+        with self.lock:
+            rows = [dict(stats, name=name, labels=dict(labels), counters=dict(stats['counters']),
+                         mean=stats['total'] / stats['count'])
+                    for (name, labels), stats in self.spans.items()]
+        return sorted(rows, key=lambda row: row['total'], reverse=True)
+
+class PrometheusSink(MemorySink):
+    """Aggregating sink that can dump its state in Prometheus text format."""
+
+    def text(self, prefix='validation'):
+        """Get aggregated spans as Prometheus text exposition format.
+
+        Keyword arguments:
+        prefix -- Prefix of metric names (default 'validation')
+        """
+        families = {'seconds' : [], 'count' : [], 'errors' : [], 'counter' : []}
+        for row in self.summary():
+            labels = dict(row['labels'], span=row['name'])
+            label_text = ','.join('%s="%s"' % (key, str(value).replace('"', '\\"'))
+                                  for key, value in sorted(labels.items()))
+            families['seconds'].append('{%s} %.9g' % (label_text, row['total']))
+            families['count'].append('{%s} %d' % (label_text, row['count']))
+            families['errors'].append('{%s} %d' % (label_text, row['errors']))
+            for counter, value in sorted(row['counters'].items()):
+                families['counter'].append('{%s,counter="%s"} %d' % (label_text, counter, value))
+
+        # Samples of a metric must follow its TYPE line without interruption
+        lines = []
+        for family, samples in families.items():
+            metric = '%s_span_%s_total' % (prefix, family)
+            lines.append('# TYPE %s counter' % metric)
+            lines.extend(metric + sample for sample in samples)
+        lines.append('# TYPE %s_max_rss_bytes gauge' % prefix)
+        lines.append('%s_max_rss_bytes %d' % (prefix, self.max_rss))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path, prefix='validation'):
+        """Write text dump to file, e.g. for the node exporter textfile collector.
+
+        Keyword arguments:
+        path -- Path of file to write
+        prefix -- Prefix of metric names (default 'validation')
+        """
+        with open(path + '.tmp', 'w') as f:
+            f.write(self.text(prefix))
+        os.replace(path + '.tmp', path)
@@ -0,0 +1,286 @@
+import os
+import json
+import uuid
+import urllib.request
+from urllib.parse import urlencode
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import validation.jobs as jobs
+import validation.matchups as matchups
+import validation.metrics as metrics
+import validation.utils as ut
+
+# MountainHub timeline API serving CSO observations
+MOUNTAINHUB_URL = 'https://api.mountainhub.com/timeline'
+MOUNTAINHUB_HEADERS = {'Accept-version' : '1'}
+
+# Number of records requested per page
+PAGE_SIZE = 1000
+
+# Columns of normalized observations, as in CSO database exports; depth is in cm
+OBSERVATION_COLUMNS = ['id', 'source', 'author', 'timestamp', 'date', 'longitude', 'latitude', 'depth']
+
+# Columns the store is partitioned by, as water_year=<year>/source=<name> directories
+OBSERVATION_PARTITIONS = ['water_year', 'source']
+
+# File in the store holding the watermark; dataset discovery skips it
+STATE_FILE = '_state.json'
+
+def epoch_ms(time):
+    """Get milliseconds since the epoch of a datetime, naive datetimes being UTC."""
+    import pandas as pd
+
+    time = pd.Timestamp(time)
+    if time.tzinfo is None:
+        time = time.tz_localize('UTC')
+    return int(time.value // 1000000)
+
+def page_params(since, before, bbox=None, limit=PAGE_SIZE, obs_type='snow_conditions'):
+    """Get query parameters of a page of the MountainHub timeline.
+
+    Keyword arguments:
+    since -- Earliest time of observations, in milliseconds since the epoch
+    before -- Time observations are before, in milliseconds since the epoch
+    bbox -- Dictionary of xmin, ymin, xmax and ymax bounds (default None)
+    limit -- Number of records per page (default PAGE_SIZE)
+    obs_type -- Type of observations (default 'snow_conditions')
+    """
+    params = {
+        'publisher' : 'all',
+        'obs_type' : obs_type,
+        'limit' : limit,
+        'since' : since,
+        'before' : before
+    }
+    if bbox is not None:
+        params.update({
+            'north_east_lat' : bbox['ymax'],
+            'north_east_lng' : bbox['xmax'],
+            'south_west_lat' : bbox['ymin'],
+            'south_west_lng' : bbox['xmin']
+        })
+    return params
+
+def fetch_page(url, params, headers=MOUNTAINHUB_HEADERS, timeout=60):
+    """Get records of one page of an observation API.
+
+    Keyword arguments:
+    url -- URL of API
+    params -- Dictionary of query parameters
+    headers -- Dictionary of request headers (default MOUNTAINHUB_HEADERS)
+    timeout -- Seconds to wait for the server (default 60)
+
+    Returns:
+    List of records
+    """
+    with metrics.span('observations.fetch_page') as span:
+        request = urllib.request.Request('%s?%s' % (url, urlencode(params)), headers=headers)
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            body = response.read()
+        span.add('bytes_in', len(body))
+    return json.loads(body.decode('utf-8')).get('results', [])
+
+def parse_mountainhub(records):
+    """Convert MountainHub timeline records to a dataframe.
+
+    Keyword arguments:
+    records -- List of records returned by fetch_page
+
+    Returns:
+    Dataframe with id, author_name, timestamp (milliseconds since the
+    epoch), long, lat, obs_type and snow_depth (cm) columns
+    """
+    import pandas as pd
+
+    columns = ['id', 'author_name', 'timestamp', 'long', 'lat', 'obs_type', 'snow_depth']
+    if not records:
+        return pd.DataFrame(columns=columns)
+    flat = pd.json_normalize(records)
+    empty = pd.Series([None] * len(flat), index=flat.index, dtype=object)
+    location = flat['observation.location']
+    details = flat.get('observation.details', empty)
+    return pd.DataFrame({
+        'id' : flat['observation._id'].astype(str),
+        'author_name' : flat.get('actor.full_name', empty),
+        'timestamp' : flat['observation.reported_at'].astype(np.int64),
+        'long' : location.str[0].astype(np.float64),
+        'lat' : location.str[1].astype(np.float64),
+        'obs_type' : flat.get('observation.type', empty),
+        'snow_depth' : pd.to_numeric(details.str[0].str.get('snowpack_depth'), errors='coerce')
+    }, columns=columns)
+
+def normalize(df, source='MountainHub'):
+    """Convert observations to the columns of CSO database exports.
+
+    Timestamps become naive UTC datetimes and depths float cm; other
+    columns are kept.
+
+    Keyword arguments:
+    df -- Dataframe of observations, e.g. returned by parse_mountainhub
+    source -- Source of observations without a source column (default 'MountainHub')
+
+    Returns:
+    Dataframe with OBSERVATION_COLUMNS first
+    """
+    import pandas as pd
+
+    df = jobs.normalize_observations(df.rename(columns={'author_name' : 'author', 'snow_depth' : 'depth'}))
+    df['timestamp'] = jobs.utc_timestamps(df['timestamp']).dt.tz_localize(None)
+    df['depth'] = pd.to_numeric(df['depth'], errors='coerce').astype(np.float64)
+    df['id'] = df['id'].astype(str)
+    if 'source' not in df.columns:
+        df['source'] = source
+    df = df.drop(columns=[column for column in ['long', 'lat', 'wkt_geom'] if column in df.columns])
+    return df[OBSERVATION_COLUMNS + [column for column in df.columns if column not in OBSERVATION_COLUMNS]]
+
+def fetch_window(since, before, bbox=None, url=MOUNTAINHUB_URL, headers=MOUNTAINHUB_HEADERS,
+                 page_size=PAGE_SIZE, parse=parse_mountainhub):
+    """Fetch all pages of observations in a time window.
+
+    Pages are requested newest first, each ending before the oldest
+    observation of the previous one.
+
+    Keyword arguments:
+    since -- Earliest time of observations, in milliseconds since the epoch
+    before -- Time observations are before, in milliseconds since the epoch
+    bbox -- Dictionary of xmin, ymin, xmax and ymax bounds (default None)
+    url -- URL of API (default MOUNTAINHUB_URL)
+    headers -- Dictionary of request headers (default MOUNTAINHUB_HEADERS)
+    page_size -- Number of records per page (default PAGE_SIZE)
+    parse -- Function converting records to a dataframe with id and timestamp columns
+
+    Returns:
+    Dataframe of observations
+    """
+    import pandas as pd
+
+    pages = []
+    while True:
+        records = ut.retry(fetch_page, url, page_params(since, before, bbox, page_size), headers=headers)
+        page = parse(records)
+        pages.append(page)
+        if len(records) < page_size:
+            break
+        # Observations sharing the oldest time may span two pages; duplicates are dropped below
+        oldest = int(page['timestamp'].min()) + 1
+        if oldest >= before:
+            raise ValueError('Page of %d observations at one time; increase page_size' % page_size)
+        before = oldest
+    return pd.concat(pages, ignore_index=True).drop_duplicates('id')
+
+def fetch_observations(since, before, bbox=None, workers=4, window='7D', **kwargs):
+    """Fetch observations, fetching time windows concurrently.
+
+    Keyword arguments:
+    since -- Earliest time of observations
+    before -- Time observations are before
+    bbox -- Dictionary of xmin, ymin, xmax and ymax bounds (default None)
+    workers -- Number of windows fetched at a time (default 4)
+    window -- Length of windows as a pandas frequency (default '7D')
+    kwargs -- Arguments passed to fetch_window
+
+    Returns:
+    Dataframe of observations
+    """
+    import pandas as pd
+
+    edges = [epoch_ms(edge) for edge in pd.date_range(since, before, freq=window)] + [epoch_ms(before)]
+    windows = [(start, end) for start, end in zip(edges[:-1], edges[1:]) if start < end]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pages = list(executor.map(lambda w: fetch_window(w[0], w[1], bbox=bbox, **kwargs), windows))
+    if not pages:
+        return kwargs.get('parse', parse_mountainhub)([])
+    return pd.concat(pages, ignore_index=True).drop_duplicates('id')
+
+def read_state(store):
+    """Read ingestion state of store, or an empty dictionary for a new store.
+
+    Keyword arguments:
+    store -- Directory of observation store
+    """
+    try:
+        with open(os.path.join(store, STATE_FILE)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def write_state(store, state):
+    """Write ingestion state of store atomically.
+
+    Keyword arguments:
+    store -- Directory of observation store
+    state -- Dictionary to write
+    """
+    path = os.path.join(store, STATE_FILE)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(state, f, indent=2)
+    os.replace(path + '.tmp', path)
+
+def ingest(store, since=None, until=None, bbox=None, source='MountainHub', overlap='1D', workers=4,
+           window='7D', **kwargs):
+    """Fetch observations newer than the watermark of the store and append them.
+
+    The watermark is the time the previous ingestion fetched up to and is
+    stored with the observations (see STATE_FILE). Observations are
+    fetched again from overlap before it, to pick up late uploads, and
+    those already in the store are dropped by id. The watermark moves
+    only after new observations are written, so a failed ingestion is
+    simply retried.
+
+    The store is a Parquet dataset partitioned by water year and source
+    (see OBSERVATION_PARTITIONS), readable with read_observations or as
+    the observations of a job (see qaqc.read_chunks).
+
+    Keyword arguments:
+    store -- Directory of observation store
+    since -- Earliest time of observations for a new store (default None, required for a new store)
+    until -- Time to fetch observations up to (default now)
+    bbox -- Dictionary of xmin, ymin, xmax and ymax bounds (default None, bounds of the store)
+    source -- Source of observations (default 'MountainHub')
+    overlap -- Time before the watermark fetched again as a pandas frequency (default '1D')
+    workers -- Number of windows fetched at a time (default 4)
+    window -- Length of windows as a pandas frequency (default '7D')
+    kwargs -- Arguments passed to fetch_window, e.g. url or parse
+
+    Returns:
+    Number of observations added
+    """
+    import pandas as pd
+    import pyarrow.dataset as pds
+
+    state = read_state(store)
+    bbox = bbox or state.get('bbox')
+    if 'since' in state:
+        start = pd.Timestamp(state['since']) - pd.Timedelta(overlap)
+    elif since is not None:
+        start = pd.Timestamp(since)
+    else:
+        raise ValueError('Store %s has no watermark; give since' % store)
+    until = pd.Timestamp(until) if until is not None else pd.Timestamp.now('UTC').tz_localize(None)
+
+    df = normalize(fetch_observations(start, until, bbox=bbox, workers=workers, window=window, **kwargs), source)
+    dataset = matchups.store_dataset(store)
+    if dataset is not None and len(df):
+        seen = dataset.to_table(columns=['id'], filter=pds.field('timestamp') >= start).column('id')
+        df = df[~df['id'].isin(seen.to_numpy(zero_copy_only=False))]
+    if len(df):
+        df['water_year'] = matchups.water_year(df['date'])
+        name = '%s-%s' % (until.strftime('%Y%m%dT%H%M%S'), uuid.uuid4().hex[:8])
+        matchups.write_partitions(store, df, name, partitions=OBSERVATION_PARTITIONS)
+
+    os.makedirs(store, exist_ok=True)
+    write_state(store, {'since' : until.isoformat(), 'bbox' : bbox, 'source' : source,
+                        'updated' : pd.Timestamp.now('UTC').tz_localize(None).isoformat()})
+    return len(df)
+
+def read_observations(store, columns=None, filters=None):
+    """Read observations from store, pushing filters down to the reader.
+
+    Keyword arguments:
+    store -- Directory of observation store
+    columns -- List of columns to read (default None, all)
+    filters -- pyarrow expression or list of (column, op, value) tuples,
+        e.g. [('water_year', '=', 2020), ('source', '=', 'MountainHub')] (default None)
+    """
+    return matchups.read_matchups(store, columns=columns, filters=filters)
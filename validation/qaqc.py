@@ -0,0 +1,416 @@
+import os
+from collections import namedtuple
+
+import numpy as np
+
+# A QA/QC rule: name, function returning a boolean mask for a dataframe, and
+# optional lists of sources, authors and regions the rule is restricted to
+Rule = namedtuple('Rule', ['name', 'test', 'sources', 'authors', 'regions'])
+
+# Maximum depth (cm) in California, from Tamarack: http://www.thestormking.com/Weather/Sierra_Snowfall/sierra_snowfall.html
+MAX_DEPTH = 990.6
+
+# Bounding boxes of the regions the QA/QC notebooks check separately (CSO_CA and CSO_UT exports)
+REGIONS = {
+    'CA' : {'latmin' : 32.5, 'latmax' : 42.0, 'lonmin' : -124.5, 'lonmax' : -114.1},
+    'UT' : {'latmin' : 37.0, 'latmax' : 42.0, 'lonmin' : -114.05, 'lonmax' : -109.05}
+}
+
+# Maximum depths (cm) per region, as (bbox, maximum) for region_above
+REGION_MAX_DEPTHS = {
+    'CA' : (REGIONS['CA'], MAX_DEPTH)
+}
+
+# Depth (cm) at or below which observations in the notebook regions are flagged as suspiciously low
+LOW_DEPTH = 10
+
+# Common snow probe lengths (cm); observations at these depths may be probe bottoming out
+PROBE_LENGTHS = [240, 300, 330]
+
+def rule(name, test, sources=None, authors=None, regions=None):
+    """Create QA/QC rule.
+
+    Keyword arguments:
+    name -- Name of rule (used for flag columns and summaries)
+    test -- Function taking a dataframe and returning a boolean mask of flagged rows
+    sources -- Only flag observations from these sources (default all)
+    authors -- Only flag observations by these authors (default all)
+    regions -- Only flag observations inside these regions, names of REGIONS (default all)
+    """
+    return Rule(name, test, sources, authors, regions)
+
+def in_bbox(df, bbox):
+    """Get mask of observations inside a bbox with latmin, latmax, lonmin and lonmax."""
+    lat = df['latitude'].to_numpy(dtype=np.float64)
+    lon = df['longitude'].to_numpy(dtype=np.float64)
+    return (lat >= bbox['latmin']) & (lat <= bbox['latmax']) & (lon >= bbox['lonmin']) & (lon <= bbox['lonmax'])
+
+def above(column, value):
+    """Test for values greater than a threshold."""
+    return lambda df: (df[column] > value).to_numpy()
+
+def at_most(column, value):
+    """Test for values less than or equal to a threshold."""
+    return lambda df: (df[column] <= value).to_numpy()
+
+def between(column, low, high, inclusive='right'):
+    """Test for values in a range (default low < value <= high)."""
+    return lambda df: df[column].between(low, high, inclusive=inclusive).to_numpy()
+
+def near(column, values, delta):
+    """Test for values within delta of any of a list of values."""
+    values = np.asarray(values, dtype=np.float64)
+    def test(df):
+        x = df[column].to_numpy(dtype=np.float64)
+        return (np.abs(x[:, np.newaxis] - values[np.newaxis]) <= delta).any(axis=1)
+    return test
+
+def region_above(column, table):
+    """Test for values above a per-region maximum.
+
+    Keyword arguments:
+    column -- Column to test
+    table -- Dictionary mapping region name to (bbox, maximum), where bbox has latmin, latmax, lonmin and lonmax
+    """
+    def test(df):
+        x = df[column].to_numpy(dtype=np.float64)
+        mask = np.zeros(len(df), dtype=bool)
+        for bbox, maximum in table.values():
+            mask |= in_bbox(df, bbox) & (x > maximum)
+        return mask
+    return test
+
+# Rules from the CSO QA/QC notebooks: zeros everywhere, low depths in the
+# regions checked with range_val, and regional maximum depths
+DEFAULT_RULES = [
+    rule('zero', at_most('depth', 0)),
+    rule('low', between('depth', 0, LOW_DEPTH), regions=['CA', 'UT']),
+    rule('max_depth', region_above('depth', REGION_MAX_DEPTHS)),
+    rule('probe_length', near('depth', PROBE_LENGTHS, 1))
+]
+
+def flag(df, rules=DEFAULT_RULES):
+    """Compute QA/QC flags for observations.
+
+    Bit i of the result is set when rule i flags the observation.
+
+    Keyword arguments:
+    df -- Dataframe of observations
+    rules -- List of rules (default DEFAULT_RULES, at most 64)
+    """
+    if len(rules) > 64:
+        raise ValueError('At most 64 rules are supported')
+    flags = np.zeros(len(df), dtype=np.uint64)
+    for bit, r in enumerate(rules):
+        mask = np.array(r.test(df), dtype=bool)
+        if r.sources is not None:
+            mask &= df['source'].isin(r.sources).to_numpy()
+        if r.authors is not None:
+            mask &= df['author'].isin(r.authors).to_numpy()
+        if r.regions is not None:
+            inside = np.zeros(len(df), dtype=bool)
+            for name in r.regions:
+                inside |= in_bbox(df, REGIONS[name])
+            mask &= inside
+        flags |= mask.astype(np.uint64) << np.uint64(bit)
+    return flags
+
+def rule_flags(flags, rules=DEFAULT_RULES):
+    """Expand flag bits into dataframe with one boolean column per rule.
+
+    Keyword arguments:
+    flags -- Array of flags returned by flag
+    rules -- List of rules used to compute flags
+    """
+    import pandas as pd
+
+    flags = np.asarray(flags, dtype=np.uint64)
+    return pd.DataFrame({
+        r.name : (flags >> np.uint64(bit)) & np.uint64(1) == 1
+        for bit, r in enumerate(rules)
+    })
+
+def summarize(df, flags, rules=DEFAULT_RULES, by=['source', 'author']):
+    """Count observations and flags per group.
+
+    Keyword arguments:
+    df -- Dataframe of observations
+    flags -- Array of flags returned by flag
+    rules -- List of rules used to compute flags
+    by -- Columns to group by (default source and author)
+    """
+    counts = rule_flags(flags, rules).astype(np.int64)
+    counts.insert(0, 'count', 1)
+    counts['flagged'] = (np.asarray(flags) != 0).astype(np.int64)
+    keys = [df[column].fillna('').to_numpy() for column in by]
+    return counts.groupby(keys).sum().rename_axis(by)
+
+def read_chunks(path, chunksize=100000):
+    """Read observations from CSV, Parquet or GeoJSON file in chunks.
+
+    GeoJSON features are read as Arrow batches, with pyogrio when it is
+    installed and otherwise with GDAL's OGR; point geometries become
+    longitude and latitude columns (see wkb_points). A directory is read as
+    a partitioned Parquet store, such as one written by observations.ingest.
+
+    Keyword arguments:
+    path -- Path of observations file or store
+    chunksize -- Number of rows per chunk (default 100000)
+
+    Yields:
+    Dataframes of observations
+    """
+    import pandas as pd
+    import pyarrow.dataset as pds
+    import pyarrow.parquet as pq
+
+    extension = os.path.splitext(path)[1].lower()
+    if os.path.isdir(path):
+        for batch in pds.dataset(path, format='parquet', partitioning='hive').to_batches(batch_size=chunksize):
+            yield batch.to_pandas()
+    elif extension == '.csv':
+        for chunk in pd.read_csv(path, chunksize=chunksize):
+            yield chunk
+    elif extension in ['.parquet', '.pq']:
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunksize):
+            yield batch.to_pandas()
+    elif extension in ['.geojson', '.json']:
+        for batch, geometry in geojson_batches(path, chunksize):
+            df = batch.drop_columns([geometry]).to_pandas()
+            df['longitude'], df['latitude'] = wkb_points(batch.column(geometry))
+            yield df
+    else:
+        raise ValueError('Unsupported observations file: %s' % path)
+
+def geojson_batches(path, chunksize):
+    """Read features of a GeoJSON file as Arrow record batches.
+
+    Keyword arguments:
+    path -- Path of GeoJSON file
+    chunksize -- Number of features per batch
+
+    Yields:
+    (record batch, name of WKB geometry column) tuples
+    """
+    import pyarrow as pa
+
+    try:
+        from pyogrio.raw import open_arrow
+    except ImportError:
+        open_arrow = None
+    if open_arrow is not None:
+        with open_arrow(path, batch_size=chunksize, use_pyarrow=True) as (meta, reader):
+            geometry = meta['geometry_name'] or 'wkb_geometry'
+            for batch in reader:
+                yield pa.Table.from_batches([batch]), geometry
+        return
+
+    from osgeo import ogr
+    source = ogr.Open(path)
+    if source is None:
+        raise ValueError('Cannot open observations file: %s' % path)
+    layer = source.GetLayer()
+    geometry = layer.GetGeometryColumn() or 'wkb_geometry'
+    stream = layer.GetArrowStreamAsPyArrow(['MAX_FEATURES_IN_BATCH=%d' % chunksize, 'INCLUDE_FID=NO'])
+    for batch in stream:
+        yield pa.Table.from_batches([batch]), geometry
+    source = None
+
+def wkb_points(geometries):
+    """Get coordinates of WKB point geometries without parsing them one by one.
+
+    Keyword arguments:
+    geometries -- Arrow array of WKB points (2D, or with Z or M values)
+
+    Returns:
+    Arrays of x and y, NaN for missing or non-point geometries
+    """
+    import pyarrow as pa
+
+    geometries = geometries.combine_chunks() if isinstance(geometries, pa.ChunkedArray) else geometries
+    n = len(geometries)
+    x = np.full(n, np.nan)
+    y = np.full(n, np.nan)
+    if n == 0:
+        return x, y
+    geometries = geometries.cast(pa.large_binary())
+    offsets = np.frombuffer(geometries.buffers()[1], dtype=np.int64)[geometries.offset:geometries.offset + n + 1]
+    data = np.frombuffer(geometries.buffers()[2], dtype=np.uint8)
+    starts = offsets[:-1]
+    valid = geometries.is_valid().to_numpy(zero_copy_only=False) & (np.diff(offsets) >= 21)
+    starts = starts[valid]
+    little = data[starts] == 1
+    # Geometry type is a uint32 after the byte order; point types are 1, 1001, 2001, 3001
+    # (ISO) or 1 with high Z/M flag bits (EWKB)
+    codes = data[starts[:, np.newaxis] + np.arange(1, 5)]
+    kind = np.where(little, codes[:, 0] | codes[:, 1].astype(np.uint32) << 8,
+                    codes[:, 3] | codes[:, 2].astype(np.uint32) << 8)
+    point = (kind % 1000) == 1
+    coords = data[starts[:, np.newaxis] + np.arange(5, 21)].copy()
+    # Big-endian coordinates are byte-swapped to little-endian
+    coords[~little] = coords[~little].reshape(-1, 2, 8)[:, :, ::-1].reshape(-1, 16)
+    values = coords.view('<f8')
+    index = np.flatnonzero(valid)
+    x[index] = np.where(point, values[:, 0], np.nan)
+    y[index] = np.where(point, values[:, 1], np.nan)
+    return x, y
+
+def qaqc_file(path, rules=DEFAULT_RULES, by=['source', 'author'], chunksize=100000, output=None):
+    """Flag all observations in a file and summarize flags per group.
+
+    Chunks are normalized first (see jobs.normalize_observations), so
+    coordinates may also be given as lat/long or WKT point columns.
+
+    Keyword arguments:
+    path -- Path of CSV, Parquet or GeoJSON observations file
+    rules -- List of rules (default DEFAULT_RULES)
+    by -- Columns to group summary by (default source and author)
+    chunksize -- Number of rows processed at a time (default 100000)
+    output -- Parquet file to write observations with their flags to (default None)
+
+    Returns:
+    Dataframe of observation and flag counts per group
+    """
+    import pandas as pd
+    import pyarrow.parquet as pq
+    # jobs imports this module
+    import validation.jobs as jobs
+
+    summary = None
+    writer = None
+    try:
+        for chunk in read_chunks(path, chunksize=chunksize):
+            chunk = jobs.normalize_observations(chunk)
+            flags = flag(chunk, rules)
+            counts = summarize(chunk, flags, rules, by=by)
+            summary = counts if summary is None else summary.add(counts, fill_value=0)
+            if output is not None:
+                chunk = chunk.assign(flags=flags)
+                table = pa_table(chunk)
+                if writer is None:
+                    writer = pq.ParquetWriter(output, table.schema)
+                writer.write_table(table.cast(writer.schema))
+    finally:
+        if writer is not None:
+            writer.close()
+
+    if summary is None:
+        return pd.DataFrame()
+    return summary.astype(np.int64)
+
+def pa_table(df):
+    """Convert dataframe to Arrow table, dropping geometry objects."""
+    import pyarrow as pa
+
+    df = df.drop(columns=[c for c in ['geometry'] if c in df.columns])
+    return pa.Table.from_pandas(df, preserve_index=False)
+
+# Mean Earth radius (km)
+EARTH_RADIUS = 6371.0088
+
+# Scale factor making the median absolute deviation consistent with the standard deviation
+MAD_SCALE = 1.4826
+
+def unit_vectors(lon, lat):
+    """Convert longitudes and latitudes (degrees) to 3D unit vectors."""
+    lon = np.radians(np.asarray(lon, dtype=np.float64))
+    lat = np.radians(np.asarray(lat, dtype=np.float64))
+    return np.column_stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)])
+
+def group_medians(groups, values, n):
+    """Median of values per group, for groups labelled 0 to n - 1.
+
+    Keyword arguments:
+    groups -- Array of group labels
+    values -- Array of values
+    n -- Number of groups
+
+    Returns:
+    Array of medians (NaN for empty groups) and array of group sizes
+    """
+    order = np.lexsort((values, groups))
+    values = values[order]
+    counts = np.bincount(groups, minlength=n)
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    medians = np.full(n, np.nan)
+    present = counts > 0
+    low = starts[present] + (counts[present] - 1) // 2
+    high = starts[present] + counts[present] // 2
+    medians[present] = (values[low] + values[high]) / 2
+    return medians, counts
+
+def neighbor_outliers(df, column='depth', radius=1.0, window=3, threshold=3.5, min_neighbors=3,
+                      min_mad=1.0, snodas=None, time_column='timestamp', batch_size=100000, workers=-1):
+    """Flag observations that disagree with their spatial and temporal neighbors.
+
+    Observations are indexed in a KD-tree of unit vectors. For each
+    observation, neighbors within radius and window are found, and a robust
+    z-score is computed against the neighbors' median and median absolute
+    deviation (MAD). Queries run in batches, with the tree search spread
+    over workers threads.
+
+    Keyword arguments:
+    df -- Dataframe of observations with latitude, longitude and time columns
+    column -- Column to check (default 'depth')
+    radius -- Neighbor search radius in km (default 1.0)
+    window -- Neighbor time window in days either side (default 3)
+    threshold -- Absolute robust z-score above which observations are outliers (default 3.5)
+    min_neighbors -- Minimum number of neighbors needed to score an observation (default 3)
+    min_mad -- Lower bound on MAD, in units of column, so identical neighbors do not give infinite scores (default 1.0)
+    snodas -- Column of sampled SNODAS values in units of column, also scored against the neighbor MAD (default None)
+    time_column -- Column of observation times (default 'timestamp')
+    batch_size -- Number of observations queried at a time (default 100000)
+    workers -- Number of threads used for tree queries (default -1, all CPUs)
+
+    Returns:
+    Dataframe aligned with df with neighbors, neighbor_median, neighbor_mad, zscore and outlier
+    columns, plus snodas_zscore and snodas_outlier when snodas is given
+    """
+    import pandas as pd
+    from scipy.spatial import cKDTree
+
+    n = len(df)
+    values = df[column].to_numpy(dtype=np.float64)
+    times = pd.to_datetime(df[time_column]).to_numpy().astype('datetime64[s]').astype(np.int64)
+    points = unit_vectors(df['longitude'], df['latitude'])
+    # Chord length corresponding to great circle distance
+    chord = 2 * np.sin(radius / EARTH_RADIUS / 2)
+    window = window * 86400
+    # Scale space and time so the search box is the unit cube, then check exact distances
+    scaled = np.column_stack([points / chord, (times - times.min()) / max(window, 1)])
+    tree = cKDTree(scaled)
+
+    medians = np.full(n, np.nan)
+    mads = np.full(n, np.nan)
+    counts = np.zeros(n, dtype=np.int64)
+    for start in range(0, n, batch_size):
+        stop = min(start + batch_size, n)
+        neighbors = tree.query_ball_point(scaled[start:stop], 1.0 + 1e-9, p=np.inf, workers=workers,
+                                          return_sorted=False)
+        sizes = np.fromiter((len(x) for x in neighbors), dtype=np.int64, count=stop - start)
+        j = np.concatenate([np.asarray(x, dtype=np.int64) for x in neighbors] + [np.zeros(0, dtype=np.int64)])
+        i = np.repeat(np.arange(start, stop), sizes)
+
+        distance = np.sqrt(((points[j] - points[i]) ** 2).sum(axis=1))
+        keep = (i != j) & (distance <= chord) & (np.abs(times[j] - times[i]) <= window) & ~np.isnan(values[j])
+        i, j = i[keep], j[keep]
+        groups = i - start
+        median, count = group_medians(groups, values[j], stop - start)
+        mad, _ = group_medians(groups, np.abs(values[j] - median[groups]), stop - start)
+        medians[start:stop] = median
+        mads[start:stop] = mad
+        counts[start:stop] = count
+
+    scored = counts >= min_neighbors
+    scale = MAD_SCALE * np.maximum(mads, min_mad)
+    result = pd.DataFrame({
+        'neighbors' : counts,
+        'neighbor_median' : medians,
+        'neighbor_mad' : mads,
+        'zscore' : np.where(scored, (values - medians) / scale, np.nan)
+    }, index=df.index)
+    result['outlier'] = np.abs(result['zscore']) > threshold
+    if snodas is not None:
+        result['snodas_zscore'] = np.where(scored, (values - df[snodas].to_numpy(dtype=np.float64)) / scale, np.nan)
+        result['snodas_outlier'] = np.abs(result['snodas_zscore']) > threshold
+    return result
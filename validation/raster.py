@@ -0,0 +1,233 @@
+import os
+import re
+
+import numpy as np
+
+# Raster backends in order of preference when none is configured
+RASTER_BACKENDS = ['gdal', 'rasterio', 'numpy']
+
+# Backend in use, chosen on first use
+_backend = None
+
+def creation_options(options):
+    """Convert GDAL creation options ('KEY=VALUE' strings) to a dictionary."""
+    return dict(option.split('=', 1) for option in options)
+
+class GdalBackend(object):
+    """Raster backend using GDAL's Python bindings."""
+
+    name = 'gdal'
+
+    def __init__(self):
+        from osgeo import gdal, gdal_array
+        self.gdal = gdal
+        self.gdal_array = gdal_array
+
+    def info(self, path):
+        """Get grid of a raster file, or None if it cannot be opened.
+
+        Keyword arguments:
+        path -- Path of raster file
+
+        Returns:
+        Dictionary of rows, cols, transform as (a, b, c, d, e, f), nodata and crs (WKT)
+        """
+        source = self.gdal.Open(path)
+        if source is None:
+            return None
+        c, a, b, f, d, e = source.GetGeoTransform()
+        return {
+            'rows' : source.RasterYSize,
+            'cols' : source.RasterXSize,
+            'transform' : (a, b, c, d, e, f),
+            'nodata' : source.GetRasterBand(1).GetNoDataValue(),
+            'crs' : source.GetProjectionRef() or None
+        }
+
+    def read(self, path, row0, row1, col0, col1, band=1):
+        """Read window of a raster band; row1 and col1 are exclusive."""
+        source = self.gdal.Open(path)
+        return source.GetRasterBand(band).ReadAsArray(int(col0), int(row0), int(col1 - col0), int(row1 - row0))
+
+    def write(self, path, layers, rows, cols, count, dtype, transform, crs, nodata=None,
+              driver='GTiff', options=()):
+        """Write layers as bands of a raster file.
+
+        Keyword arguments:
+        path -- Path of raster file
+        layers -- Iterable of (description, 2D array) pairs, description may be None
+        rows, cols -- Shape of layers
+        count -- Number of layers
+        dtype -- numpy dtype of layers
+        transform -- Affine transform as (a, b, c, d, e, f)
+        crs -- CRS as WKT
+        nodata -- Nodata value (default None)
+        driver -- GDAL driver name (default 'GTiff')
+        options -- GDAL creation options
+
+        Returns:
+        Number of bytes written
+        """
+        gdal = self.gdal
+        out_ds = gdal.GetDriverByName(driver).Create(
+            path, cols, rows, count, self.gdal_array.NumericTypeCodeToGDALTypeCode(np.dtype(dtype)), list(options))
+        a, b, c, d, e, f = transform
+        out_ds.SetGeoTransform((c, a, b, f, d, e))
+        out_ds.SetProjection(crs)
+        written = 0
+        for i, (description, values) in enumerate(layers):
+            band = out_ds.GetRasterBand(i + 1)
+            if nodata is not None:
+                band.SetNoDataValue(float(nodata))
+            if description is not None:
+                band.SetDescription(description)
+            band.WriteArray(values)
+            written += values.nbytes
+            band = None
+        out_ds.FlushCache()
+        out_ds = None
+        return written
+
+    def copy(self, source_path, path, driver, options=()):
+        """Copy raster file to another format, e.g. the COG driver."""
+        source = self.gdal.Open(source_path)
+        self.gdal.GetDriverByName(driver).CreateCopy(path, source, options=list(options))
+        source = None
+
+    def delete(self, path):
+        """Delete raster file, including /vsimem/ files."""
+        self.gdal.Unlink(path)
+
+class RasterioBackend(object):
+    """Raster backend using rasterio."""
+
+    name = 'rasterio'
+
+    def __init__(self):
+        import rasterio
+        import rasterio.shutil
+        from rasterio.windows import Window
+        self.rasterio = rasterio
+        self.Window = Window
+
+    def info(self, path):
+        try:
+            source = self.rasterio.open(path)
+        except self.rasterio.errors.RasterioIOError:
+            return None
+        with source:
+            return {
+                'rows' : source.height,
+                'cols' : source.width,
+                'transform' : tuple(source.transform)[:6],
+                'nodata' : source.nodata,
+                'crs' : source.crs.to_wkt() if source.crs else None
+            }
+
+    def read(self, path, row0, row1, col0, col1, band=1):
+        with self.rasterio.open(path) as source:
+            return source.read(band, window=self.Window(int(col0), int(row0), int(col1 - col0), int(row1 - row0)))
+
+    def write(self, path, layers, rows, cols, count, dtype, transform, crs, nodata=None,
+              driver='GTiff', options=()):
+        profile = dict(creation_options(options), driver=driver, height=rows, width=cols, count=count,
+                       dtype=np.dtype(dtype).name, crs=crs, nodata=nodata,
+                       transform=self.rasterio.Affine(*transform))
+        written = 0
+        with self.rasterio.open(path, 'w', **profile) as out:
+            for i, (description, values) in enumerate(layers):
+                out.write(values, i + 1)
+                if description is not None:
+                    out.set_band_description(i + 1, description)
+                written += values.nbytes
+        return written
+
+    def copy(self, source_path, path, driver, options=()):
+        self.rasterio.shutil.copy(source_path, path, driver=driver, **creation_options(options))
+
+    def delete(self, path):
+        os.remove(path)
+
+class NumpyBackend(object):
+    """Raster backend without dependencies, reading SRTM .hgt DEM tiles.
+
+    HGT tiles are square grids of big-endian 16 bit integers whose
+    position is given by their name, e.g. N45W122.hgt. Other formats are
+    not supported: info returns None for them and writing raises
+    ValueError.
+    """
+
+    name = 'numpy'
+
+    HGT_NAME = re.compile(r'^([NS])(\d{2})([EW])(\d{3})\.hgt$', re.IGNORECASE)
+
+    def info(self, path):
+        match = self.HGT_NAME.match(os.path.basename(path))
+        if match is None:
+            return None
+        size = int(round(np.sqrt(os.path.getsize(path) / 2)))
+        lat = int(match.group(2)) * (1 if match.group(1).upper() == 'N' else -1)
+        lon = int(match.group(4)) * (1 if match.group(3).upper() == 'E' else -1)
+        res = 1.0 / (size - 1)
+        # Cells are centered on the tile edges
+        return {
+            'rows' : size,
+            'cols' : size,
+            'transform' : (res, 0.0, lon - res / 2, 0.0, -res, lat + 1 + res / 2),
+            'nodata' : -32768,
+            'crs' : 'EPSG:4326'
+        }
+
+    def read(self, path, row0, row1, col0, col1, band=1):
+        size = self.info(path)['rows']
+        values = np.memmap(path, dtype='>i2', mode='r', shape=(size, size))
+        return np.array(values[int(row0):int(row1), int(col0):int(col1)], dtype=np.int16)
+
+    def write(self, path, *args, **kwargs):
+        raise ValueError('The numpy raster backend cannot write %s; install GDAL or rasterio' % path)
+
+    def copy(self, source_path, path, driver, options=()):
+        raise ValueError('The numpy raster backend cannot write %s; install GDAL or rasterio' % path)
+
+    def delete(self, path):
+        os.remove(path)
+
+BACKEND_CLASSES = {
+    'gdal' : GdalBackend,
+    'rasterio' : RasterioBackend,
+    'numpy' : NumpyBackend
+}
+
+def set_backend(name):
+    """Use raster backend by name, one of RASTER_BACKENDS.
+
+    Keyword arguments:
+    name -- Name of backend
+
+    Returns:
+    The backend
+    """
+    global _backend
+    if name not in BACKEND_CLASSES:
+        raise ValueError('Unknown raster backend %s; use one of %s' % (name, ', '.join(RASTER_BACKENDS)))
+    _backend = BACKEND_CLASSES[name]()
+    return _backend
+
+def backend():
+    """Get raster backend, choosing it on first use.
+
+    The backend is taken from the CSO_RASTER_BACKEND environment variable,
+    then the raster_backend credential (see creds), and otherwise is the
+    first of RASTER_BACKENDS that can be imported.
+    """
+    if _backend is not None:
+        return _backend
+    import validation.creds as creds
+    name = os.environ.get('CSO_RASTER_BACKEND') or creds.get_credential('raster_backend')
+    if name:
+        return set_backend(name)
+    for name in RASTER_BACKENDS:
+        try:
+            return set_backend(name)
+        except ImportError:
+            continue
@@ -0,0 +1,188 @@
+import numpy as np
+import pandas as pd
+import xarray as xr
+from pyproj import CRS, Transformer
+import validation.utils as ut
+
+# Statistics of observations computed per cell
+CELL_STATS = ['count', 'mean', 'min', 'max', 'std']
+
+def snodas_grid(prefix='us'):
+    """Get grid of SNODAS products.
+
+    Keyword arguments:
+    prefix -- 'us' for the masked archive, 'zz' for the unmasked archive (default 'us')
+
+    Returns:
+    Dictionary of rows, cols, transform and crs
+    """
+    import validation.SNODAS as SNODAS
+    grid = SNODAS.SNODAS_GRIDS[prefix]
+    return {'rows' : grid['rows'], 'cols' : grid['cols'], 'transform' : grid['transform'], 'crs' : 'EPSG:4326'}
+
+def ease2_grid():
+    """Get EASE2_G1km grid of C-SNOW products.
+
+    Returns:
+    Dictionary of rows, cols, transform and crs
+    """
+    import validation.CSNOW as CSNOW
+    import validation.regrid as regrid
+    eg_easting, eg_northing = CSNOW.ease2grid_coords()
+    return {'rows' : len(eg_northing), 'cols' : len(eg_easting),
+            'transform' : regrid.coords_transform(eg_easting, eg_northing), 'crs' : CSNOW.EASE2G_epsg_str}
+
+def dataarray_grid(da):
+    """Get grid of a DataArray, e.g. a SNODAS product or C-SNOW store variable.
+
+    Keyword arguments:
+    da -- xarray DataArray with y and x as last dimensions
+
+    Returns:
+    Dictionary of rows, cols, transform and crs
+    """
+    transform, crs, _ = ut.grid_geometry(da)
+    return {'rows' : da.shape[-2], 'cols' : da.shape[-1], 'transform' : transform, 'crs' : crs}
+
+def cell_indices(lons, lats, grid):
+    """Get flat indices (row * cols + col) of the grid cells containing points.
+
+    Points are projected to the CRS of the grid first.
+
+    Keyword arguments:
+    lons -- Array of longitudes
+    lats -- Array of latitudes
+    grid -- Dictionary of rows, cols, transform and crs (e.g. from snodas_grid or ease2_grid)
+
+    Returns:
+    Array of cell indices, -1 for points outside the grid
+    """
+    x = np.asarray(lons, dtype=np.float64)
+    y = np.asarray(lats, dtype=np.float64)
+    if CRS.from_user_input(grid['crs']).to_epsg() != 4326:
+        transformer = Transformer.from_crs('EPSG:4326', grid['crs'], always_xy=True)
+        x, y = transformer.transform(x, y)
+    rows, cols, valid = ut.grid_indices(x, y, grid['transform'], (grid['rows'], grid['cols']))
+    return np.where(valid, rows.astype(np.int64) * grid['cols'] + cols, -1)
+
+def aggregate(keys, values):
+    """Reduce values sharing a key to count, mean, min, max and standard deviation.
+
+    Keyword arguments:
+    keys -- Array of non-negative integer keys
+    values -- Array of values
+
+    Returns:
+    Array of unique keys, in increasing order, and dictionary of
+    statistic name to array per key; std is the sample standard deviation,
+    NaN for single values. Both are empty without keys.
+    """
+    keys = np.asarray(keys, dtype=np.int64)
+    values = np.asarray(values, dtype=np.float64)
+    if not len(keys):
+        empty = np.empty(0, dtype=np.float64)
+        return keys, {'count' : np.empty(0, dtype=np.int64), 'mean' : empty, 'min' : empty.copy(),
+                      'max' : empty.copy(), 'std' : empty.copy()}
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+    values = values[order]
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    ids = np.cumsum(np.r_[False, keys[1:] != keys[:-1]])
+
+    count = np.bincount(ids)
+    mean = np.bincount(ids, weights=values) / count
+    # Squared deviations from the group mean avoid cancellation in sum of squares
+    squares = np.bincount(ids, weights=(values - mean[ids]) ** 2)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        std = np.where(count > 1, np.sqrt(squares / (count - 1)), np.nan)
+    stats = {
+        'count' : count,
+        'mean' : mean,
+        'min' : np.minimum.reduceat(values, starts),
+        'max' : np.maximum.reduceat(values, starts),
+        'std' : std
+    }
+    return keys[starts], stats
+
+def rasterize(df, grid, value='depth', by_date=True):
+    """Aggregate observations per grid cell, and per day.
+
+    Observations outside the grid or without a value are dropped.
+
+    Keyword arguments:
+    df -- Dataframe of observations with longitude, latitude and, by date, date columns
+    grid -- Dictionary of rows, cols, transform and crs (e.g. from snodas_grid or ease2_grid)
+    value -- Column of values to aggregate (default 'depth')
+    by_date -- Whether to aggregate each day separately (default True)
+
+    Returns:
+    Dataframe of occupied cells, sorted by date and cell, with date (when
+    by_date), cell, row, col and CELL_STATS columns; empty when no
+    observation is on the grid
+    """
+    cells = cell_indices(df['longitude'].to_numpy(), df['latitude'].to_numpy(), grid)
+    values = df[value].to_numpy(dtype=np.float64)
+    valid = (cells >= 0) & ~np.isnan(values)
+    keys = cells[valid]
+    ncells = grid['rows'] * grid['cols']
+    if by_date:
+        days = pd.DatetimeIndex(df['date']).normalize().to_numpy()[valid]
+        day_codes, day_values = pd.factorize(days, sort=True)
+        keys = day_codes.astype(np.int64) * ncells + keys
+    keys, stats = aggregate(keys, values[valid])
+
+    out = {}
+    if by_date:
+        out['date'] = day_values[keys // ncells]
+    out['cell'] = keys % ncells
+    out['row'] = out['cell'] // grid['cols']
+    out['col'] = out['cell'] % grid['cols']
+    out.update(stats)
+    return pd.DataFrame(out, columns=list(out))
+
+def cell_values(cells, values):
+    """Get values of a grid at the cells of rasterized observations.
+
+    Keyword arguments:
+    cells -- Dataframe returned by rasterize
+    values -- 2D array or DataArray on the grid cells were computed for
+
+    Returns:
+    Array of grid values per row of cells
+    """
+    return np.asarray(values).reshape(-1)[cells['cell'].to_numpy()]
+
+def to_dense(cells, grid, stat='mean', fill=np.nan, dtype=np.float32):
+    """Convert rasterized observations to a dense grid.
+
+    Keyword arguments:
+    cells -- Dataframe returned by rasterize
+    grid -- Grid cells were computed for
+    stat -- Statistic to grid, one of CELL_STATS (default 'mean')
+    fill -- Value of cells without observations (default NaN)
+    dtype -- Type of grid values (default float32)
+
+    Returns:
+    xarray DataArray with (y, x) dimensions, or (time, y, x) when cells has
+    a date column; without cells, all fill or with an empty time dimension
+    """
+    a, _, c, _, e, f = grid['transform'][:6]
+    coords = {
+        'y' : f + e * (np.arange(grid['rows']) + 0.5),
+        'x' : c + a * (np.arange(grid['cols']) + 0.5)
+    }
+    ncells = grid['rows'] * grid['cols']
+    if 'date' in cells.columns:
+        dates, layers = np.unique(cells['date'].to_numpy(), return_inverse=True)
+        values = np.full(len(dates) * ncells, fill, dtype=dtype)
+        values[layers.ravel() * ncells + cells['cell'].to_numpy()] = cells[stat].to_numpy()
+        values = values.reshape(len(dates), grid['rows'], grid['cols'])
+        dims = ('time', 'y', 'x')
+        coords['time'] = pd.DatetimeIndex(dates)
+    else:
+        values = np.full(ncells, fill, dtype=dtype)
+        values[cells['cell'].to_numpy()] = cells[stat].to_numpy()
+        values = values.reshape(grid['rows'], grid['cols'])
+        dims = ('y', 'x')
+    return xr.DataArray(values, dims=dims, coords=coords, name=stat,
+                        attrs={'transform' : tuple(grid['transform'][:6]), 'crs' : grid['crs']})
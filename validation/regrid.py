@@ -0,0 +1,247 @@
+import os
+
+import numpy as np
+import xarray as xr
+from pyproj import CRS, Transformer
+from rasterio.warp import calculate_default_transform
+
+# Resampling methods supported by regrid plans
+REGRID_METHODS = ['nearest', 'bilinear']
+
+def coords_transform(x, y):
+    """Get affine transform of a regular grid from cell center coordinates.
+
+    Keyword arguments:
+    x -- Cell center x coordinates
+    y -- Cell center y coordinates
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    a = (x[-1] - x[0]) / (len(x) - 1)
+    e = (y[-1] - y[0]) / (len(y) - 1)
+    return (a, 0.0, x[0] - a / 2, 0.0, e, y[0] - e / 2)
+
+def regrid_plan(src_x, src_y, src_crs, resolution, dst_crs='epsg:4326', method='nearest'):
+    """Compute mapping from source grid cells to target grid cells.
+
+    The target grid is chosen the same way rioxarray's rio.reproject picks
+    it for a given resolution. Each target cell center is transformed to
+    the source grid once. For nearest, the plan stores the source cell
+    containing that point. For bilinear, it stores the upper-left source
+    cell and the fractional offsets between source cell centers.
+
+    Keyword arguments:
+    src_x -- Source cell center x coordinates
+    src_y -- Source cell center y coordinates
+    src_crs -- CRS of source grid
+    resolution -- Target resolution in target CRS units
+    dst_crs -- CRS of target grid (default 'epsg:4326')
+    method -- Resampling method, 'nearest' or 'bilinear' (default 'nearest')
+
+    Returns:
+    Dictionary of plan arrays, source and target grid description
+    """
+    if method not in REGRID_METHODS:
+        raise ValueError('Unknown regrid method: %s' % method)
+    src_shape = (len(src_y), len(src_x))
+    src_transform = coords_transform(src_x, src_y)
+    a, _, c, _, e, f = src_transform
+    left, right = sorted([c, c + a * src_shape[1]])
+    bottom, top = sorted([f, f + e * src_shape[0]])
+    dst_transform, width, height = calculate_default_transform(
+        src_crs, dst_crs, src_shape[1], src_shape[0], left, bottom, right, top, resolution=resolution)
+    dst_transform = tuple(dst_transform)[:6]
+    dst_a, _, dst_c, _, dst_e, dst_f = dst_transform
+
+    # Target cell centers, in source grid pixel coordinates
+    transformer = Transformer.from_crs(dst_crs, src_crs, always_xy=True)
+    dst_x = dst_c + dst_a * (np.arange(width) + 0.5)
+    dst_y = dst_f + dst_e * (np.arange(height) + 0.5)
+    xx, yy = np.meshgrid(dst_x, dst_y)
+    sx, sy = transformer.transform(xx.ravel(), yy.ravel())
+    col = (np.asarray(sx) - c) / a
+    row = (np.asarray(sy) - f) / e
+
+    plan = {
+        'method' : np.array(method),
+        'src_shape' : np.array(src_shape),
+        'src_transform' : np.array(src_transform),
+        'src_crs' : np.array(CRS.from_user_input(src_crs).to_wkt()),
+        'resolution' : np.array(resolution, dtype=np.float64),
+        'dst_shape' : np.array((height, width)),
+        'dst_transform' : np.array(dst_transform),
+        'dst_crs' : np.array(str(dst_crs))
+    }
+    if method == 'nearest':
+        rows = np.floor(row)
+        cols = np.floor(col)
+        valid = (rows >= 0) & (rows < src_shape[0]) & (cols >= 0) & (cols < src_shape[1])
+        plan['index'] = np.where(valid, rows * src_shape[1] + cols, -1).astype(np.int32)
+    else:
+        # Offsets relative to cell centers; edge cells are clamped to the grid
+        row = row - 0.5
+        col = col - 0.5
+        valid = (row >= -0.5) & (row <= src_shape[0] - 0.5) & (col >= -0.5) & (col <= src_shape[1] - 0.5)
+        row = np.clip(row, 0, src_shape[0] - 1)
+        col = np.clip(col, 0, src_shape[1] - 1)
+        rows = np.minimum(np.floor(row), max(src_shape[0] - 2, 0))
+        cols = np.minimum(np.floor(col), max(src_shape[1] - 2, 0))
+        plan['index'] = np.where(valid, rows * src_shape[1] + cols, -1).astype(np.int32)
+        plan['wy'] = (row - rows).astype(np.float32)
+        plan['wx'] = (col - cols).astype(np.float32)
+    return plan
+
+def save_plan(plan, path):
+    """Save regrid plan to .npz file.
+
+    Keyword arguments:
+    plan -- Dictionary returned by regrid_plan
+    path -- Path of file to write
+    """
+    tmp_path = path + '.tmp.npz'
+    np.savez(tmp_path, **plan)
+    os.replace(tmp_path, path)
+
+def load_plan(path):
+    """Load regrid plan from .npz file.
+
+    Keyword arguments:
+    path -- Path of file written by save_plan
+    """
+    with np.load(path, allow_pickle=False) as npz:
+        return {key : npz[key] for key in npz.files}
+
+def plan_mismatch(plan, src_x, src_y, src_crs, resolution, dst_crs='epsg:4326', method='nearest'):
+    """Get names of the grid properties a regrid plan was not computed for.
+
+    Plans saved without the source grid description mismatch on every
+    missing property.
+
+    Keyword arguments:
+    plan -- Dictionary returned by regrid_plan
+    src_x, src_y, src_crs, resolution, dst_crs, method -- Arguments of regrid_plan
+
+    Returns:
+    List of mismatched property names, empty if the plan applies
+    """
+    expected = {
+        'method' : lambda value: str(value) == method,
+        'src_shape' : lambda value: tuple(value) == (len(src_y), len(src_x)),
+        'src_transform' : lambda value: np.allclose(value, coords_transform(src_x, src_y), rtol=0, atol=1e-9),
+        'src_crs' : lambda value: CRS.from_user_input(str(value)) == CRS.from_user_input(src_crs),
+        'resolution' : lambda value: np.shape(value) == np.shape(resolution) and np.allclose(value, resolution),
+        'dst_crs' : lambda value: CRS.from_user_input(str(value)) == CRS.from_user_input(dst_crs)
+    }
+    return [name for name, matches in expected.items() if name not in plan or not matches(plan[name])]
+
+def cached_plan(plan_dir, key, src_x, src_y, src_crs, resolution, dst_crs='epsg:4326', method='nearest'):
+    """Load regrid plan from directory, computing and saving it on first use.
+
+    A saved plan is only used if it was computed for the same source grid
+    (shape, transform and CRS), resolution, target CRS and method;
+    otherwise it is recomputed and replaced.
+
+    Keyword arguments:
+    plan_dir -- Directory of saved plans
+    key -- Name identifying the plan, e.g. domain, resolution and method
+    src_x, src_y, src_crs, resolution, dst_crs, method -- Arguments passed to regrid_plan
+    """
+    args = (src_x, src_y, src_crs, resolution, dst_crs, method)
+    path = os.path.join(plan_dir, '%s.npz' % key)
+    if os.path.exists(path):
+        plan = load_plan(path)
+        if not plan_mismatch(plan, *args):
+            return plan
+    plan = regrid_plan(*args)
+    os.makedirs(plan_dir, exist_ok=True)
+    save_plan(plan, path)
+    return plan
+
+def apply_plan(plan, data):
+    """Regrid array of any number of time slices with a regrid plan.
+
+    Keyword arguments:
+    plan -- Dictionary returned by regrid_plan
+    data -- Array of shape (..., rows, columns) on the source grid
+
+    Returns:
+    Array of shape (..., rows, columns) on the target grid, NaN outside the source grid
+    """
+    src_shape = tuple(int(n) for n in plan['src_shape'])
+    dst_shape = tuple(int(n) for n in plan['dst_shape'])
+    data = np.asarray(data)
+    if data.shape[-2:] != src_shape:
+        raise ValueError('Data of shape %s is not on the source grid of the plan %s' % (data.shape[-2:], src_shape))
+    lead = data.shape[:-2]
+    flat = data.reshape((-1, src_shape[0] * src_shape[1])).astype(np.float32, copy=False)
+    index = plan['index']
+    valid = index >= 0
+    safe = np.where(valid, index, 0)
+
+    if str(plan['method']) == 'nearest':
+        out = flat[:, safe]
+    else:
+        ncols = src_shape[1]
+        right = np.minimum(safe % ncols + 1, ncols - 1) - safe % ncols
+        down = np.where(safe // ncols + 1 < src_shape[0], ncols, 0)
+        wx, wy = plan['wx'], plan['wy']
+        corners = [
+            (safe, (1 - wx) * (1 - wy)),
+            (safe + right, wx * (1 - wy)),
+            (safe + down, (1 - wx) * wy),
+            (safe + down + right, wx * wy)
+        ]
+        # Weighted mean of non-NaN corners, like GDAL skipping nodata
+        total = np.zeros((flat.shape[0], len(safe)), dtype=np.float32)
+        weight = np.zeros_like(total)
+        for idx, w in corners:
+            values = flat[:, idx]
+            present = ~np.isnan(values)
+            total += np.where(present, values * w, 0)
+            weight += np.where(present, w, 0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            out = np.where(weight > 0, total / weight, np.nan)
+
+    out[:, ~valid] = np.nan
+    return out.reshape(lead + dst_shape)
+
+def regrid(ds, plan, x_dim='x', y_dim='y', x_name='longitude', y_name='latitude'):
+    """Regrid xarray dataset with a regrid plan.
+
+    Only variables on the source grid are kept. The result carries no CRS
+    information; it is in plan['dst_crs'].
+
+    Keyword arguments:
+    ds -- xarray Dataset or DataArray on the source grid
+    plan -- Dictionary returned by regrid_plan
+    x_dim -- Name of source x dimension (default 'x')
+    y_dim -- Name of source y dimension (default 'y')
+    x_name -- Name of target x dimension (default 'longitude')
+    y_name -- Name of target y dimension (default 'latitude')
+    """
+    if 'src_transform' in plan and not np.allclose(
+            plan['src_transform'], coords_transform(ds[x_dim].values, ds[y_dim].values), rtol=0, atol=1e-9):
+        raise ValueError('Coordinates of %s and %s do not match the source grid of the plan' % (x_dim, y_dim))
+    rows, cols = plan['dst_shape']
+    a, _, c, _, e, f = plan['dst_transform']
+    coords = {
+        y_name : f + e * (np.arange(rows) + 0.5),
+        x_name : c + a * (np.arange(cols) + 0.5)
+    }
+
+    def regrid_array(da):
+        if x_dim not in da.dims or y_dim not in da.dims:
+            return da
+        da = da.transpose(..., y_dim, x_dim)
+        lead = [dim for dim in da.dims if dim not in (y_dim, x_dim)]
+        return xr.DataArray(
+            apply_plan(plan, da.values),
+            dims=lead + [y_name, x_name],
+            coords={**{dim : da[dim] for dim in lead if dim in da.coords}, **coords},
+            attrs=da.attrs
+        )
+
+    if isinstance(ds, xr.DataArray):
+        return regrid_array(ds)
+    return xr.Dataset({name : regrid_array(da) for name, da in ds.data_vars.items()
+                       if x_dim in da.dims and y_dim in da.dims}, attrs=ds.attrs)
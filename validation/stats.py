@@ -0,0 +1,324 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import validation.matchups as matchups
+
+# Columns statistics are grouped by by default
+STATS_GROUPS = ['water_year', 'region', 'source', 'author', 'elevation_band']
+
+# Height of elevation bands (m)
+ELEVATION_BAND = 500
+
+# Bin edges of value and difference histograms (m); values outside go to under/overflow bins
+VALUE_EDGES = np.linspace(0.0, 10.0, 501)
+DIFFERENCE_EDGES = np.linspace(-5.0, 5.0, 1001)
+
+# Quantiles of differences reported by GroupedStats.result
+STATS_QUANTILES = (0.05, 0.25, 0.5, 0.75, 0.95)
+
+# Sums kept per group: x is observed, y is modeled and d = y - x
+SUMS = ['x', 'y', 'xx', 'yy', 'xy', 'd', 'dd', 'abs_d']
+
+def group_columns(df, by, elevation_band=ELEVATION_BAND):
+    """Get values of group columns of matchups.
+
+    water_year is derived from the date column and elevation_band from the
+    dem_elevation column, or the elevation column if there is none. Other
+    groups are columns of df; missing columns and values are grouped as None.
+
+    Keyword arguments:
+    df -- Dataframe of matchups
+    by -- List of group names
+    elevation_band -- Height of elevation bands (default ELEVATION_BAND)
+
+    Returns:
+    List of arrays, one per group
+    """
+    columns = []
+    for name in by:
+        if name == 'water_year':
+            values = matchups.water_year(df['date'])
+        elif name == 'elevation_band':
+            column = 'dem_elevation' if 'dem_elevation' in df.columns else 'elevation'
+            elevation = df[column].to_numpy(dtype=np.float64) if column in df.columns else np.full(len(df), np.nan)
+            values = np.floor(elevation / elevation_band) * elevation_band
+        elif name in df.columns:
+            values = df[name].to_numpy()
+        else:
+            values = np.full(len(df), None, dtype=object)
+        columns.append(values)
+    return columns
+
+def histogram_bins(values, edges):
+    """Get histogram bin of values: 0 below the first edge, len(edges) above the last."""
+    return np.searchsorted(edges, values, side='right')
+
+def histogram_quantiles(counts, edges, low, high, quantiles):
+    """Estimate quantiles from histogram counts by interpolating within bins.
+
+    Keyword arguments:
+    counts -- Array of shape (groups, len(edges) + 1) including under/overflow bins
+    edges -- Bin edges
+    low -- Array of group minimums, the lower edge of the underflow bin
+    high -- Array of group maximums, the upper edge of the overflow bin
+    quantiles -- Quantiles to estimate
+
+    Returns:
+    Array of shape (groups, quantiles)
+    """
+    n = counts.sum(axis=1)
+    cumulative = np.cumsum(counts, axis=1)
+    result = np.full((len(counts), len(quantiles)), np.nan)
+    for g in np.nonzero(n)[0]:
+        lower = np.concatenate([[min(low[g], edges[0])], edges])
+        upper = np.concatenate([edges, [max(high[g], edges[-1])]])
+        for j, q in enumerate(quantiles):
+            rank = q * n[g]
+            b = min(np.searchsorted(cumulative[g], rank, side='left'), len(upper) - 1)
+            before = cumulative[g, b - 1] if b > 0 else 0
+            fraction = (rank - before) / counts[g, b] if counts[g, b] else 0.0
+            result[g, j] = lower[b] + fraction * (upper[b] - lower[b])
+    return np.clip(result, low[:, np.newaxis], high[:, np.newaxis])
+
+class GroupedStats(object):
+    """Mergeable validation statistics of modeled against observed values per group.
+
+    Each group keeps its count, sums of values, squares and cross-products,
+    the minimum and maximum difference, and fixed-bin histograms of
+    observed, modeled and difference values. All of these are combined by
+    addition, so statistics of chunks processed separately, e.g. in
+    parallel workers, merge into those of a single pass.
+
+    Keyword arguments:
+    by -- List of groups (default STATS_GROUPS, see group_columns)
+    elevation_band -- Height of elevation bands (default ELEVATION_BAND)
+    value_edges -- Bin edges of observed and modeled histograms (default VALUE_EDGES)
+    difference_edges -- Bin edges of difference histograms (default DIFFERENCE_EDGES)
+    """
+
+    def __init__(self, by=STATS_GROUPS, elevation_band=ELEVATION_BAND,
+                 value_edges=VALUE_EDGES, difference_edges=DIFFERENCE_EDGES):
+        self.by = list(by)
+        self.elevation_band = elevation_band
+        self.value_edges = np.asarray(value_edges, dtype=np.float64)
+        self.difference_edges = np.asarray(difference_edges, dtype=np.float64)
+        self.keys = {}
+        self.count = np.zeros(0, dtype=np.int64)
+        self.sums = np.zeros((0, len(SUMS)))
+        self.d_min = np.zeros(0)
+        self.d_max = np.zeros(0)
+        self.hist_x = np.zeros((0, len(self.value_edges) + 1), dtype=np.int64)
+        self.hist_y = np.zeros((0, len(self.value_edges) + 1), dtype=np.int64)
+        self.hist_d = np.zeros((0, len(self.difference_edges) + 1), dtype=np.int64)
+
+    def group_ids(self, keys):
+        """Get ids of group keys, adding new groups.
+
+        Keyword arguments:
+        keys -- List of key tuples
+        """
+        new = [key for key in dict.fromkeys(keys) if key not in self.keys]
+        if new:
+            for key in new:
+                self.keys[key] = len(self.keys)
+            n = len(new)
+            self.count = np.concatenate([self.count, np.zeros(n, dtype=np.int64)])
+            self.sums = np.concatenate([self.sums, np.zeros((n, len(SUMS)))])
+            self.d_min = np.concatenate([self.d_min, np.full(n, np.inf)])
+            self.d_max = np.concatenate([self.d_max, np.full(n, -np.inf)])
+            self.hist_x = np.concatenate([self.hist_x, np.zeros((n, self.hist_x.shape[1]), dtype=np.int64)])
+            self.hist_y = np.concatenate([self.hist_y, np.zeros((n, self.hist_y.shape[1]), dtype=np.int64)])
+            self.hist_d = np.concatenate([self.hist_d, np.zeros((n, self.hist_d.shape[1]), dtype=np.int64)])
+        return np.array([self.keys[key] for key in keys], dtype=np.int64)
+
+    def update(self, df, observed='depth', modeled='snodas_1036', observed_scale=0.01, modeled_scale=1.0):
+        """Add matchups to statistics. Rows where either value is missing are skipped.
+
+        Keyword arguments:
+        df -- Dataframe of matchups
+        observed -- Column of observed values (default 'depth', in cm)
+        modeled -- Column of modeled values (default 'snodas_1036', in m)
+        observed_scale -- Factor converting observed values to common units (default 0.01, cm to m)
+        modeled_scale -- Factor converting modeled values to common units (default 1.0)
+
+        Returns:
+        self
+        """
+        import pandas as pd
+
+        x = df[observed].to_numpy(dtype=np.float64) * observed_scale
+        y = df[modeled].to_numpy(dtype=np.float64) * modeled_scale
+        valid = ~np.isnan(x) & ~np.isnan(y)
+        if not valid.any():
+            return self
+        x, y = x[valid], y[valid]
+        d = y - x
+
+        # Factorize each group column, then the rows of codes, so keys are only built per group
+        codes = []
+        uniques = []
+        for values in group_columns(df, self.by, self.elevation_band):
+            c, u = pd.factorize(pd.Series(values[valid], dtype=object), use_na_sentinel=False)
+            codes.append(c)
+            # Missing values become None, as NaN keys never compare equal
+            uniques.append([None if pd.isna(value) else value for value in u])
+        shape = tuple(len(u) for u in uniques)
+        combined, first = pd.factorize(np.ravel_multi_index(codes, shape))
+        keys = [tuple(uniques[j][i] for j, i in enumerate(row)) for row in zip(*np.unravel_index(first, shape))]
+        ids = self.group_ids(keys)[combined]
+
+        n = len(self.keys)
+        self.count += np.bincount(ids, minlength=n)
+        for i, values in enumerate([x, y, x * x, y * y, x * y, d, d * d, np.abs(d)]):
+            self.sums[:, i] += np.bincount(ids, weights=values, minlength=n)
+        np.minimum.at(self.d_min, ids, d)
+        np.maximum.at(self.d_max, ids, d)
+        for hist, values, edges in [(self.hist_x, x, self.value_edges), (self.hist_y, y, self.value_edges),
+                                    (self.hist_d, d, self.difference_edges)]:
+            bins = hist.shape[1]
+            hist += np.bincount(ids * bins + histogram_bins(values, edges), minlength=n * bins).reshape(n, bins)
+        return self
+
+    def merge(self, other):
+        """Add statistics of another GroupedStats with the same groups and bins.
+
+        Keyword arguments:
+        other -- GroupedStats to merge
+
+        Returns:
+        self
+        """
+        if other.by != self.by or other.elevation_band != self.elevation_band or \
+                not np.array_equal(other.value_edges, self.value_edges) or \
+                not np.array_equal(other.difference_edges, self.difference_edges):
+            raise ValueError('Cannot merge statistics with different groups or bins')
+        ids = self.group_ids(list(other.keys))
+        self.count[ids] += other.count
+        self.sums[ids] += other.sums
+        self.d_min[ids] = np.minimum(self.d_min[ids], other.d_min)
+        self.d_max[ids] = np.maximum(self.d_max[ids], other.d_max)
+        self.hist_x[ids] += other.hist_x
+        self.hist_y[ids] += other.hist_y
+        self.hist_d[ids] += other.hist_d
+        return self
+
+    def index(self):
+        """Get index of groups, in the order of the statistics arrays."""
+        import pandas as pd
+
+        return pd.MultiIndex.from_tuples(list(self.keys), names=self.by)
+
+    def result(self, quantiles=STATS_QUANTILES):
+        """Get validation statistics per group.
+
+        Keyword arguments:
+        quantiles -- Quantiles of differences to estimate from histograms (default STATS_QUANTILES)
+
+        Returns:
+        Dataframe indexed by group with count, observed and modeled means,
+        bias (mean of modeled - observed), MAE, RMSE, standard deviation
+        of differences, correlation, slope and intercept of modeled
+        against observed, minimum and maximum difference and difference
+        quantiles
+        """
+        import pandas as pd
+
+        n = self.count.astype(np.float64)
+        s = dict(zip(SUMS, self.sums.T))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean_x = s['x'] / n
+            mean_y = s['y'] / n
+            var_x = s['xx'] / n - mean_x ** 2
+            var_y = s['yy'] / n - mean_y ** 2
+            cov = s['xy'] / n - mean_x * mean_y
+            bias = s['d'] / n
+            slope = cov / var_x
+            columns = {
+                'count' : self.count,
+                'observed_mean' : mean_x,
+                'modeled_mean' : mean_y,
+                'bias' : bias,
+                'mae' : s['abs_d'] / n,
+                'rmse' : np.sqrt(s['dd'] / n),
+                'std' : np.sqrt(np.maximum(s['dd'] / n - bias ** 2, 0) * n / (n - 1)),
+                'r' : cov / np.sqrt(var_x * var_y),
+                'slope' : slope,
+                'intercept' : mean_y - slope * mean_x,
+                'difference_min' : self.d_min,
+                'difference_max' : self.d_max
+            }
+        estimates = histogram_quantiles(self.hist_d, self.difference_edges, self.d_min, self.d_max, quantiles)
+        for j, q in enumerate(quantiles):
+            columns['difference_p%02d' % round(q * 100)] = estimates[:, j]
+        return pd.DataFrame(columns, index=self.index()).sort_index()
+
+    def histograms(self, kind='difference'):
+        """Get histogram counts per group.
+
+        Keyword arguments:
+        kind -- 'observed', 'modeled' or 'difference' (default 'difference')
+
+        Returns:
+        Dataframe indexed by group with a column per bin, labelled by its
+        lower edge; the first column counts values below the first edge
+        """
+        import pandas as pd
+
+        hist, edges = {'observed' : (self.hist_x, self.value_edges),
+                       'modeled' : (self.hist_y, self.value_edges),
+                       'difference' : (self.hist_d, self.difference_edges)}[kind]
+        return pd.DataFrame(hist, index=self.index(), columns=np.concatenate([[-np.inf], edges])).sort_index()
+
+def file_stats(store, paths, schema, partitioning, filters, by, kwargs):
+    """Compute statistics of some files of a matchup store; runs in worker processes."""
+    import pyarrow.dataset as pds
+
+    stats = GroupedStats(by, **kwargs.pop('options'))
+    dataset = pds.dataset(paths, schema=schema, format='parquet', partitioning=partitioning,
+                          partition_base_dir=store)
+    for batch in dataset.to_batches(filter=filters):
+        stats.update(batch.to_pandas(), **kwargs)
+    return stats
+
+def matchup_stats(store, by=STATS_GROUPS, filters=None, workers=None, elevation_band=ELEVATION_BAND,
+                  value_edges=VALUE_EDGES, difference_edges=DIFFERENCE_EDGES, **kwargs):
+    """Compute grouped validation statistics of a matchup store in one pass.
+
+    Files of the store are split among worker processes and their partial
+    statistics merged.
+
+    Keyword arguments:
+    store -- Directory of matchup store (see matchups.update_store)
+    by -- List of groups (default STATS_GROUPS)
+    filters -- Filters pushed down to the reader (see matchups.read_matchups)
+    workers -- Number of processes (default CPU count)
+    elevation_band -- Height of elevation bands (default ELEVATION_BAND)
+    value_edges -- Bin edges of observed and modeled histograms (default VALUE_EDGES)
+    difference_edges -- Bin edges of difference histograms (default DIFFERENCE_EDGES)
+    kwargs -- Arguments of GroupedStats.update, e.g. observed and modeled
+
+    Returns:
+    GroupedStats
+    """
+    import pyarrow.dataset as pds
+    import pyarrow.parquet as pq
+
+    options = {'elevation_band' : elevation_band, 'value_edges' : value_edges, 'difference_edges' : difference_edges}
+    stats = GroupedStats(by, **options)
+    dataset = matchups.store_dataset(store)
+    if dataset is None:
+        return stats
+    if filters is not None and not isinstance(filters, pds.Expression):
+        filters = pq.filters_to_expression(filters)
+
+    paths = [fragment.path for fragment in dataset.get_fragments(filter=filters)]
+    workers = min(workers or os.cpu_count() or 1, len(paths)) or 1
+    partitioning = pds.HivePartitioning(dataset.partitioning.schema)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(file_stats, store, paths[i::workers], dataset.schema, partitioning, filters, by,
+                                   dict(kwargs, options=options))
+                   for i in range(workers)]
+        for future in futures:
+            stats.merge(future.result())
+    return stats
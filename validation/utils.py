@@ -1,11 +1,18 @@
+import os
 import urllib.request
 import tarfile
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from contextlib import closing, contextmanager
 from io import BytesIO
-from osgeo import gdal, gdal_array, osr
+from itertools import chain
 import re
 from datetime import datetime
 
 import numpy as np
+import validation.metrics as metrics
+import validation.raster as raster
 
 def batches(list, size):
     """Splits list into batches of fixed size.
@@ -26,8 +33,8 @@ def intervals(start, end, intervals):
     intervals -- Number of points to generate
     """
     stop = 0
-    while stop < stops:
-        yield (start + stop * (end - start) / (stops - 1))
+    while stop < intervals:
+        yield (start + stop * (end - start) / (intervals - 1))
         stop += 1
 
 def date_from_file(name):
@@ -40,12 +47,34 @@ def date_from_file(name):
     date = datetime.strptime(match.group(), '%Y%m%d')
     return date
 
+def grid_indices(x, y, transform, shape):
+    """Get row and column indices of points on a regular grid.
+
+    Keyword arguments:
+    x -- Array of x coordinates (e.g. longitude)
+    y -- Array of y coordinates (e.g. latitude)
+    transform -- Affine transform of grid as (a, b, c, d, e, f) tuple
+    shape -- Shape of grid as (rows, columns)
+
+    Returns:
+    rows, columns and boolean mask of points inside the grid
+    """
+    a, _, c, _, e, f = transform[:6]
+    cols = np.floor((np.asarray(x, dtype=float) - c) / a)
+    rows = np.floor((np.asarray(y, dtype=float) - f) / e)
+    valid = (rows >= 0) & (rows < shape[0]) & (cols >= 0) & (cols < shape[1])
+    rows = np.where(valid, rows, 0).astype(np.intp)
+    cols = np.where(valid, cols, 0).astype(np.intp)
+    return rows, cols, valid
+
 def gdal_metadata(source):
     """Get metadata from GDAL dataset.
 
     Keyword arguments:
     source -- GDAL dataset to retrieve metadata for
     """
+    from osgeo import gdal, osr
+
     ndv = source.GetRasterBand(1).GetNoDataValue()
     width = source.RasterXSize
     height = source.RasterYSize
@@ -62,64 +91,362 @@ def url_to_io(url):
     Keyword arguments:
     url -- URL to fetch data from
     """
-    stream = urllib.request.urlopen(url)
-    bytes = BytesIO()
-    while True:
-        next = stream.read(16384)
-        if not next:
-            break
+    with metrics.span('utils.url_to_io') as span:
+        stream = urllib.request.urlopen(url)
+        bytes = BytesIO()
+        while True:
+            next = stream.read(16384)
+            if not next:
+                break
 
-        bytes.write(next)
+            bytes.write(next)
 
-    stream.close()
+        stream.close()
+        span.add('bytes_in', bytes.tell())
     bytes.seek(0)
     return bytes
 
-def url_to_tar(url):
+def retry(func, *args, attempts=3, backoff=1.0, exceptions=(IOError, EOFError), **kwargs):
+    """Call function, retrying transient failures with exponential backoff.
+
+    Keyword arguments:
+    func -- Function to call with remaining positional and keyword arguments
+    attempts -- Maximum number of calls (default 3)
+    backoff -- Seconds to wait after first failure, doubled after each retry
+    exceptions -- Exception types treated as transient
+    """
+    for attempt in range(attempts):
+        try:
+            return func(*args, **kwargs)
+        except exceptions:
+            if attempt == attempts - 1:
+                raise
+            time.sleep(backoff * 2 ** attempt)
+
+def url_to_tar(url, stream=False):
     """Get tar object from url.
 
+    In stream mode the archive is read directly from the connection as a
+    forward-only stream instead of being buffered in memory first. Members
+    must then be read in archive order (see SNODAS.tar_members). Closing a
+    streamed tar does not close the connection; use stream_tar to have it
+    closed when reading stops.
+
     Keyword arguments:
     url -- URL of SNODAS data for specific date
+    stream -- Whether to open tar in stream mode (default False)
     """
+    if stream:
+        with metrics.span('utils.urlopen'):
+            response = urllib.request.urlopen(url)
+        # Bytes are counted in whichever span reads the archive
+        return tarfile.open(fileobj = metrics.counted(response), mode = 'r|')
     io = url_to_io(url)
     tar = tarfile.open(fileobj = io, mode = 'r')
     return tar
 
-def save_ds(ds, path, driver):
-    """Save GDAL dataset using arbitrary driver.
+@contextmanager
+def stream_tar(url):
+    """Open tar at url in stream mode, closing the connection on exit.
+
+    Reading may stop before the end of the archive (e.g. once a bbox
+    window is decoded), so the connection is closed here rather than
+    left to garbage collection.
+
+    Keyword arguments:
+    url -- URL of SNODAS data for specific date
+
+    Yields:
+    tar object opened in stream mode
+    """
+    with metrics.span('utils.urlopen'):
+        response = urllib.request.urlopen(url)
+    with closing(response):
+        # Bytes are counted in whichever span reads the archive
+        yield tarfile.open(fileobj = metrics.counted(response), mode = 'r|')
+
+# Creation options of tiled, compressed GeoTIFFs
+TIFF_OPTIONS = ['TILED=YES', 'BIGTIFF=IF_SAFER', 'INTERLEAVE=BAND']
+
+# HDF5 is not thread-safe, so NetCDF files are written one at a time
+NETCDF_LOCK = threading.Lock()
+
+def grid_layers(ds):
+    """Split grids into 2D layers without copying them.
+
+    Keyword arguments:
+    ds -- xarray DataArray with (y, x), (band, y, x) or (time, y, x) dimensions,
+          e.g. from SNODAS.snodas_ds, or iterable of (date, DataArray) pairs
+
+    Yields:
+    (date, 2D array, DataArray) tuples; date is None when unknown
+    """
+    import pandas as pd
+    import xarray as xr
+
+    if isinstance(ds, xr.DataArray):
+        if 'time' in ds.dims:
+            ds = ds.transpose('time', ...)
+            for i, date in enumerate(ds['time'].values):
+                yield pd.Timestamp(date), ds.values[i].reshape(ds.shape[-2:]), ds
+        else:
+            yield None, ds.values.reshape(ds.shape[-2:]), ds
+        return
+    for date, da in ds:
+        for _, values, da in grid_layers(da):
+            yield pd.Timestamp(date), values, da
+
+def layer_count(ds):
+    """Count the layers grid_layers yields, without reading grid values.
+
+    Keyword arguments:
+    ds -- Grids accepted by grid_layers; an iterator of pairs is consumed,
+          so pass the returned pairs to grid_layers
+
+    Returns:
+    (number of layers, grids) tuple
+    """
+    import xarray as xr
+
+    if isinstance(ds, xr.DataArray):
+        return (ds.sizes['time'] if 'time' in ds.dims else 1), ds
+    if not isinstance(ds, (list, tuple)):
+        ds = list(ds)
+    return sum(layer_count(da)[0] for _, da in ds), ds
+
+def grid_geometry(da):
+    """Get affine transform, CRS and nodata value of a grid.
+
+    The transform is read from the transform attribute of rasterio-style
+    grids, or computed from the cell center coordinates of the last two
+    dimensions.
+
+    Keyword arguments:
+    da -- xarray DataArray
+    """
+    if 'transform' in da.attrs:
+        transform = tuple(da.attrs['transform'])[:6]
+    else:
+        y = da[da.dims[-2]].values.astype(np.float64)
+        x = da[da.dims[-1]].values.astype(np.float64)
+        a = (x[-1] - x[0]) / (len(x) - 1)
+        e = (y[-1] - y[0]) / (len(y) - 1)
+        transform = (a, 0.0, x[0] - a / 2, 0.0, e, y[0] - e / 2)
+    crs = da.attrs.get('crs')
+    if crs is None and 'spatial_ref' in da.coords:
+        # Written by rioxarray's rio.write_crs
+        crs = da['spatial_ref'].attrs.get('crs_wkt')
+    nodata = da.attrs.get('nodatavals', (None,))[0]
+    return transform, crs or 'EPSG:4326', nodata
+
+def crs_wkt(crs):
+    """Get WKT of a CRS given as WKT, PROJ string or EPSG code.
+
+    Keyword arguments:
+    crs -- CRS definition, e.g. '+init=epsg:4326'
+    """
+    from pyproj import CRS
+    crs = str(crs)
+    # PROJ deprecates the +init= syntax; the authority code alone is equivalent
+    if crs.startswith('+init=') and ' ' not in crs:
+        crs = crs[len('+init='):].upper()
+    return CRS.from_user_input(crs).to_wkt('WKT1_GDAL')
+
+def native(values):
+    """Get array in native byte order; GDAL and HDF5 reject big-endian buffers.
+
+    Keyword arguments:
+    values -- numpy array
+    """
+    if values.dtype.isnative:
+        return values
+    return values.astype(values.dtype.newbyteorder('='))
+
+def save_ds(ds, path, driver='GTiff', compress='DEFLATE', blocksize=512, options=()):
+    """Save grids with a GDAL driver, one band per layer, using the raster backend.
+
+    Layers are written one at a time straight from the grid arrays, so
+    many days go into one multi-band file in a single pass. Band
+    descriptions hold the dates.
 
     Keyword arguments:
-    ds -- GDAl dataset
+    ds -- Grids accepted by grid_layers
     path -- Location where file will be saved
-    driver -- Driver to use
+    driver -- GDAL driver to use (default 'GTiff')
+    compress -- Compression method (default 'DEFLATE')
+    blocksize -- Tile width and height in cells (default 512)
+    options -- Additional creation options
     """
+    # Band count is needed up front; layers are then read as they are written
+    count, ds = layer_count(ds)
+    layers = grid_layers(ds)
+    first_layer = next(layers, None)
+    if first_layer is None:
+        raise ValueError('No grids to save to %s' % path)
+    _, first, da = first_layer
+    transform, crs, nodata = grid_geometry(da)
+    rows, cols = first.shape
+    dtype = first.dtype.newbyteorder('=')
+
+    creation = list(options)
+    if driver == 'GTiff':
+        creation += TIFF_OPTIONS + ['BLOCKXSIZE=%d' % blocksize, 'BLOCKYSIZE=%d' % blocksize]
+        if compress:
+            creation += ['COMPRESS=%s' % compress,
+                         'PREDICTOR=%d' % (3 if dtype.kind == 'f' else 2)]
 
-    band = ds.GetRasterBand(1)
-    bytes = band.ReadAsArray()
-    driver = gdal.GetDriverByName(driver)
-    ndv, width, height, transform, projection, dtype = gdal_metadata(ds)
-    bytes[np.isnan(bytes)] = ndv
-    out_ds = driver.Create(path, width, height, 1, gdal.GDT_Int16)
-    out_ds.SetGeoTransform(transform)
-    out_ds.SetProjection(projection.ExportToWkt())
+    bands = ((date.strftime('%Y-%m-%d') if date is not None else None, native(values))
+             for date, values, _ in chain([first_layer], layers))
+    with metrics.span('utils.save_ds', driver=driver) as span:
+        written = raster.backend().write(path, bands, rows, cols, count, dtype, transform, crs_wkt(crs),
+                                         nodata=nodata, driver=driver, options=creation)
+        span.add('bytes_out', written)
 
-    out_ds.GetRasterBand(1).WriteArray(bytes)
-    out_ds.GetRasterBand(1).SetNoDataValue(ndv)
+def save_tiff(ds, path, cog=False, compress='DEFLATE', blocksize=512, options=()):
+    """Save grids as tiled, compressed GeoTIFF or Cloud Optimized GeoTIFF.
 
-def save_tiff(ds, path):
-    """Save GDAL dataset as GeoTIFF file.
+    A COG is written as a tiled GeoTIFF first and then copied by GDAL's COG
+    driver, which adds overviews; the GDAL and rasterio raster backends
+    both support it.
 
     Keyword arguments:
-    ds -- GDAl dataset
+    ds -- Grids accepted by grid_layers
     path -- Location where file will be saved
+    cog -- Whether to write a Cloud Optimized GeoTIFF (default False)
+    compress -- Compression method (default 'DEFLATE')
+    blocksize -- Tile width and height in cells (default 512)
+    options -- Additional creation options
     """
-    save_ds(ds, path, 'GTiff')
+    if not cog:
+        save_ds(ds, path, 'GTiff', compress=compress, blocksize=blocksize, options=options)
+        return
+
+    tmp_path = path + '.tmp.tif'
+    save_ds(ds, tmp_path, 'GTiff', compress=None, blocksize=blocksize)
+    try:
+        with metrics.span('utils.save_cog'):
+            creation = ['BLOCKSIZE=%d' % blocksize, 'BIGTIFF=IF_SAFER'] + list(options)
+            if compress:
+                creation.append('COMPRESS=%s' % compress)
+            raster.backend().copy(tmp_path, path, 'COG', options=creation)
+    finally:
+        raster.backend().delete(tmp_path)
+
+def save_netcdf(ds, path, name=None, chunks=(1, 512, 512), complevel=4):
+    """Save grids as chunked, compressed NetCDF4 file.
 
-def save_netcdf(ds, path):
-    """Save GDAL dataset as NetCDF file.
+    Layers are appended along an unlimited time dimension as they arrive,
+    so an iterable of (date, DataArray) pairs is written in a single pass
+    without holding all days in memory. A single grid without a date is
+    written as a 2D variable.
 
     Keyword arguments:
-    ds -- GDAl dataset
+    ds -- Grids accepted by grid_layers
     path -- Location where file will be saved
+    name -- Name of variable (default DataArray name, then 'Band1' like GDAL)
+    chunks -- Chunk sizes along (time, y, x) (default (1, 512, 512))
+    complevel -- zlib compression level, 0 for none (default 4)
     """
-    save_ds(ds, path, 'netCDF')
+    import netCDF4
+    import pandas as pd
+
+    layers = grid_layers(ds)
+    first_layer = next(layers, None)
+    if first_layer is None:
+        raise ValueError('No grids to save to %s' % path)
+    date, first, da = first_layer
+    transform, crs, nodata = grid_geometry(da)
+    a, _, c, _, e, f = transform
+    rows, cols = first.shape
+    name = name or da.name or 'Band1'
+    timed = date is not None
+
+    # Only HDF5 calls hold the lock; the next layer is fetched without it
+    nc = None
+    with metrics.span('utils.save_netcdf') as span:
+        try:
+            with NETCDF_LOCK:
+                nc = netCDF4.Dataset(path + '.tmp', 'w', format='NETCDF4')
+                nc.createDimension('y', rows)
+                nc.createDimension('x', cols)
+                y = nc.createVariable('y', 'f8', ('y',))
+                y[:] = f + e * (np.arange(rows) + 0.5)
+                x = nc.createVariable('x', 'f8', ('x',))
+                x[:] = c + a * (np.arange(cols) + 0.5)
+                grid_mapping = nc.createVariable('spatial_ref', 'i4')
+                grid_mapping.spatial_ref = grid_mapping.crs_wkt = crs_wkt(crs)
+                grid_mapping.GeoTransform = ' '.join(str(v) for v in (c, a, 0.0, f, 0.0, e))
+
+                dims = ('y', 'x')
+                if timed:
+                    nc.createDimension('time', None)
+                    times = nc.createVariable('time', 'f8', ('time',))
+                    times.units = 'days since 1970-01-01'
+                    times.calendar = 'standard'
+                    dims = ('time',) + dims
+                chunksizes = [min(size, dim) for size, dim in zip(chunks[-len(dims):], (1, rows, cols)[-len(dims):])]
+                var = nc.createVariable(name, first.dtype.newbyteorder('='), dims, zlib=complevel > 0,
+                                        complevel=complevel or None, chunksizes=chunksizes,
+                                        fill_value=nodata if nodata is not None else None)
+                var.grid_mapping = 'spatial_ref'
+                # Values are written as stored, without masking copies
+                var.set_auto_maskandscale(False)
+
+            layer = first_layer
+            i = 0
+            while layer is not None:
+                date, values, _ = layer
+                values = native(values)
+                with NETCDF_LOCK:
+                    if timed:
+                        var[i] = values
+                        times[i] = (date - pd.Timestamp('1970-01-01')) / pd.Timedelta(days=1)
+                    else:
+                        var[:] = values
+                span.add('bytes_out', values.nbytes)
+                i += 1
+                layer = next(layers, None)
+        finally:
+            if nc is not None:
+                with NETCDF_LOCK:
+                    nc.close()
+    os.replace(path + '.tmp', path)
+
+def save_dates(grids, path_format, save=save_tiff, workers=4, max_in_flight=8, **kwargs):
+    """Save grids of many dates to one file each, with parallel writers.
+
+    Compression runs in GDAL and HDF5 outside the GIL, so writers are
+    threads; NetCDF writes are serialized by NETCDF_LOCK. At most
+    max_in_flight grids are waiting to be written.
+
+    Keyword arguments:
+    grids -- Iterable of (date, DataArray) pairs; select a product from
+             SNODAS.snodas_dates with SNODAS.product_dates
+    path_format -- strftime format of output paths, e.g. 'SNODAS_%Y%m%d.tif'
+    save -- Function to write each grid with (default save_tiff)
+    workers -- Number of writer threads (default 4)
+    max_in_flight -- Maximum number of grids waiting to be written (default 8)
+    kwargs -- Additional arguments passed to save
+
+    Returns:
+    List of paths written
+    """
+    import pandas as pd
+    import xarray as xr
+
+    paths = []
+    pending = set()
+    with ThreadPoolExecutor(workers) as pool:
+        for date, da in grids:
+            if isinstance(da, (dict, xr.Dataset)):
+                raise ValueError('Grids of %s are keyed by product code; select one with SNODAS.product_dates' % date)
+            if len(pending) >= max_in_flight:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+            path = pd.Timestamp(date).strftime(path_format)
+            pending.add(pool.submit(save, da, path, **kwargs))
+            paths.append(path)
+        for future in pending:
+            future.result()
+    return paths